@@ -0,0 +1,48 @@
+"""Benchmark di RPO Zero.
+
+Misurano i tempi delle operazioni principali (query del DatabaseHandler,
+calcolo fiscale, generazione PDF) su database sintetici di dimensione
+crescente e scrivono i risultati in JSON, da confrontare prima e dopo ogni
+modifica di prestazioni:
+
+    python -m benchmarks --righe 1000 10000 --output risultati.json
+
+L'applicazione è un unico file con un nome non importabile (contiene dei
+punti): viene caricata con importlib da load_app().
+"""
+
+import importlib.util
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(REPO_DIR, "Rpo_Zero_v2.0.0.py")
+
+
+def load_app(path=None):
+    """Importa il file dell'applicazione come modulo 'rpo_zero' e lo ritorna.
+
+    Il modulo crea il suo DatabaseHandler globale all'import ma apre il
+    database solo al primo accesso: usare use_database() per puntarlo al
+    dataset voluto.
+    """
+    path = os.path.abspath(path or APP_PATH)
+    spec = importlib.util.spec_from_file_location("rpo_zero", path)
+    app = importlib.util.module_from_spec(spec)
+    sys.modules["rpo_zero"] = app
+    spec.loader.exec_module(app)
+    return app
+
+
+def use_database(app, cartella):
+    """Sostituisce il database globale dell'app con quello di cartella.
+
+    Anche la directory corrente passa a cartella: i PDF vengono scritti in
+    RPO_RICEVUTE/ relativo alla directory corrente.
+    """
+    os.makedirs(cartella, exist_ok=True)
+    os.chdir(cartella)
+    app.db.close()
+    app.DB_NAME = os.path.join(os.path.abspath(cartella), "rpo_zero.db")
+    app.db = app.DatabaseHandler()
+    return app.db
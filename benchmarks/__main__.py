@@ -0,0 +1,116 @@
+"""Esegue i benchmark e scrive i risultati in JSON.
+
+    python -m benchmarks --righe 1000 10000 100000 --output risultati.json
+
+I dataset vengono creati una volta sola in --cartella e riusati nei run
+successivi con gli stessi parametri.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from . import APP_PATH, REPO_DIR, load_app
+from .dataset import cartella_dataset, genera_dataset
+from .suite import bench_calcolo, bench_database, bench_pdf
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark di RPO Zero")
+    parser.add_argument("--righe", type=int, nargs="+", default=[1000, 10000],
+                        help="dimensioni dei dataset in numero di ricevute (default: 1000 10000)")
+    parser.add_argument("--utenti", type=int, default=5, help="utenti per dataset (default: 5)")
+    parser.add_argument("--seed", type=int, default=0, help="seme del generatore (default: 0)")
+    parser.add_argument("--ripetizioni", type=int, default=15, help="campioni per misura (default: 15)")
+    parser.add_argument("--pdf", type=int, default=30, help="PDF generati per la misura del rendering (default: 30)")
+    parser.add_argument("--cartella", default=os.path.join(tempfile.gettempdir(), "rpo_zero_bench"),
+                        help="dove creare e riusare i dataset")
+    parser.add_argument("--app", default=APP_PATH, help="file dell'applicazione da misurare")
+    parser.add_argument("--output", help="file JSON dei risultati (default: standard output)")
+    return parser
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _versione_fpdf():
+    try:
+        from importlib.metadata import version
+        return version("fpdf2")
+    except Exception:
+        return None
+
+
+def metadati(args):
+    with open(args.app, "rb") as f:
+        app_sha = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "piattaforma": platform.platform(),
+        "processore": platform.processor() or platform.machine(),
+        "sqlite": sqlite3.sqlite_version,
+        "fpdf2": _versione_fpdf(),
+        "app": os.path.basename(args.app),
+        "app_sha256": app_sha,
+        "git_commit": _git_commit(),
+        "parametri": {"righe": args.righe, "utenti": args.utenti, "seed": args.seed,
+                      "ripetizioni": args.ripetizioni, "pdf": args.pdf},
+    }
+
+
+def esegui(args, log=print):
+    """Crea/apre i dataset, esegue tutte le misure e ritorna il documento dei risultati."""
+    args.app = os.path.abspath(args.app)
+    cartella = os.path.abspath(args.cartella)
+    app = load_app(args.app)
+    documento = {"meta": metadati(args), "dataset": [], "risultati": {}}
+    risultati = documento["risultati"]
+
+    log("calcolo fiscale...")
+    risultati.update(bench_calcolo(app, args.ripetizioni))
+    for i, righe in enumerate(sorted(args.righe)):
+        log(f"dataset {righe} ricevute...")
+        info = genera_dataset(app, cartella_dataset(cartella, righe, args.utenti, args.seed), righe,
+                              utenti=args.utenti, seed=args.seed)
+        documento["dataset"].append(info)
+        risultati.update(bench_database(app, info, args.ripetizioni))
+        if i == 0 and args.pdf:
+            # Il rendering non dipende dalla dimensione del database
+            log("generazione PDF...")
+            risultati.update(bench_pdf(app, info, args.pdf))
+    app.db.close()
+    return documento
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    # I dataset cambiano la directory corrente: i percorsi relativi vanno risolti prima
+    output = os.path.abspath(args.output) if args.output else None
+    documento = esegui(args, log=lambda msg: print(msg, file=sys.stderr))
+    testo = json.dumps(documento, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(testo + "\n")
+    else:
+        print(testo)
+    for chiave, voce in documento["risultati"].items():
+        print(f"  {chiave:<36} mediana {voce['median'] * 1000:9.3f} ms   p95 {voce['p95'] * 1000:9.3f} ms",
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Confronta i benchmark con un file di riferimento e segnala i peggioramenti.
+
+    python -m benchmarks --output baseline.json          # prima della modifica
+    python -m benchmarks.confronta baseline.json         # dopo: rilancia e confronta
+
+Senza --risultati i benchmark vengono rieseguiti con gli stessi parametri
+del riferimento (dimensioni, seed, ripetizioni). Un'operazione è peggiorata
+se la sua mediana supera quella di riferimento di più della tolleranza E la
+differenza è maggiore del rumore (3 volte la MAD più alta dei due run, e
+almeno minimo_ms): i picchi isolati non bastano a far fallire il controllo.
+Se qualcosa risulta peggiorato i benchmark vengono ripetuti (--conferme) e
+per ogni operazione vale il run migliore: un rallentamento dovuto al carico
+momentaneo della macchina non si ripresenta, una regressione vera sì.
+Esce con codice 1 se almeno un'operazione è peggiorata.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from . import __main__ as runner
+
+SOGLIE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soglie.json")
+TOLLERANZA = 0.20
+MINIMO_MS = 0.05
+FATTORE_MAD = 3
+
+
+def carica_soglie(path):
+    """Soglie da file JSON: {"predefinita": 0.2, "minimo_ms": 0.05, "operazioni": {chiave: tolleranza}}.
+
+    Le chiavi possono essere complete (get_receipts@50000) o il solo nome
+    dell'operazione, valido per tutte le dimensioni.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def tolleranza_per(chiave, voce, soglie, predefinita):
+    operazioni = soglie.get("operazioni", {})
+    for nome in (chiave, voce.get("operazione")):
+        if nome in operazioni:
+            return operazioni[nome]
+    return soglie.get("predefinita", predefinita)
+
+
+def confronta(riferimento, attuale, soglie, predefinita=TOLLERANZA):
+    """Ritorna una riga per ogni operazione del riferimento:
+    (chiave, mediana_rif, mediana_att, variazione, tolleranza, esito)
+    con esito tra "ok", "meglio", "PEGGIORATO", "mancante"."""
+    minimo = soglie.get("minimo_ms", MINIMO_MS) / 1000
+    righe = []
+    for chiave, rif in sorted(riferimento["risultati"].items()):
+        tolleranza = tolleranza_per(chiave, rif, soglie, predefinita)
+        att = attuale["risultati"].get(chiave)
+        if att is None:
+            righe.append((chiave, rif["median"], None, None, tolleranza, "mancante"))
+            continue
+        delta = att["median"] - rif["median"]
+        variazione = delta / rif["median"] if rif["median"] else 0.0
+        rumore = max(FATTORE_MAD * max(rif["mad"], att["mad"]), minimo)
+        if variazione > tolleranza and delta > rumore:
+            esito = "PEGGIORATO"
+        elif variazione < -tolleranza and -delta > rumore:
+            esito = "meglio"
+        else:
+            esito = "ok"
+        righe.append((chiave, rif["median"], att["median"], variazione, tolleranza, esito))
+    return righe
+
+
+def migliori(documenti):
+    """Unisce più run tenendo, per ogni operazione, quello con la mediana più bassa."""
+    unito = dict(documenti[0], risultati={})
+    for doc in documenti:
+        for chiave, voce in doc["risultati"].items():
+            if chiave not in unito["risultati"] or voce["median"] < unito["risultati"][chiave]["median"]:
+                unito["risultati"][chiave] = voce
+    return unito
+
+
+def stampa(righe, file=sys.stdout):
+    print(f"{'operazione':<36} {'riferimento':>12} {'attuale':>12} {'var.':>8} {'toll.':>6}  esito", file=file)
+    for chiave, rif, att, variazione, tolleranza, esito in righe:
+        att_txt = f"{att * 1000:9.3f} ms" if att is not None else f"{'-':>12}"
+        var_txt = f"{variazione:+7.1%}" if variazione is not None else f"{'-':>8}"
+        print(f"{chiave:<36} {rif * 1000:9.3f} ms {att_txt} {var_txt} {tolleranza:6.0%}  {esito}", file=file)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.confronta",
+                                     description="Confronta i benchmark con un riferimento")
+    parser.add_argument("riferimento", help="file JSON dei risultati di riferimento")
+    parser.add_argument("--risultati", help="file JSON già prodotto da confrontare (default: rilancia i benchmark)")
+    parser.add_argument("--soglie", default=SOGLIE_PATH, help="tolleranze per operazione (default: benchmarks/soglie.json)")
+    parser.add_argument("--tolleranza", type=float, default=TOLLERANZA,
+                        help="tolleranza predefinita, es. 0.2 = +20%% sulla mediana")
+    parser.add_argument("--conferme", type=int, default=1,
+                        help="run aggiuntivi per confermare i peggioramenti (default: 1)")
+    parser.add_argument("--ripetizioni", type=int, help="campioni per misura (default: come il riferimento)")
+    parser.add_argument("--cartella", help="dove creare e riusare i dataset")
+    parser.add_argument("--app", help="file dell'applicazione da misurare")
+    parser.add_argument("--output", help="salva qui i risultati del nuovo run")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    with open(args.riferimento, encoding="utf-8") as f:
+        riferimento = json.load(f)
+
+    soglie = carica_soglie(args.soglie)
+    if args.risultati:
+        with open(args.risultati, encoding="utf-8") as f:
+            attuale = json.load(f)
+        righe = confronta(riferimento, attuale, soglie, args.tolleranza)
+    else:
+        # Stessi parametri del riferimento, così i tempi sono confrontabili
+        parametri = riferimento["meta"]["parametri"]
+        argv_run = ["--righe", *map(str, parametri["righe"]), "--utenti", str(parametri["utenti"]),
+                    "--seed", str(parametri["seed"]), "--pdf", str(parametri["pdf"]),
+                    "--ripetizioni", str(args.ripetizioni or parametri["ripetizioni"])]
+        for opzione in ("cartella", "app"):
+            if getattr(args, opzione):
+                argv_run += [f"--{opzione}", getattr(args, opzione)]
+        output = os.path.abspath(args.output) if args.output else None
+        runs = []
+        for tentativo in range(1 + max(0, args.conferme)):
+            if tentativo:
+                print(f"Peggioramenti da confermare, nuovo run ({tentativo}/{args.conferme})...", file=sys.stderr)
+            run_args = runner.build_arg_parser().parse_args(argv_run)
+            runs.append(runner.esegui(run_args, log=lambda msg: print(msg, file=sys.stderr)))
+            attuale = migliori(runs)
+            righe = confronta(riferimento, attuale, soglie, args.tolleranza)
+            if not any(r[5] == "PEGGIORATO" for r in righe):
+                break
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                f.write(json.dumps(attuale, indent=2, ensure_ascii=False) + "\n")
+
+    stampa(righe)
+    peggiorati = [r[0] for r in righe if r[5] == "PEGGIORATO"]
+    if peggiorati:
+        print(f"\n{len(peggiorati)} operazioni peggiorate oltre la tolleranza: {', '.join(peggiorati)}")
+        return 1
+    print("\nNessun peggioramento oltre la tolleranza.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Generatore di database sintetici per i benchmark.
+
+I dati passano dalle stesse funzioni dell'applicazione (DatabaseHandler,
+FiscalEngine), quindi trigger, totali annui, sequenze e indice di ricerca
+sono quelli reali. Ogni utente ha clienti, incarichi e ricevute distribuite
+su più anni, con una quota di note di credito che stornano ricevute
+precedenti. Con lo stesso seed il dataset è sempre identico.
+"""
+
+import os
+import random
+from datetime import date
+
+from . import use_database
+
+# Ricevute inserite per transazione
+BLOCCO = 5000
+
+RAGIONI = ("Comune di", "Provincia di", "Consorzio", "ASL", "Università di", "Studio Associato")
+CITTA = ("Salerno", "Napoli", "Avellino", "Caserta", "Benevento", "Potenza", "Roma", "Bari")
+ATTIVITA = ("Collaudo tecnico-amministrativo", "Direzione lavori", "Consulenza", "Docenza",
+            "Progettazione", "Supporto al RUP", "Verifica progetto", "Commissione di gara")
+
+
+def cartella_dataset(base, righe, utenti, seed):
+    """Cartella in cui viene salvato (e riusato) il dataset con questi parametri."""
+    return os.path.join(base, f"dataset_{righe}_{utenti}u_s{seed}")
+
+
+def genera_dataset(app, cartella, righe, utenti=5, anni=3, clienti_per_utente=20,
+                   incarichi_per_cliente=3, quota_note_credito=0.03, seed=0):
+    """Crea in cartella un rpo_zero.db con circa `righe` ricevute e lo apre.
+
+    Se il database esiste già (stessi parametri) viene solo riaperto.
+    Ritorna un dizionario con la descrizione del dataset.
+    """
+    # Il segnaposto viene scritto solo a generazione finita: un dataset
+    # interrotto a metà viene cancellato e rifatto
+    segnaposto = os.path.join(cartella, "COMPLETO")
+    esistente = os.path.exists(segnaposto)
+    if not esistente:
+        for suffisso in ("", "-wal", "-shm"):
+            path = os.path.join(cartella, "rpo_zero.db" + suffisso)
+            if os.path.exists(path):
+                os.remove(path)
+    db = use_database(app, cartella)
+    rng = random.Random(seed)
+    anno_finale = date.today().year
+    elenco_anni = list(range(anno_finale - anni + 1, anno_finale + 1))
+    info = {"righe": righe, "utenti": utenti, "anni": elenco_anni, "seed": seed, "cartella": cartella}
+
+    if not esistente:
+        per_utente = [righe // utenti + (1 if u < righe % utenti else 0) for u in range(utenti)]
+        for u, n in enumerate(per_utente):
+            user_id = _crea_utente(db, u)
+            assignments = _crea_anagrafiche(db, rng, user_id, clienti_per_utente, incarichi_per_cliente)
+            for anno in elenco_anni:
+                db.ensure_fiscal_config_exists(user_id, anno)
+            quote = [n // anni + (1 if i < n % anni else 0) for i in range(anni)]
+            for anno, n_anno in zip(elenco_anni, quote):
+                _crea_ricevute(app, db, rng, user_id, anno, n_anno, assignments, quota_note_credito)
+        with db.transaction() as conn:
+            # I PDF non esistono: il dataset serve solo alle query
+            conn.execute("UPDATE receipts SET render_status = 'rendered'")
+        db.pool.checkpoint()
+        with open(segnaposto, "w") as f:
+            f.write(f"{righe}\n")
+
+    conn = db._get_connection()
+    info["ricevute"] = conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+    info["note_credito"] = conn.execute("SELECT COUNT(*) FROM receipts WHERE importo_lordo_cents < 0").fetchone()[0]
+    info["user_ids"] = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    return info
+
+
+def _crea_utente(db, u):
+    username = f"bench{u}"
+    db.register_user(username, "bench", f"Utente Benchmark {u}")
+    user_id = db.get_user_by_username(username)['id']
+    db.save_user_profile(user_id, f"Mario Rossi {u}", f"RSSMRA80A01H703{u % 10}",
+                         "Via Roma 1, 84100 Salerno (SA)", "IT60X0542811101000000123456",
+                         f"bench{u}@example.com", "089000000")
+    return user_id
+
+
+def _crea_anagrafiche(db, rng, user_id, n_clienti, incarichi_per_cliente):
+    with db.transaction():
+        for c in range(n_clienti):
+            nome = f"{rng.choice(RAGIONI)} {rng.choice(CITTA)} {c}"
+            db.save_client(user_id, None, nome, f"{rng.randrange(10**10, 10**11)}",
+                           f"Piazza Municipio {c}, {rng.choice(CITTA)}", f"protocollo{c}@example.it",
+                           rng.random() < 0.8, "")
+        for client in db.get_clients(user_id):
+            for i in range(incarichi_per_cliente):
+                db.save_assignment(user_id, None, client['id'],
+                                   f"{rng.choice(ATTIVITA)} - lotto {i + 1}", "2020-01-01",
+                                   f"Det. n. {rng.randrange(1, 999)}/{2020 + i}", "2020-01-01",
+                                   "Ing. Giuseppe Verdi", "rup@example.it",
+                                   f"Z{rng.randrange(16**9):09X}", "Attivo" if i == 0 else "Chiuso")
+    return [a['id'] for a in db.get_assignments(user_id)]
+
+
+def _crea_ricevute(app, db, rng, user_id, anno, n, assignments, quota_note_credito):
+    """n ricevute dell'anno in ordine di emissione, calcolate con FiscalEngine."""
+    if n <= 0:
+        return
+    engine = app.FiscalEngine(db.get_fiscal_config(user_id, anno))
+    lordi = [round(rng.uniform(150, 4000), 2) for _ in range(n)]
+    spese = [round(rng.uniform(0, 150), 2) if rng.random() < 0.2 else 0 for _ in range(n)]
+    righe = engine.righe(lordi, spese)
+    giorni = sorted(rng.randrange(1, 365) for _ in range(n))
+
+    rows, emesse = [], []  # emesse: (numero, incarico, importi) delle ricevute stornabili
+    for numero, (r, giorno) in enumerate(zip(righe, giorni), start=1):
+        data_em = date.fromordinal(date(anno, 1, 1).toordinal() + giorno - 1).isoformat()
+        assign_id = rng.choice(assignments)
+        desc = f"{rng.choice(ATTIVITA)} - prestazione n. {numero}"
+        if emesse and rng.random() < quota_note_credito:
+            # Nota di credito: storno totale di una ricevuta precedente, come fa la GUI
+            num_orig, assign_id, orig = rng.choice(emesse)
+            r = {k: -orig[k] if k in app.FiscalEngine.MONEY_COLUMNS else orig[k] for k in app.FiscalEngine.COLUMNS}
+            desc = f"STORNO TOTALE Ricevuta n. {num_orig}/{anno}"
+            suffisso = "_STORNO"
+        else:
+            emesse.append((numero, assign_id, r))
+            suffisso = ""
+        rows.append((user_id, assign_id, numero, anno, data_em, desc,
+                     r['lordo'], r['imp_inps'], r['aliq_inps'], r['rit_inps'], r['quota_inps'],
+                     r['aliq_irpef'], r['imp_irpef'], r['spese'], r['bollo_bool'], r['val_bollo'], r['netto'],
+                     f"RPO_RICEVUTE/User{user_id}_RPO_{anno}_{numero}{suffisso}.pdf"))
+        if len(rows) == BLOCCO:
+            db.save_receipts_bulk(rows)
+            rows = []
+    if rows:
+        db.save_receipts_bulk(rows)
@@ -0,0 +1,127 @@
+"""Operazioni misurate dai benchmark e statistiche sui tempi.
+
+Ogni misura è un elenco di campioni in secondi (uno per ripetizione, dopo
+un giro di riscaldamento non conteggiato) riassunto da statistiche():
+mediana, p95 e MAD sono robuste ai picchi occasionali del sistema.
+"""
+
+import os
+import statistics
+import time
+
+
+def statistiche(campioni):
+    """Riassunto di una lista di tempi in secondi."""
+    ordinati = sorted(campioni)
+    mediana = statistics.median(ordinati)
+    # p95 col metodo nearest-rank: sempre uno dei campioni osservati
+    p95 = ordinati[max(0, -(-95 * len(ordinati) // 100) - 1)]
+    return {
+        "n": len(ordinati),
+        "min": ordinati[0],
+        "median": mediana,
+        "mean": statistics.fmean(ordinati),
+        "p95": p95,
+        "max": ordinati[-1],
+        "mad": statistics.median(abs(x - mediana) for x in ordinati),
+    }
+
+
+def misura(fn, ripetizioni, riscaldamento=1, prepara=None, pulisci=None):
+    """Esegue fn() riscaldamento + ripetizioni volte e ritorna i campioni misurati.
+
+    prepara() e pulisci() girano prima e dopo ogni chiamata, fuori dal tempo
+    misurato; il valore di prepara() viene passato a fn e quello di fn a pulisci.
+    """
+    campioni = []
+    for i in range(riscaldamento + ripetizioni):
+        arg = prepara() if prepara else None
+        t0 = time.perf_counter()
+        risultato = fn(arg) if prepara else fn()
+        elapsed = time.perf_counter() - t0
+        if pulisci:
+            pulisci(risultato)
+        if i >= riscaldamento:
+            campioni.append(elapsed)
+    return campioni
+
+
+def risultato(operazione, campioni, righe=None, **extra):
+    """Voce del file dei risultati; la chiave è operazione@righe per quelle sul database."""
+    chiave = f"{operazione}@{righe}" if righe is not None else operazione
+    voce = {"operazione": operazione, "righe": righe, "unita": "s", "campioni": campioni}
+    voce.update(statistiche(campioni))
+    voce.update(extra)
+    return chiave, voce
+
+
+def bench_database(app, info, ripetizioni):
+    """Query e scritture principali del DatabaseHandler sul dataset aperto."""
+    db = app.db
+    righe = info["righe"]
+    user_id = info["user_ids"][0]
+    anno = info["anni"][-1]
+    risultati = {}
+
+    def aggiungi(operazione, campioni, **extra):
+        chiave, voce = risultato(operazione, campioni, righe, **extra)
+        risultati[chiave] = voce
+
+    aggiungi("get_receipts", misura(lambda: db.get_receipts(user_id), ripetizioni))
+    aggiungi("get_receipts_page", misura(lambda: db.get_receipts_page(user_id, 100), ripetizioni))
+    aggiungi("get_annual_gross", misura(lambda: db.get_annual_gross(user_id, anno), ripetizioni))
+    aggiungi("get_next_receipt_number", misura(lambda: db.get_next_receipt_number(user_id, anno), ripetizioni))
+
+    assignment_id = db.get_assignments(user_id)[0]['id']
+    cfg = db.get_fiscal_config(user_id, anno)
+    importi = app.calcola_ricevuta(cfg, 0, 1000, 0, 20, anno)
+
+    def salva(_):
+        num = db.get_next_receipt_number(user_id, anno)
+        i = importi
+        return db.save_receipt(user_id, assignment_id, num, anno, f"{anno}-12-31", "Benchmark",
+                               i['lordo'], i['imp_inps'], i['aliq_inps'], i['rit_inps'], i['quota_inps'],
+                               i['aliq_irpef'], i['imp_irpef'], i['spese'], i['bollo_bool'], i['val_bollo'],
+                               i['netto'], f"RPO_RICEVUTE/bench_{num}.pdf")
+
+    # Ogni ricevuta di prova viene cancellata subito: il dataset resta invariato
+    aggiungi("save_receipt", misura(salva, ripetizioni, prepara=lambda: None, pulisci=db.delete_receipt))
+    return risultati
+
+
+def bench_calcolo(app, ripetizioni, ricevute_anno=1000):
+    """Calcolo fiscale: una ricevuta singola e un anno intero con FiscalEngine."""
+    cfg = {"anno": 2025, "soglia_inps_no_tax": 5000.0, "aliquota_gestione_separata": 24.0,
+           "quota_carico_utente": 0.33333333, "soglia_bollo": 77.47, "valore_bollo": 2.0}
+    engine = app.FiscalEngine(cfg)
+    lordi = [150 + (i * 37) % 3850 for i in range(ricevute_anno)]
+    return dict([
+        risultato("calcola_ricevuta", misura(lambda: app.calcola_ricevuta(cfg, 4800, 1000, 50, 20, 2025),
+                                             ripetizioni)),
+        risultato("fiscal_engine_anno", misura(lambda: engine.calcola(lordi), ripetizioni),
+                  ricevute=ricevute_anno),
+    ])
+
+
+def bench_pdf(app, info, numero):
+    """Throughput di genera_pdf_ricevuta (documento di 2 pagine) sulle prime
+    ricevute del dataset; un campione per PDF."""
+    db = app.db
+    ids = db.get_receipt_ids(info["user_ids"][0])[:numero]
+    contesti = db.get_render_contexts(ids)
+    path = os.path.join("RPO_RICEVUTE", "benchmark.pdf")
+    coda = iter(contesti * 2)
+
+    def prossimo():
+        return next(coda)
+
+    def genera(ctx):
+        return app.genera_pdf_ricevuta(ctx.profile, ctx.client, ctx.pdf_data, path,
+                                       is_credit_note=ctx.is_credit_note)
+
+    # Il riscaldamento copre l'import di fpdf2 al primo PDF
+    campioni = misura(genera, len(contesti), prepara=prossimo)
+    os.remove(path)
+    chiave, voce = risultato("genera_pdf_ricevuta", campioni)
+    voce["pdf_al_secondo"] = len(campioni) / sum(campioni) if campioni else 0.0
+    return {chiave: voce}
@@ -2,16 +2,44 @@
 # Versione Monolitica 2.0.0 (Multi-Utente)
 # Tutti i moduli integrati in un unico file
 
+import time
+# Tempi di avvio per --profile-startup: (fase, secondi da inizio import)
+_STARTUP_T0 = time.perf_counter()
+STARTUP_TIMINGS = []
+
+def startup_mark(fase):
+    STARTUP_TIMINGS.append((fase, time.perf_counter() - _STARTUP_T0))
+
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 from datetime import date
 import sqlite3
 import hashlib
 import platform
 import subprocess
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos  # <--- Aggiungi questa riga
+# fpdf2 NON viene importato qui: lo carica pdf_class() al primo rendering
 import os
+import sys
+import argparse
+import csv
+import json
+import threading
+import queue
+import atexit
+import getpass
+import multiprocessing
+import inspect
+import re
+import logging
+import logging.handlers
+from bisect import bisect_left
+from collections import namedtuple, deque
+from functools import wraps
+from itertools import accumulate, count
+from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+startup_mark("import librerie")
 
 # =========================================================================
 # MODULO 1: DATABASE HANDLER
@@ -19,21 +47,905 @@ import os
 
 DB_NAME = "rpo_zero.db"
 
-class DatabaseHandler:
+# Profilo di storage applicato a ogni nuova connessione (PRAGMA -> valore).
+# Ogni voce si può sovrascrivere con la variabile d'ambiente RPO_ZERO_<PRAGMA>,
+# es. RPO_ZERO_CACHE_SIZE=-64000. WAL usa memoria condivisa e non è affidabile
+# su cartelle di rete (SMB/NFS): se il database è su un percorso di rete si usa
+# NETWORK_STORAGE_PROFILE, a meno che RPO_ZERO_JOURNAL_MODE non dica altrimenti.
+STORAGE_PROFILE = {
+    "foreign_keys": "ON",
+    "journal_mode": "WAL",      # letture e scritture concorrenti
+    "synchronous": "NORMAL",    # in WAL: niente fsync a ogni commit, solo al checkpoint
+    "cache_size": -16000,       # negativo = KiB (circa 16 MB)
+    "mmap_size": 67108864,      # 64 MB
+    "temp_store": "MEMORY",
+}
+
+NETWORK_STORAGE_PROFILE = {
+    "journal_mode": "DELETE",   # rollback journal: solo lock sul file, niente memoria condivisa
+    "synchronous": "FULL",      # senza WAL NORMAL non protegge dalle interruzioni a metà commit
+}
+
+# File system di rete riconosciuti in /proc/mounts (Linux)
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afpfs", "ncpfs",
+                       "fuse.sshfs", "davfs", "fuse.davfs2"}
+
+def percorso_di_rete(path):
+    """True se path sta su una cartella di rete: UNC (\\\\server\\...), unità di
+    rete di Windows o mount NFS/SMB su Linux. Nel dubbio False."""
+    full = os.path.abspath(path)
+    if sys.platform == "win32":
+        if full.startswith("\\\\"):
+            return True
+        drive = os.path.splitdrive(full)[0]
+        if not drive:
+            return False
+        import ctypes
+        DRIVE_REMOTE = 4
+        return ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") == DRIVE_REMOTE
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    full = os.path.realpath(full)
+    fstype, lunghezza = None, -1
+    for mountpoint, tipo in mounts:
+        # /proc/mounts codifica gli spazi come \040
+        mountpoint = mountpoint.replace("\\040", " ")
+        if (full == mountpoint or full.startswith(mountpoint.rstrip("/") + "/")) and len(mountpoint) > lunghezza:
+            fstype, lunghezza = tipo, len(mountpoint)
+    return fstype in NETWORK_FILESYSTEMS
+
+def load_storage_profile(overrides=None, db_path=None):
+    """Ritorna il profilo di storage effettivo (default + ambiente + overrides).
+
+    Con db_path su una cartella di rete il WAL predefinito diventa
+    NETWORK_STORAGE_PROFILE; un journal_mode esplicito (ambiente o
+    overrides) viene sempre rispettato.
+    """
+    profile = dict(STORAGE_PROFILE)
+    explicit = set(overrides or {}) | {name for name in profile if os.environ.get(f"RPO_ZERO_{name.upper()}")}
+    if db_path and "journal_mode" not in explicit and percorso_di_rete(db_path):
+        profile.update({k: v for k, v in NETWORK_STORAGE_PROFILE.items() if k not in explicit})
+    for name in profile:
+        env_value = os.environ.get(f"RPO_ZERO_{name.upper()}")
+        if env_value:
+            profile[name] = env_value
+    profile.update(overrides or {})
+    return profile
+
+# --- IMPORTI IN CENTESIMI ---
+# Gli importi sono memorizzati e sommati come centesimi interi (colonne *_cents):
+# i REAL storici restano per compatibilità e visualizzazione. Regola di
+# arrotondamento: ogni voce calcolata è arrotondata al centesimo con
+# ROUND_HALF_UP (0,005 -> 0,01; per i negativi simmetrico rispetto allo zero).
+MONEY_COLUMNS = ("importo_lordo", "imponibile_inps", "ritenuta_inps_totale", "quota_inps_utente",
+                 "importo_ritenuta_acconto", "rimborso_spese_esenti", "importo_bollo", "netto_a_pagare")
+
+def round_cents(value):
+    """Arrotonda un Decimal (espresso in centesimi) all'intero più vicino, ROUND_HALF_UP."""
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_cents(value):
+    """Importo in euro (float, str, Decimal, int) -> centesimi interi. None resta None."""
+    if value is None:
+        return None
+    # str(): usa la rappresentazione decimale più corta del float (12.345 -> "12.345")
+    return round_cents(Decimal(str(value)) * 100)
+
+def from_cents(cents):
+    """Centesimi interi -> euro (float con al più due decimali, per GUI, PDF e colonne REAL)."""
+    return None if cents is None else cents / 100
+
+# Tabella FTS5 alimentata da search_source: rowid = id * 4 + kind
+SEARCH_KINDS = {1: "ricevuta", 2: "cliente", 3: "incarico"}
+SEARCH_INDEX_SQL = """
+    CREATE VIRTUAL TABLE search_index USING fts5(
+        user_id UNINDEXED, titolo, codici, altro,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+"""
+_SEARCH_REINDEX = """
+    INSERT OR REPLACE INTO search_index (rowid, user_id, titolo, codici, altro)
+    SELECT id * 4 + kind, user_id, titolo, codici, altro FROM search_source
+"""
+SEARCH_TRIGGERS = {
+    "receipts": ("descrizione_prestazione, numero_progressivo, anno_riferimento, assignment_id, user_id", 1),
+    "clients": ("ragione_sociale, piva_cf, note, user_id", 2),
+    "assignments": ("descrizione_progetto, cig, rif_determina_incarico, nome_rup, user_id", 3),
+}
+
+
+def _create_search_index(conn):
+    """Crea search_index e i trigger che la tengono allineata.
+
+    Se SQLite è compilato senza FTS5 non fa nulla: DatabaseHandler.search
+    ripiega allora su una ricerca LIKE sulla vista search_source.
+    """
+    try:
+        conn.execute(SEARCH_INDEX_SQL)
+    except sqlite3.OperationalError:
+        return
+    for table, (columns, kind) in SEARCH_TRIGGERS.items():
+        reindex = f"{_SEARCH_REINDEX} WHERE kind = {kind} AND id = NEW.id;"
+        if table == "assignments":
+            # CIG e determina compaiono anche nel testo delle ricevute dell'incarico
+            reindex += (f"{_SEARCH_REINDEX} WHERE kind = 1 AND id IN "
+                        "(SELECT id FROM receipts WHERE assignment_id = NEW.id);")
+        conn.execute(f"CREATE TRIGGER trg_{table}_search_ins AFTER INSERT ON {table} "
+                     f"BEGIN {reindex} END")
+        conn.execute(f"CREATE TRIGGER trg_{table}_search_upd AFTER UPDATE OF {columns} ON {table} "
+                     f"BEGIN {reindex} END")
+        conn.execute(f"CREATE TRIGGER trg_{table}_search_del AFTER DELETE ON {table} "
+                     f"BEGIN DELETE FROM search_index WHERE rowid = OLD.id * 4 + {kind}; END")
+    conn.execute(_SEARCH_REINDEX)
+
+
+# Dati completi per stampare una ricevuta (vedi DatabaseHandler.get_render_contexts);
+# render_hash è l'impronta dei dati con cui è stato generato il PDF attuale
+RenderContext = namedtuple("RenderContext",
+                           "receipt_id profile client pdf_data filename is_credit_note render_hash render_status",
+                           defaults=(None,))
+
+
+def impronta_render(ctx):
+    """SHA-256 di tutto ciò che finisce nel PDF: profilo, cliente, incarico,
+    importi, versione del modello. Se non cambia, il PDF esistente è valido."""
+    dati = {"profile": ctx.profile, "client": ctx.client, "pdf_data": ctx.pdf_data,
+            "is_credit_note": ctx.is_credit_note}
+    testo = json.dumps(dati, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(testo.encode("utf-8")).hexdigest()
+
+
+def _backfill_cents(conn):
+    conn.create_function("to_cents", 1, to_cents, deterministic=True)
+    sets = ", ".join(f"{col}_cents = to_cents({col})" for col in MONEY_COLUMNS)
+    conn.execute(f"UPDATE receipts SET {sets}")
+
+
+DUPLICATE_NUMBERS_QUERY = """
+    SELECT user_id, anno_riferimento AS anno, numero_progressivo AS numero, COUNT(*) AS quante
+    FROM receipts GROUP BY user_id, anno_riferimento, numero_progressivo HAVING COUNT(*) > 1
+"""
+
+
+def _create_unique_numbering(conn):
+    """Vincolo UNIQUE sulla numerazione, se i dati esistenti lo permettono.
+
+    Numeri doppi già emessi non si possono correggere in automatico (sono
+    su documenti consegnati): in quel caso l'indice non viene creato e i
+    doppioni vengono ritornati. DatabaseHandler riprova a ogni avvio
+    (ensure_unique_numbering) finché non vengono risolti a mano.
+    """
+    duplicati = conn.execute(DUPLICATE_NUMBERS_QUERY).fetchall()
+    if duplicati:
+        return duplicati
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_numero_unico "
+                 "ON receipts(user_id, anno_riferimento, numero_progressivo)")
+    return []
+
+
+def descrivi_duplicati(duplicati):
+    """Elenco leggibile dei numeri doppi: "3/2025 (utente 1, 2 ricevute), ..."."""
+    return ", ".join(f"{d['numero']}/{d['anno']} (utente {d['user_id']}, {d['quante']} ricevute)"
+                     for d in duplicati)
+
+# Migrazioni dello schema: (versione, descrizione, passi). Ogni passo è
+# un'istruzione SQL oppure una funzione che riceve la connessione.
+# PRAGMA user_version memorizza l'ultima versione applicata al file:
+# le nuove migrazioni vanno SOLO aggiunte in coda, mai modificate.
+SCHEMA_MIGRATIONS = [
+    (1, "Indici secondari su ricevute, incarichi e clienti", [
+        # Copre get_annual_gross (SUM) e il MAX della numerazione
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_anno_num "
+        "ON receipts(user_id, anno_riferimento, numero_progressivo, importo_lordo)",
+        # Ordinamento dello storico in get_receipts / get_receipts_page
+        # (l'id e' la rowid, gia' presente in coda a ogni indice)
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_num_data "
+        "ON receipts(user_id, numero_progressivo, data_emissione)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_assignment ON receipts(assignment_id)",
+        "CREATE INDEX IF NOT EXISTS idx_assignments_user_data ON assignments(user_id, data_inizio)",
+        "CREATE INDEX IF NOT EXISTS idx_assignments_client ON assignments(client_id)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_user_ragione ON clients(user_id, ragione_sociale)",
+    ]),
+    (2, "Totali annui materializzati, aggiornati da trigger sulle ricevute", [
+        """
+        CREATE TABLE IF NOT EXISTS annual_totals (
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            totale_lordo REAL NOT NULL DEFAULT 0,
+            totale_imponibile_inps REAL NOT NULL DEFAULT 0,
+            totale_quota_inps REAL NOT NULL DEFAULT 0,
+            totale_irpef REAL NOT NULL DEFAULT 0,
+            totale_bollo REAL NOT NULL DEFAULT 0,
+            totale_netto REAL NOT NULL DEFAULT 0,
+            numero_ricevute INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, anno),
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_totals_ins AFTER INSERT ON receipts
+        BEGIN
+            INSERT INTO annual_totals (user_id, anno, totale_lordo, totale_imponibile_inps, totale_quota_inps,
+                                       totale_irpef, totale_bollo, totale_netto, numero_ricevute)
+            VALUES (NEW.user_id, NEW.anno_riferimento, IFNULL(NEW.importo_lordo, 0), IFNULL(NEW.imponibile_inps, 0),
+                    IFNULL(NEW.quota_inps_utente, 0), IFNULL(NEW.importo_ritenuta_acconto, 0),
+                    IFNULL(NEW.importo_bollo, 0), IFNULL(NEW.netto_a_pagare, 0), 1)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                totale_lordo = totale_lordo + excluded.totale_lordo,
+                totale_imponibile_inps = totale_imponibile_inps + excluded.totale_imponibile_inps,
+                totale_quota_inps = totale_quota_inps + excluded.totale_quota_inps,
+                totale_irpef = totale_irpef + excluded.totale_irpef,
+                totale_bollo = totale_bollo + excluded.totale_bollo,
+                totale_netto = totale_netto + excluded.totale_netto,
+                numero_ricevute = numero_ricevute + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_totals_del AFTER DELETE ON receipts
+        BEGIN
+            UPDATE annual_totals SET
+                totale_lordo = totale_lordo - IFNULL(OLD.importo_lordo, 0),
+                totale_imponibile_inps = totale_imponibile_inps - IFNULL(OLD.imponibile_inps, 0),
+                totale_quota_inps = totale_quota_inps - IFNULL(OLD.quota_inps_utente, 0),
+                totale_irpef = totale_irpef - IFNULL(OLD.importo_ritenuta_acconto, 0),
+                totale_bollo = totale_bollo - IFNULL(OLD.importo_bollo, 0),
+                totale_netto = totale_netto - IFNULL(OLD.netto_a_pagare, 0),
+                numero_ricevute = numero_ricevute - 1
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento;
+        END
+        """,
+        # Un UPDATE degli importi equivale a togliere la vecchia riga e aggiungere la nuova
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_totals_upd
+        AFTER UPDATE OF user_id, anno_riferimento, importo_lordo, imponibile_inps, quota_inps_utente,
+                        importo_ritenuta_acconto, importo_bollo, netto_a_pagare ON receipts
+        BEGIN
+            UPDATE annual_totals SET
+                totale_lordo = totale_lordo - IFNULL(OLD.importo_lordo, 0),
+                totale_imponibile_inps = totale_imponibile_inps - IFNULL(OLD.imponibile_inps, 0),
+                totale_quota_inps = totale_quota_inps - IFNULL(OLD.quota_inps_utente, 0),
+                totale_irpef = totale_irpef - IFNULL(OLD.importo_ritenuta_acconto, 0),
+                totale_bollo = totale_bollo - IFNULL(OLD.importo_bollo, 0),
+                totale_netto = totale_netto - IFNULL(OLD.netto_a_pagare, 0),
+                numero_ricevute = numero_ricevute - 1
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento;
+            INSERT INTO annual_totals (user_id, anno, totale_lordo, totale_imponibile_inps, totale_quota_inps,
+                                       totale_irpef, totale_bollo, totale_netto, numero_ricevute)
+            VALUES (NEW.user_id, NEW.anno_riferimento, IFNULL(NEW.importo_lordo, 0), IFNULL(NEW.imponibile_inps, 0),
+                    IFNULL(NEW.quota_inps_utente, 0), IFNULL(NEW.importo_ritenuta_acconto, 0),
+                    IFNULL(NEW.importo_bollo, 0), IFNULL(NEW.netto_a_pagare, 0), 1)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                totale_lordo = totale_lordo + excluded.totale_lordo,
+                totale_imponibile_inps = totale_imponibile_inps + excluded.totale_imponibile_inps,
+                totale_quota_inps = totale_quota_inps + excluded.totale_quota_inps,
+                totale_irpef = totale_irpef + excluded.totale_irpef,
+                totale_bollo = totale_bollo + excluded.totale_bollo,
+                totale_netto = totale_netto + excluded.totale_netto,
+                numero_ricevute = numero_ricevute + 1;
+        END
+        """,
+        # Popola i totali a partire dalle ricevute già presenti
+        """
+        INSERT OR REPLACE INTO annual_totals (user_id, anno, totale_lordo, totale_imponibile_inps, totale_quota_inps,
+                                              totale_irpef, totale_bollo, totale_netto, numero_ricevute)
+        SELECT user_id, anno_riferimento, TOTAL(importo_lordo), TOTAL(imponibile_inps), TOTAL(quota_inps_utente),
+               TOTAL(importo_ritenuta_acconto), TOTAL(importo_bollo), TOTAL(netto_a_pagare), COUNT(*)
+        FROM receipts GROUP BY user_id, anno_riferimento
+        """,
+    ]),
+    (3, "Importi in centesimi interi e totali annui su interi", [
+        "ALTER TABLE receipts ADD COLUMN importo_lordo_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN imponibile_inps_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN ritenuta_inps_totale_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN quota_inps_utente_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN importo_ritenuta_acconto_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN rimborso_spese_esenti_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN importo_bollo_cents INTEGER",
+        "ALTER TABLE receipts ADD COLUMN netto_a_pagare_cents INTEGER",
+        _backfill_cents,
+        "DROP TRIGGER IF EXISTS trg_receipts_totals_ins",
+        "DROP TRIGGER IF EXISTS trg_receipts_totals_del",
+        "DROP TRIGGER IF EXISTS trg_receipts_totals_upd",
+        "DROP TABLE IF EXISTS annual_totals",
+        """
+        CREATE TABLE annual_totals (
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            lordo_cents INTEGER NOT NULL DEFAULT 0,
+            imponibile_inps_cents INTEGER NOT NULL DEFAULT 0,
+            quota_inps_cents INTEGER NOT NULL DEFAULT 0,
+            irpef_cents INTEGER NOT NULL DEFAULT 0,
+            bollo_cents INTEGER NOT NULL DEFAULT 0,
+            netto_cents INTEGER NOT NULL DEFAULT 0,
+            numero_ricevute INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, anno),
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TRIGGER trg_receipts_totals_ins AFTER INSERT ON receipts
+        BEGIN
+            INSERT INTO annual_totals (user_id, anno, lordo_cents, imponibile_inps_cents, quota_inps_cents,
+                                       irpef_cents, bollo_cents, netto_cents, numero_ricevute)
+            VALUES (NEW.user_id, NEW.anno_riferimento, IFNULL(NEW.importo_lordo_cents, 0),
+                    IFNULL(NEW.imponibile_inps_cents, 0), IFNULL(NEW.quota_inps_utente_cents, 0),
+                    IFNULL(NEW.importo_ritenuta_acconto_cents, 0), IFNULL(NEW.importo_bollo_cents, 0),
+                    IFNULL(NEW.netto_a_pagare_cents, 0), 1)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                lordo_cents = lordo_cents + excluded.lordo_cents,
+                imponibile_inps_cents = imponibile_inps_cents + excluded.imponibile_inps_cents,
+                quota_inps_cents = quota_inps_cents + excluded.quota_inps_cents,
+                irpef_cents = irpef_cents + excluded.irpef_cents,
+                bollo_cents = bollo_cents + excluded.bollo_cents,
+                netto_cents = netto_cents + excluded.netto_cents,
+                numero_ricevute = numero_ricevute + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_receipts_totals_del AFTER DELETE ON receipts
+        BEGIN
+            UPDATE annual_totals SET
+                lordo_cents = lordo_cents - IFNULL(OLD.importo_lordo_cents, 0),
+                imponibile_inps_cents = imponibile_inps_cents - IFNULL(OLD.imponibile_inps_cents, 0),
+                quota_inps_cents = quota_inps_cents - IFNULL(OLD.quota_inps_utente_cents, 0),
+                irpef_cents = irpef_cents - IFNULL(OLD.importo_ritenuta_acconto_cents, 0),
+                bollo_cents = bollo_cents - IFNULL(OLD.importo_bollo_cents, 0),
+                netto_cents = netto_cents - IFNULL(OLD.netto_a_pagare_cents, 0),
+                numero_ricevute = numero_ricevute - 1
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_receipts_totals_upd
+        AFTER UPDATE OF user_id, anno_riferimento, importo_lordo_cents, imponibile_inps_cents, quota_inps_utente_cents,
+                        importo_ritenuta_acconto_cents, importo_bollo_cents, netto_a_pagare_cents ON receipts
+        BEGIN
+            UPDATE annual_totals SET
+                lordo_cents = lordo_cents - IFNULL(OLD.importo_lordo_cents, 0),
+                imponibile_inps_cents = imponibile_inps_cents - IFNULL(OLD.imponibile_inps_cents, 0),
+                quota_inps_cents = quota_inps_cents - IFNULL(OLD.quota_inps_utente_cents, 0),
+                irpef_cents = irpef_cents - IFNULL(OLD.importo_ritenuta_acconto_cents, 0),
+                bollo_cents = bollo_cents - IFNULL(OLD.importo_bollo_cents, 0),
+                netto_cents = netto_cents - IFNULL(OLD.netto_a_pagare_cents, 0),
+                numero_ricevute = numero_ricevute - 1
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento;
+            INSERT INTO annual_totals (user_id, anno, lordo_cents, imponibile_inps_cents, quota_inps_cents,
+                                       irpef_cents, bollo_cents, netto_cents, numero_ricevute)
+            VALUES (NEW.user_id, NEW.anno_riferimento, IFNULL(NEW.importo_lordo_cents, 0),
+                    IFNULL(NEW.imponibile_inps_cents, 0), IFNULL(NEW.quota_inps_utente_cents, 0),
+                    IFNULL(NEW.importo_ritenuta_acconto_cents, 0), IFNULL(NEW.importo_bollo_cents, 0),
+                    IFNULL(NEW.netto_a_pagare_cents, 0), 1)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                lordo_cents = lordo_cents + excluded.lordo_cents,
+                imponibile_inps_cents = imponibile_inps_cents + excluded.imponibile_inps_cents,
+                quota_inps_cents = quota_inps_cents + excluded.quota_inps_cents,
+                irpef_cents = irpef_cents + excluded.irpef_cents,
+                bollo_cents = bollo_cents + excluded.bollo_cents,
+                netto_cents = netto_cents + excluded.netto_cents,
+                numero_ricevute = numero_ricevute + 1;
+        END
+        """,
+        """
+        INSERT INTO annual_totals (user_id, anno, lordo_cents, imponibile_inps_cents, quota_inps_cents,
+                                   irpef_cents, bollo_cents, netto_cents, numero_ricevute)
+        SELECT user_id, anno_riferimento, IFNULL(SUM(importo_lordo_cents), 0), IFNULL(SUM(imponibile_inps_cents), 0),
+               IFNULL(SUM(quota_inps_utente_cents), 0), IFNULL(SUM(importo_ritenuta_acconto_cents), 0),
+               IFNULL(SUM(importo_bollo_cents), 0), IFNULL(SUM(netto_a_pagare_cents), 0), COUNT(*)
+        FROM receipts GROUP BY user_id, anno_riferimento
+        """,
+    ]),
+    (4, "Indice full-text (FTS5) su ricevute, clienti e incarichi", [
+        # Testo ricercabile di ogni elemento. kind: 1 ricevuta, 2 cliente, 3 incarico.
+        # Le ricevute ereditano CIG e determina dell'incarico, che stampano in PDF.
+        """
+        CREATE VIEW IF NOT EXISTS search_source AS
+        SELECT 1 AS kind, r.id, r.user_id, r.descrizione_prestazione AS titolo,
+               r.numero_progressivo || '/' || r.anno_riferimento || ' ' || IFNULL(a.cig, '')
+                   || ' ' || IFNULL(a.rif_determina_incarico, '') AS codici,
+               '' AS altro
+        FROM receipts r LEFT JOIN assignments a ON a.id = r.assignment_id
+        UNION ALL
+        SELECT 2, c.id, c.user_id, c.ragione_sociale, IFNULL(c.piva_cf, ''), IFNULL(c.note, '')
+        FROM clients c
+        UNION ALL
+        SELECT 3, a.id, a.user_id, a.descrizione_progetto,
+               IFNULL(a.cig, '') || ' ' || IFNULL(a.rif_determina_incarico, ''), IFNULL(a.nome_rup, '')
+        FROM assignments a
+        """,
+        _create_search_index,
+    ]),
+    (5, "Indici per ordinamenti e filtri delle liste", [
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_data ON receipts(user_id, data_emissione)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_lordo ON receipts(user_id, importo_lordo_cents)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_netto ON receipts(user_id, netto_a_pagare_cents)",
+        "CREATE INDEX IF NOT EXISTS idx_assignments_user_stato ON assignments(user_id, stato, data_inizio)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_user_piva ON clients(user_id, piva_cf)",
+    ]),
+    (6, "Sequenze di numerazione per utente/anno e numeri univoci", [
+        """
+        CREATE TABLE IF NOT EXISTS receipt_sequences (
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            ultimo_numero INTEGER NOT NULL,
+            PRIMARY KEY (user_id, anno)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO receipt_sequences (user_id, anno, ultimo_numero)
+        SELECT user_id, anno_riferimento, MAX(numero_progressivo)
+        FROM receipts GROUP BY user_id, anno_riferimento
+        """,
+        # Ogni numero inserito porta avanti la sequenza, da qualunque percorso arrivi
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_seq_ins AFTER INSERT ON receipts
+        BEGIN
+            INSERT INTO receipt_sequences (user_id, anno, ultimo_numero)
+            VALUES (NEW.user_id, NEW.anno_riferimento, NEW.numero_progressivo)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                ultimo_numero = MAX(ultimo_numero, excluded.ultimo_numero);
+        END
+        """,
+        # Cancellando l'ultima ricevuta il suo numero torna disponibile (come con MAX+1)
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_seq_del AFTER DELETE ON receipts
+        BEGIN
+            UPDATE receipt_sequences SET ultimo_numero = (
+                SELECT IFNULL(MAX(numero_progressivo), 0) FROM receipts
+                WHERE user_id = OLD.user_id AND anno_riferimento = OLD.anno_riferimento)
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento
+              AND ultimo_numero = OLD.numero_progressivo;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_seq_upd
+        AFTER UPDATE OF user_id, anno_riferimento, numero_progressivo ON receipts
+        BEGIN
+            UPDATE receipt_sequences SET ultimo_numero = (
+                SELECT IFNULL(MAX(numero_progressivo), 0) FROM receipts
+                WHERE user_id = OLD.user_id AND anno_riferimento = OLD.anno_riferimento)
+            WHERE user_id = OLD.user_id AND anno = OLD.anno_riferimento;
+            INSERT INTO receipt_sequences (user_id, anno, ultimo_numero)
+            VALUES (NEW.user_id, NEW.anno_riferimento, NEW.numero_progressivo)
+            ON CONFLICT(user_id, anno) DO UPDATE SET
+                ultimo_numero = MAX(ultimo_numero, excluded.ultimo_numero);
+        END
+        """,
+        _create_unique_numbering,
+    ]),
+    (7, "Stato del rendering PDF delle ricevute", [
+        # Le ricevute esistenti hanno già il loro PDF; le nuove nascono 'pending'
+        "ALTER TABLE receipts ADD COLUMN render_status TEXT NOT NULL DEFAULT 'rendered'",
+        "ALTER TABLE receipts ADD COLUMN render_error TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_render_pending "
+        "ON receipts(user_id) WHERE render_status <> 'rendered'",
+    ]),
+    (8, "Versione del modello PDF con cui è stata emessa ogni ricevuta", [
+        "ALTER TABLE receipts ADD COLUMN template_version INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (9, "Impronta dei dati di stampa dei PDF", [
+        # NULL = impronta sconosciuta: il PDF viene rigenerato alla prima occasione
+        "ALTER TABLE receipts ADD COLUMN render_hash TEXT",
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# --- LOG DELLE QUERY LENTE ---
+SLOW_SQL_FILE = "rpo_zero_slow_sql.log"
+
+class SlowQueryLog:
+    """Registra in un log a rotazione le istruzioni SQL più lente di una soglia.
+
+    Attivo con --slow-sql [MS] o RPO_ZERO_SLOW_SQL_MS: le connessioni aperte
+    da ConnectionPool usano allora ConnessioneTracciata, che misura ogni
+    istruzione (fetch delle righe compresi), qualunque sia il chiamante,
+    anche il codice che usa direttamente db._get_connection(). Per ogni
+    istruzione lenta vengono scritti il tempo, le righe lette, la forma dei
+    parametri (solo i tipi: i valori possono contenere dati personali) e
+    il piano di EXPLAIN QUERY PLAN.
+    """
+    PIANI_MAX = 256
+
     def __init__(self):
-        self.db_name = DB_NAME
-        self.init_db()  # Inizializza le tabelle al primo avvio
+        self.attivo = False
+        self.soglia = 0.0
+        self.logger = logging.getLogger("rpo_zero.slow_sql")
+        self._piani = {}
+
+    def configura(self, soglia_ms, path=SLOW_SQL_FILE, max_bytes=1_000_000, backup=3):
+        """Attiva il log per le connessioni aperte da qui in poi."""
+        self.soglia = float(soglia_ms) / 1000
+        if not self.attivo:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup,
+                                                           encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+        self.attivo = True
+
+    @staticmethod
+    def forma_parametri(params, molti=None):
+        """Tipi dei parametri senza i valori: (int, str, NULL) o {nome: str}."""
+        def tipo(v):
+            return "NULL" if v is None else type(v).__name__
+        if isinstance(params, dict):
+            forma = "{" + ", ".join(f"{k}: {tipo(v)}" for k, v in params.items()) + "}"
+        else:
+            # Le sequenze dello stesso tipo (liste IN (...)) diventano int×500
+            gruppi = []
+            for v in params:
+                if gruppi and gruppi[-1][0] == tipo(v):
+                    gruppi[-1][1] += 1
+                else:
+                    gruppi.append([tipo(v), 1])
+            parti = []
+            for t, n in gruppi:
+                parti += [t] * n if n < 4 else [f"{t}×{n}"]
+            forma = "(" + ", ".join(parti) + ")"
+        return f"{molti} × {forma}" if molti is not None else forma
+
+    @staticmethod
+    def testo(sql):
+        """SQL su una riga, con le liste lunghe di segnaposto compattate (IN (?×500))."""
+        sql = " ".join(sql.split())
+        return re.sub(r"\?(?:\s*,\s*\?){3,}", lambda m: f"?×{m.group(0).count('?')}", sql)
+
+    def piano(self, conn, sql, params):
+        """EXPLAIN QUERY PLAN come righe indentate (memorizzato per testo SQL)."""
+        if sql in self._piani:
+            return self._piani[sql]
+        try:
+            # Cursore normale: l'EXPLAIN non deve essere a sua volta misurato
+            cur = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+            livelli, righe = {0: -1}, []
+            for id_, parent, _, dettaglio in cur.execute("EXPLAIN QUERY PLAN " + sql, params):
+                livelli[id_] = livelli.get(parent, -1) + 1
+                righe.append("  " * livelli[id_] + dettaglio)
+        except sqlite3.Error as e:
+            righe = [f"(piano non disponibile: {e})"]
+        if len(self._piani) >= self.PIANI_MAX:
+            self._piani.clear()
+        self._piani[sql] = righe
+        return righe
+
+    @staticmethod
+    def con_piano(sql):
+        """True per le istruzioni di cui ha senso chiedere EXPLAIN QUERY PLAN."""
+        testa = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        return testa in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def registra(self, sql, params, secondi, righe=None, molti=None, piano=None, errore=None):
+        """Scrive l'istruzione nel log se supera la soglia.
+
+        Non usa la connessione: il piano, se serve, è già stato letto dal
+        thread che possiede la connessione (vedi CursoreTracciato).
+        """
+        if secondi < self.soglia:
+            return
+        linee = [f"[{secondi * 1000:.1f} ms" + (f", {righe} righe" if righe is not None else "")
+                 + (", FALLITA" if errore is not None else "") + "] " + self.testo(sql),
+                 f"    parametri: {self.forma_parametri(params, molti)}"]
+        if errore is not None:
+            linee.append(f"    errore: {errore}")
+        linee += ["    piano: " + r for r in piano or ()]
+        self.logger.info("\n".join(linee))
+
+SLOW_SQL = SlowQueryLog()
+
+
+class CursoreTracciato(sqlite3.Cursor):
+    """Cursore che misura ogni istruzione per SLOW_SQL.
+
+    Il tempo comprende execute() e le letture successive (fetch* o
+    iterazione) fino a quando il cursore viene esaurito, riusato o chiuso.
+    Il piano viene letto appena l'istruzione supera la soglia, sul thread
+    che la esegue: le connessioni del pool sono per thread, e __del__ (che
+    può girare sul thread del garbage collector) si limita a scrivere il log.
+    Le istruzioni che sollevano un'eccezione sono registrate come FALLITA,
+    senza piano.
+    """
+    _misura = None  # [sql, parametri, secondi, righe lette, piano]
+
+    def _controlla_soglia(self):
+        misura = self._misura
+        if misura[4] is None and misura[2] >= SLOW_SQL.soglia and SLOW_SQL.con_piano(misura[0]):
+            misura[4] = SLOW_SQL.piano(self.connection, misura[0], misura[1])
+
+    def _chiudi_misura(self, errore=None):
+        misura, self._misura = self._misura, None
+        if misura:
+            SLOW_SQL.registra(misura[0], misura[1], misura[2], misura[3],
+                              piano=misura[4] if errore is None else None, errore=errore)
+
+    def execute(self, sql, params=()):
+        self._chiudi_misura()
+        t0 = time.perf_counter()
+        try:
+            risultato = super().execute(sql, params)
+        except Exception as e:
+            SLOW_SQL.registra(sql, params, time.perf_counter() - t0, errore=e)
+            raise
+        self._misura = [sql, params, time.perf_counter() - t0, 0, None]
+        self._controlla_soglia()
+        return risultato
+
+    def executemany(self, sql, seq_of_params):
+        self._chiudi_misura()
+        seq_of_params = list(seq_of_params)
+        primi = seq_of_params[0] if seq_of_params else ()
+        t0 = time.perf_counter()
+        try:
+            risultato = super().executemany(sql, seq_of_params)
+        except Exception as e:
+            SLOW_SQL.registra(sql, primi, time.perf_counter() - t0, molti=len(seq_of_params), errore=e)
+            raise
+        SLOW_SQL.registra(sql, primi, time.perf_counter() - t0, molti=len(seq_of_params))
+        return risultato
 
-    def _get_connection(self):
-        conn = sqlite3.connect(self.db_name)
+    def _leggi(self, fetch, *args):
+        t0 = time.perf_counter()
+        try:
+            risultato = fetch(*args)
+        except Exception as e:
+            if self._misura:
+                self._misura[2] += time.perf_counter() - t0
+                self._chiudi_misura(errore=e)
+            raise
+        misura = self._misura
+        if misura:
+            misura[2] += time.perf_counter() - t0
+            if isinstance(risultato, list):
+                misura[3] += len(risultato)
+            elif risultato is not None:
+                misura[3] += 1
+            self._controlla_soglia()
+            if not risultato or fetch == super().fetchall:
+                self._chiudi_misura()
+        return risultato
+
+    def fetchone(self):
+        return self._leggi(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._leggi(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._leggi(super().fetchall)
+
+    def __next__(self):
+        riga = self._leggi(super().fetchone)
+        if riga is None:
+            raise StopIteration
+        return riga
+
+    def close(self):
+        self._chiudi_misura()
+        super().close()
+
+    def __del__(self):
+        # Solo scrittura del log: nessun accesso alla connessione da qui
+        try:
+            self._chiudi_misura()
+        except Exception:
+            pass
+
+
+class ConnessioneTracciata(sqlite3.Connection):
+    """Connessione i cui cursori (anche quelli impliciti di execute) sono CursoreTracciato."""
+    def cursor(self, factory=CursoreTracciato):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+class ConnectionPool:
+    """Mantiene una connessione SQLite persistente per ogni thread.
+
+    Aprire il file (specie su disco di rete) costa parecchio: la connessione
+    viene creata una sola volta per thread, configurata con i PRAGMA e poi
+    riusata da tutte le query fino a close_all().
+    """
+
+    def __init__(self, db_name, pragmas=None, timeout=5.0):
+        self.db_name = db_name
+        self.pragmas = pragmas if pragmas is not None else {"foreign_keys": "ON"}
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0
+
+    def connection(self):
+        """Ritorna la connessione del thread corrente, creandola se serve."""
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            local.conn = self._connect()
+            local.generation = self._generation
+            local.depth = 0
+            local.after_commit = []
+        return local.conn
+
+    def _connect(self):
+        # isolation_level=None: le transazioni sono aperte esplicitamente da transaction()
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout,
+                               isolation_level=None, check_same_thread=False,
+                               factory=ConnessioneTracciata if SLOW_SQL.attivo else sqlite3.Connection)
         conn.row_factory = sqlite3.Row
-        # Abilita vincoli foreign keys
-        conn.execute("PRAGMA foreign_keys = ON") 
+        for name, value in self.pragmas.items():
+            try:
+                conn.execute(f"PRAGMA {name} = {value}")
+            except sqlite3.OperationalError:
+                # es. journal_mode non modificabile mentre un altro processo scrive:
+                # la connessione resta valida con l'impostazione corrente del file
+                pass
+        with self._lock:
+            self._connections.append(conn)
         return conn
 
+    @contextmanager
+    def transaction(self, mode="DEFERRED"):
+        """Blocco transazionale: COMMIT all'uscita, ROLLBACK in caso di eccezione.
+
+        Le chiamate annidate usano un SAVEPOINT, così un metodo del
+        DatabaseHandler può essere richiamato dentro una transazione più ampia.
+        """
+        conn = self.connection()
+        local = self._local
+        depth = local.depth
+        pending = len(local.after_commit)
+        savepoint = f"sp_{depth}"
+        if depth == 0:
+            # Con il database condiviso BEGIN IMMEDIATE può attendere il lock di altri processi
+            with TRACCIA.span(f"BEGIN {mode}"):
+                conn.execute(f"BEGIN {mode}")
+        else:
+            conn.execute(f"SAVEPOINT {savepoint}")
+        local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            # Le azioni registrate dentro il blocco annullato vengono scartate
+            del local.after_commit[pending:]
+            if depth == 0:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            else:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+            raise
+        else:
+            if depth == 0:
+                with TRACCIA.span("COMMIT"):
+                    conn.execute("COMMIT")
+            else:
+                conn.execute(f"RELEASE {savepoint}")
+        finally:
+            local.depth = depth
+        if depth == 0:
+            self._run_after_commit()
+
+    def after_commit(self, fn, *args):
+        """Esegue fn(*args) dopo il COMMIT della transazione più esterna del thread.
+
+        Fuori da una transazione fn viene eseguita subito; se la transazione
+        viene annullata fn non viene mai eseguita.
+        """
+        self.connection()
+        self._local.after_commit.append((fn, args))
+        if self._local.depth == 0:
+            self._run_after_commit()
+
+    def _run_after_commit(self):
+        actions, self._local.after_commit = self._local.after_commit, []
+        for fn, args in actions:
+            fn(*args)
+
+    def checkpoint(self):
+        """Riversa il WAL nel file principale e lo tronca (no-op fuori da WAL)."""
+        if not self._connections:
+            return
+        try:
+            self.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        except sqlite3.Error:
+            pass  # un altro processo sta leggendo: il checkpoint avverrà più tardi
+
+    def close_all(self):
+        """Chiude tutte le connessioni aperte (da chiamare in chiusura applicazione)."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+class DatabaseHandler:
+    def __init__(self, storage_profile=None):
+        self.db_name = DB_NAME
+        self.storage_profile = load_storage_profile(storage_profile, db_path=self.db_name)
+        self.pool = ConnectionPool(self.db_name, self.storage_profile)
+        # Lo schema viene preparato al primo accesso, non all'import del modulo
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        # Numeri doppi che impediscono il vincolo UNIQUE (vedi ensure_unique_numbering)
+        self.duplicate_numbers = []
+        self._subscribers = []
+        atexit.register(self.close)
+
+    def _ensure_schema(self):
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if not self._schema_ready:
+                self.init_db()  # Inizializza le tabelle al primo avvio
+                self.ensure_unique_numbering()
+                self._schema_ready = True
+
+    def _get_connection(self):
+        # Connessione persistente del thread corrente: NON va chiusa dal chiamante
+        self._ensure_schema()
+        return self.pool.connection()
+
+    def transaction(self, mode="DEFERRED"):
+        """Context manager per eseguire più istruzioni in un'unica transazione."""
+        self._ensure_schema()
+        return self.pool.transaction(mode)
+
+    def close(self):
+        self.pool.checkpoint()
+        self.pool.close_all()
+
+    # --- NOTIFICHE DI MODIFICA ---
+    def subscribe(self, callback):
+        """Registra callback(tabella, operazione, id), chiamata dopo ogni commit.
+
+        operazione è "insert", "update" o "delete". La callback gira nel
+        thread che ha eseguito la scrittura: chi aggiorna widget deve
+        rimandarla al thread della GUI.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def data_version(self):
+        """PRAGMA data_version della connessione del thread corrente.
+
+        Cambia quando un'altra connessione (altro thread, altro processo, la
+        riga di comando) fa COMMIT sul file: serve a scoprire le modifiche
+        che non passano dalle notifiche di subscribe().
+        """
+        return self._get_connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def _changed(self, table, op, row_id):
+        # Da chiamare dentro la transazione: la notifica parte solo a COMMIT avvenuto
+        if self._subscribers:
+            self.pool.after_commit(self._notify, table, op, row_id)
+
+    def _notify(self, table, op, row_id):
+        for callback in list(self._subscribers):
+            callback(table, op, row_id)
+
     def init_db(self):
-        """Crea la struttura del database se non esiste (Multi-utente)."""
-        conn = self._get_connection()
+        """Crea la struttura del database se non esiste (Multi-utente).
+
+        Se il file è già all'ultima versione di schema non esegue nulla:
+        basta leggere PRAGMA user_version.
+        """
+        conn = self.pool.connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
         cur = conn.cursor()
         
         # 1. Tabella Utenti (Login)
@@ -137,92 +1049,92 @@ class DatabaseHandler:
             FOREIGN KEY(assignment_id) REFERENCES assignments(id)
         )
         """)
-        
-        conn.commit()
-        conn.close()
+
+        self.migrate()
+
+    def migrate(self):
+        """Porta il file all'ultima versione di SCHEMA_MIGRATIONS (aggiornamento in place)."""
+        conn = self.pool.connection()
+        for version, _descr, steps in SCHEMA_MIGRATIONS:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            # IMMEDIATE: se due istanze partono insieme, una sola applica la migrazione
+            with self.pool.transaction("IMMEDIATE"):
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
 
     # --- AUTENTICAZIONE ---
     def register_user(self, username, password, display_name):
-        conn = self._get_connection()
-        cur = conn.cursor()
         pwd_hash = hashlib.sha256(password.encode()).hexdigest()
         try:
-            cur.execute("INSERT INTO users (username, password_hash, display_name) VALUES (?, ?, ?)", 
-                        (username, pwd_hash, display_name))
-            conn.commit()
+            with self.transaction() as conn:
+                conn.execute("INSERT INTO users (username, password_hash, display_name) VALUES (?, ?, ?)", 
+                             (username, pwd_hash, display_name))
             return True
         except sqlite3.IntegrityError:
             return False # Username già in uso
-        finally:
-            conn.close()
 
     def login_user(self, username, password):
         conn = self._get_connection()
         cur = conn.cursor()
         pwd_hash = hashlib.sha256(password.encode()).hexdigest()
         cur.execute("SELECT id, display_name FROM users WHERE username=? AND password_hash=?", (username, pwd_hash))
-        result = cur.fetchone()
-        conn.close()
-        return result # Ritorna tuple (id, display_name) o None
+        return cur.fetchone() # Ritorna tuple (id, display_name) o None
 
     # --- GESTIONE PROFILO UTENTE ---
     def get_user_profile(self, user_id):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM user_profile WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return cursor.fetchone()
 
     def save_user_profile(self, user_id, nome, cf, indirizzo, iban, email, telefono):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM user_profile WHERE user_id = ?", (user_id,))
-        exists = cursor.fetchone()
-        
-        if exists:
-            query = """UPDATE user_profile SET 
-                       nome_completo=?, codice_fiscale=?, indirizzo=?, iban=?, email=?, telefono=? 
-                       WHERE user_id=?"""
-            cursor.execute(query, (nome, cf, indirizzo, iban, email, telefono, user_id))
-        else:
-            query = """INSERT INTO user_profile 
-                       (user_id, nome_completo, codice_fiscale, indirizzo, iban, email, telefono) 
-                       VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            cursor.execute(query, (user_id, nome, cf, indirizzo, iban, email, telefono))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT id FROM user_profile WHERE user_id = ?", (user_id,))
+            exists = cursor.fetchone()
+            
+            if exists:
+                query = """UPDATE user_profile SET 
+                           nome_completo=?, codice_fiscale=?, indirizzo=?, iban=?, email=?, telefono=? 
+                           WHERE user_id=?"""
+                cursor.execute(query, (nome, cf, indirizzo, iban, email, telefono, user_id))
+            else:
+                query = """INSERT INTO user_profile 
+                           (user_id, nome_completo, codice_fiscale, indirizzo, iban, email, telefono) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?)"""
+                cursor.execute(query, (user_id, nome, cf, indirizzo, iban, email, telefono))
 
     # --- CONFIGURAZIONE FISCALE ---
     def ensure_fiscal_config_exists(self, user_id, anno):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT anno FROM fiscal_config WHERE user_id = ? AND anno = ?", (user_id, anno))
-        exists = cursor.fetchone()
-        
-        if not exists:
-            query = """
-                INSERT INTO fiscal_config 
-                (user_id, anno, soglia_inps_no_tax, aliquota_gestione_separata, quota_carico_utente, soglia_bollo, valore_bollo)
-                VALUES (?, ?, 5000.00, 24.00, 0.33333333, 77.47, 2.00)
-            """
-            cursor.execute(query, (user_id, anno))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT anno FROM fiscal_config WHERE user_id = ? AND anno = ?", (user_id, anno))
+            exists = cursor.fetchone()
+            
+            if not exists:
+                query = """
+                    INSERT INTO fiscal_config 
+                    (user_id, anno, soglia_inps_no_tax, aliquota_gestione_separata, quota_carico_utente, soglia_bollo, valore_bollo)
+                    VALUES (?, ?, 5000.00, 24.00, 0.33333333, 77.47, 2.00)
+                """
+                cursor.execute(query, (user_id, anno))
 
     def get_fiscal_config(self, user_id, anno):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM fiscal_config WHERE user_id = ? AND anno = ?", (user_id, anno))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return cursor.fetchone()
 
     def save_fiscal_config(self, user_id, anno, soglia, aliquota, quota, s_bollo, v_bollo):
-        conn = self._get_connection()
-        cursor = conn.cursor()
         query = """
             INSERT INTO fiscal_config 
             (user_id, anno, soglia_inps_no_tax, aliquota_gestione_separata, quota_carico_utente, soglia_bollo, valore_bollo)
@@ -234,49 +1146,55 @@ class DatabaseHandler:
             soglia_bollo=excluded.soglia_bollo,
             valore_bollo=excluded.valore_bollo
         """
-        cursor.execute(query, (user_id, anno, soglia, aliquota, quota, s_bollo, v_bollo))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute(query, (user_id, anno, soglia, aliquota, quota, s_bollo, v_bollo))
     
     # --- GESTIONE CLIENTI ---
     def get_clients(self, user_id):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM clients WHERE user_id = ? ORDER BY ragione_sociale ASC", (user_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return cursor.fetchall()
+
+    # Ordinamenti ammessi per la lista clienti: colonna della vista -> colonna SQL
+    CLIENT_SORTS = {"ragione": "ragione_sociale", "piva": "piva_cf", "indirizzo": "indirizzo"}
+
+    def get_clients_list(self, user_id, sort="ragione", desc=False):
+        """Clienti ordinati lato SQL su una colonna di CLIENT_SORTS."""
+        verso = "DESC" if desc else "ASC"
+        query = f"SELECT * FROM clients WHERE user_id = ? ORDER BY {self.CLIENT_SORTS[sort]} {verso}, id {verso}"
+        return self._get_connection().execute(query, (user_id,)).fetchall()
 
     def get_client_by_id(self, client_id):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return cursor.fetchone()
 
     def save_client(self, user_id, client_id, ragione_sociale, piva_cf, indirizzo, email, sostituto, note):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        if client_id:
-            query = """UPDATE clients SET 
-                       ragione_sociale=?, piva_cf=?, indirizzo=?, email_amministrazione=?, sostituto_imposta=?, note=? 
-                       WHERE id=? AND user_id=?"""
-            cursor.execute(query, (ragione_sociale, piva_cf, indirizzo, email, sostituto, note, client_id, user_id))
-        else:
-            query = """INSERT INTO clients 
-                       (user_id, ragione_sociale, piva_cf, indirizzo, email_amministrazione, sostituto_imposta, note) 
-                       VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            cursor.execute(query, (user_id, ragione_sociale, piva_cf, indirizzo, email, sostituto, note))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                query = """UPDATE clients SET 
+                           ragione_sociale=?, piva_cf=?, indirizzo=?, email_amministrazione=?, sostituto_imposta=?, note=? 
+                           WHERE id=? AND user_id=?"""
+                cursor.execute(query, (ragione_sociale, piva_cf, indirizzo, email, sostituto, note, client_id, user_id))
+                self._changed("clients", "update", int(client_id))
+            else:
+                query = """INSERT INTO clients 
+                           (user_id, ragione_sociale, piva_cf, indirizzo, email_amministrazione, sostituto_imposta, note) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?)"""
+                cursor.execute(query, (user_id, ragione_sociale, piva_cf, indirizzo, email, sostituto, note))
+                self._changed("clients", "insert", cursor.lastrowid)
 
     def delete_client(self, client_id):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM clients WHERE id = ?", (client_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            # Gli incarichi del cliente vengono cancellati in cascata
+            cascata = conn.execute("SELECT id FROM assignments WHERE client_id = ?", (client_id,)).fetchall()
+            conn.execute("DELETE FROM clients WHERE id = ?", (client_id,))
+            for row in cascata:
+                self._changed("assignments", "delete", row['id'])
+            self._changed("clients", "delete", int(client_id))
 
     # --- GESTIONE INCARICHI ---
     def get_assignments(self, user_id):
@@ -288,50 +1206,118 @@ class DatabaseHandler:
                    WHERE a.user_id = ? 
                    ORDER BY a.data_inizio DESC"""
         cursor.execute(query, (user_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return cursor.fetchall()
 
     def get_assignment_by_id(self, assign_id):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM assignments WHERE id = ?", (assign_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return cursor.fetchone()
+
+    # Ordinamenti e filtri ammessi per la lista incarichi
+    ASSIGNMENT_SORTS = {"cliente": "c.ragione_sociale", "progetto": "a.descrizione_progetto",
+                        "data": "a.data_inizio", "stato": "a.stato"}
+    ASSIGNMENT_FILTERS = {"client_id": "a.client_id = ?", "stato": "a.stato = ?"}
+
+    def get_assignments_list(self, user_id, sort="data", desc=True, filtri=None):
+        """Incarichi ordinati e filtrati lato SQL (chiavi di ASSIGNMENT_SORTS/ASSIGNMENT_FILTERS)."""
+        filtro, params = self._filter_sql(self.ASSIGNMENT_FILTERS, filtri)
+        verso = "DESC" if desc else "ASC"
+        query = f"""SELECT a.*, c.ragione_sociale 
+                   FROM assignments a 
+                   JOIN clients c ON a.client_id = c.id 
+                   WHERE a.user_id = ? {filtro}
+                   ORDER BY {self.ASSIGNMENT_SORTS[sort]} {verso}, a.id {verso}"""
+        return self._get_connection().execute(query, (user_id, *params)).fetchall()
+
+    def get_assignment_row(self, assign_id, filtri=None):
+        """Una sola riga nel formato di get_assignments (per aggiornare la lista).
+
+        Con filtri ritorna None se l'incarico non li soddisfa.
+        """
+        filtro, params = self._filter_sql(self.ASSIGNMENT_FILTERS, filtri)
+        query = f"""SELECT a.*, c.ragione_sociale 
+                   FROM assignments a 
+                   JOIN clients c ON a.client_id = c.id 
+                   WHERE a.id = ? {filtro}"""
+        return self._get_connection().execute(query, (assign_id, *params)).fetchone()
 
     def save_assignment(self, user_id, assign_id, client_id, descrizione, data_inizio, rif_det, data_det, rup, email_rup, cig, stato):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        if assign_id:
-            query = """UPDATE assignments SET 
-                       client_id=?, descrizione_progetto=?, data_inizio=?, rif_determina_incarico=?, 
-                       data_determina=?, nome_rup=?, email_rup=?, cig=?, stato=? 
-                       WHERE id=? AND user_id=?"""
-            cursor.execute(query, (client_id, descrizione, data_inizio, rif_det, data_det, rup, email_rup, cig, stato, assign_id, user_id))
-        else:
-            query = """INSERT INTO assignments 
-                       (user_id, client_id, descrizione_progetto, data_inizio, rif_determina_incarico, data_determina, nome_rup, email_rup, cig, stato) 
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-            cursor.execute(query, (user_id, client_id, descrizione, data_inizio, rif_det, data_det, rup, email_rup, cig, stato))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            if assign_id:
+                query = """UPDATE assignments SET 
+                           client_id=?, descrizione_progetto=?, data_inizio=?, rif_determina_incarico=?, 
+                           data_determina=?, nome_rup=?, email_rup=?, cig=?, stato=? 
+                           WHERE id=? AND user_id=?"""
+                cursor.execute(query, (client_id, descrizione, data_inizio, rif_det, data_det, rup, email_rup, cig, stato, assign_id, user_id))
+                self._changed("assignments", "update", int(assign_id))
+            else:
+                query = """INSERT INTO assignments 
+                           (user_id, client_id, descrizione_progetto, data_inizio, rif_determina_incarico, data_determina, nome_rup, email_rup, cig, stato) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+                cursor.execute(query, (user_id, client_id, descrizione, data_inizio, rif_det, data_det, rup, email_rup, cig, stato))
+                self._changed("assignments", "insert", cursor.lastrowid)
 
     def delete_assignment(self, assign_id):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM assignments WHERE id = ?", (assign_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM assignments WHERE id = ?", (assign_id,))
+            self._changed("assignments", "delete", int(assign_id))
 
     # --- GESTIONE RICEVUTE ---
+    # Query di riferimento per i totali annui, calcolati direttamente dalle ricevute (interi)
+    ANNUAL_TOTALS_QUERY = """
+        SELECT user_id, anno_riferimento AS anno,
+               IFNULL(SUM(importo_lordo_cents), 0) AS lordo_cents,
+               IFNULL(SUM(imponibile_inps_cents), 0) AS imponibile_inps_cents,
+               IFNULL(SUM(quota_inps_utente_cents), 0) AS quota_inps_cents,
+               IFNULL(SUM(importo_ritenuta_acconto_cents), 0) AS irpef_cents,
+               IFNULL(SUM(importo_bollo_cents), 0) AS bollo_cents,
+               IFNULL(SUM(netto_a_pagare_cents), 0) AS netto_cents,
+               COUNT(*) AS numero_ricevute
+        FROM receipts GROUP BY user_id, anno_riferimento
+    """
+    ANNUAL_TOTALS_FIELDS = ["lordo_cents", "imponibile_inps_cents", "quota_inps_cents", "irpef_cents",
+                            "bollo_cents", "netto_cents", "numero_ricevute"]
+
     def get_annual_gross(self, user_id, year):
+        return from_cents(self.get_annual_gross_cents(user_id, year))
+
+    def get_annual_gross_cents(self, user_id, year):
+        totals = self.get_annual_totals(user_id, year)
+        return totals['lordo_cents'] if totals else 0
+
+    def get_annual_totals(self, user_id, year):
+        """Totali dell'anno (in centesimi) dalla tabella materializzata: una sola lettura per chiave primaria."""
         conn = self._get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT SUM(importo_lordo) FROM receipts WHERE user_id = ? AND anno_riferimento = ?", (user_id, year))
-        result = cursor.fetchone()[0]
-        conn.close()
-        return result if result else 0.00
+        cursor.execute("SELECT * FROM annual_totals WHERE user_id = ? AND anno = ?", (user_id, year))
+        return cursor.fetchone()
+
+    def verify_annual_totals(self):
+        """Confronta annual_totals con le ricevute. Ritorna le differenze come
+        lista di tuple (user_id, anno, campo, valore_atteso, valore_memorizzato)."""
+        conn = self._get_connection()
+        expected = {(r['user_id'], r['anno']): r for r in conn.execute(self.ANNUAL_TOTALS_QUERY)}
+        stored = {(r['user_id'], r['anno']): r for r in conn.execute("SELECT * FROM annual_totals")}
+        diffs = []
+        for key in sorted(set(expected) | set(stored)):
+            exp, sto = expected.get(key), stored.get(key)
+            for field in self.ANNUAL_TOTALS_FIELDS:
+                exp_val = exp[field] if exp else 0
+                sto_val = sto[field] if sto else 0
+                if exp_val != sto_val:
+                    diffs.append((key[0], key[1], field, exp_val, sto_val))
+        return diffs
+
+    def rebuild_annual_totals(self):
+        """Ricalcola da zero la tabella annual_totals."""
+        with self.transaction("IMMEDIATE") as conn:
+            conn.execute("DELETE FROM annual_totals")
+            conn.execute(f"""
+                INSERT INTO annual_totals (user_id, anno, {", ".join(self.ANNUAL_TOTALS_FIELDS)})
+                {self.ANNUAL_TOTALS_QUERY}
+            """)
 
     def get_receipts(self, user_id):
         conn = self._get_connection()
@@ -345,47 +1331,259 @@ class DatabaseHandler:
             ORDER BY r.numero_progressivo DESC, r.data_emissione DESC
         """
         cursor.execute(query, (user_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return cursor.fetchall()
+
+    RECEIPTS_PAGE_SQL = """
+        SELECT r.*, a.client_id, c.ragione_sociale
+        FROM receipts r
+        JOIN assignments a ON r.assignment_id = a.id
+        JOIN clients c ON a.client_id = c.id
+        WHERE r.user_id = ? {filtro}
+        ORDER BY {ordine}
+        LIMIT ?
+    """
+    # Ordinamenti ammessi per lo storico: colonna della vista -> colonne SQL.
+    # L'id chiude sempre la chiave, cosi' la paginazione keyset e' univoca.
+    RECEIPT_SORTS = {
+        "num": ("r.numero_progressivo", "r.data_emissione"),
+        "data": ("r.data_emissione",),
+        "cliente": ("c.ragione_sociale",),
+        "lordo": ("r.importo_lordo_cents",),
+        "netto": ("r.netto_a_pagare_cents",),
+    }
+    # Filtri ammessi: nome -> condizione SQL con un solo parametro
+    RECEIPT_FILTERS = {
+        "anno": "r.anno_riferimento = ?",
+        "client_id": "a.client_id = ?",
+        "min_cents": "r.importo_lordo_cents >= ?",
+        "max_cents": "r.importo_lordo_cents <= ?",
+    }
+
+    @classmethod
+    def _filter_sql(cls, allowed, filtri):
+        """Traduce i filtri valorizzati in condizioni AND parametrizzate."""
+        clauses, params = [], []
+        for name, value in (filtri or {}).items():
+            if value is None:
+                continue
+            clauses.append(f"AND {allowed[name]}")
+            params.append(value)
+        return " ".join(clauses), params
+
+    def get_receipt_row(self, receipt_id, filtri=None):
+        """Una sola riga nel formato di get_receipts_page (per aggiornare lo storico).
+
+        Con filtri ritorna None se la ricevuta non li soddisfa.
+        """
+        filtro, params = self._filter_sql(self.RECEIPT_FILTERS, filtri)
+        query = """
+            SELECT r.*, a.client_id, c.ragione_sociale
+            FROM receipts r
+            JOIN assignments a ON r.assignment_id = a.id
+            JOIN clients c ON a.client_id = c.id
+            WHERE r.id = ? 
+        """ + filtro
+        return self._get_connection().execute(query, (receipt_id, *params)).fetchone()
+
+    @classmethod
+    def receipt_page_key(cls, row, sort="num"):
+        """Chiave di ordinamento dello storico per la paginazione keyset."""
+        return tuple(row[col.split(".")[1]] for col in cls.RECEIPT_SORTS[sort]) + (row['id'],)
+
+    def get_receipts_page(self, user_id, limit, after=None, before=None, sort="num", desc=True, filtri=None):
+        """Una pagina dello storico, per default nell'ordine di get_receipts (dal piu' recente).
+
+        sort e' una chiave di RECEIPT_SORTS, filtri un dict con chiavi di
+        RECEIPT_FILTERS. after/before sono chiavi receipt_page_key: con after
+        si leggono le righe successive, con before quelle precedenti. Il
+        risultato e' sempre nell'ordine di visualizzazione. Il costo dipende
+        solo da limit e non dalla posizione nello storico (nessun OFFSET).
+        """
+        columns = self.RECEIPT_SORTS[sort] + ("r.id",)
+        filtro, params = self._filter_sql(self.RECEIPT_FILTERS, filtri)
+        params = [user_id] + params
+        # Leggere "prima" della chiave significa scorrere al contrario e poi invertire
+        backwards = before is not None
+        verso = "DESC" if desc != backwards else "ASC"
+        key = before if backwards else after
+        if key is not None:
+            op = "<" if verso == "DESC" else ">"
+            filtro += f" AND ({', '.join(columns)}) {op} ({', '.join('?' * len(columns))})"
+            params.extend(key)
+        params.append(limit)
+        ordine = ", ".join(f"{col} {verso}" for col in columns)
+        query = self.RECEIPTS_PAGE_SQL.format(filtro=filtro, ordine=ordine)
+        rows = self._get_connection().execute(query, params).fetchall()
+        if backwards:
+            rows.reverse()
+        return rows
+
+    def get_receipt_years(self, user_id):
+        """Anni con almeno una ricevuta, dal piu' recente (dai totali materializzati)."""
+        conn = self._get_connection()
+        return [r['anno'] for r in conn.execute(
+            "SELECT anno FROM annual_totals WHERE user_id = ? AND numero_ricevute > 0 ORDER BY anno DESC",
+            (user_id,))]
+
+    def get_receipt_ids(self, user_id, anno=None, client_id=None, assignment_id=None, in_sospeso=False):
+        """Id delle ricevute dell'utente, filtrabili per anno, cliente o incarico.
+
+        Con in_sospeso=True solo quelle il cui PDF è ancora da generare o è fallito.
+        """
+        query = """SELECT r.id FROM receipts r
+                   JOIN assignments a ON r.assignment_id = a.id
+                   WHERE r.user_id = ?"""
+        params = [user_id]
+        if anno is not None:
+            query += " AND r.anno_riferimento = ?"
+            params.append(anno)
+        if client_id is not None:
+            query += " AND a.client_id = ?"
+            params.append(client_id)
+        if assignment_id is not None:
+            query += " AND r.assignment_id = ?"
+            params.append(assignment_id)
+        if in_sospeso:
+            query += " AND r.render_status <> 'rendered'"
+        query += " ORDER BY r.anno_riferimento, r.numero_progressivo"
+        conn = self._get_connection()
+        return [row['id'] for row in conn.execute(query, params)]
+
+    def get_user_by_username(self, username):
+        conn = self._get_connection()
+        return conn.execute("SELECT id, username, display_name FROM users WHERE username = ?", (username,)).fetchone()
 
     def get_next_receipt_number(self, user_id, year):
+        """Prossimo numero libero dalla sequenza dell'anno.
+
+        Il numero è garantito solo se lettura e inserimento stanno nella
+        stessa transazione IMMEDIATE: usare allocate_receipt_number.
+        """
         conn = self._get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT MAX(numero_progressivo) FROM receipts WHERE user_id = ? AND anno_riferimento = ?", (user_id, year))
-        res = cursor.fetchone()[0]
-        conn.close()
-        return (res + 1) if res else 1
+        cursor.execute("SELECT ultimo_numero FROM receipt_sequences WHERE user_id = ? AND anno = ?", (user_id, year))
+        res = cursor.fetchone()
+        return (res[0] + 1) if res else 1
+
+    @contextmanager
+    def allocate_receipt_number(self, user_id, year):
+        """Transazione IMMEDIATE che fornisce il prossimo numero dell'anno.
+
+        La ricevuta va salvata dentro il blocco: il lock di scrittura è preso
+        prima di leggere la sequenza, quindi nessun'altra sessione o processo
+        può assegnare lo stesso numero nel frattempo.
+
+            with db.allocate_receipt_number(user_id, anno) as num:
+                db.save_receipt(user_id, ..., num, anno, ...)
+        """
+        with self.transaction("IMMEDIATE"):
+            with TRACCIA.span("numerazione", anno=year):
+                numero = self.get_next_receipt_number(user_id, year)
+            yield numero
+
+    def get_duplicate_receipt_numbers(self):
+        """Numeri di ricevuta assegnati più volte (dati precedenti al vincolo UNIQUE)."""
+        return self._get_connection().execute(DUPLICATE_NUMBERS_QUERY).fetchall()
+
+    def ensure_unique_numbering(self):
+        """Crea l'indice UNIQUE sulla numerazione se manca (la migrazione 6 lo
+        salta quando trova doppioni). Ritorna i doppioni che lo impediscono,
+        memorizzati anche in duplicate_numbers; [] se il vincolo è attivo."""
+        conn = self.pool.connection()
+        presente = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                                "AND name = 'idx_receipts_numero_unico'").fetchone()
+        if presente:
+            self.duplicate_numbers = []
+        else:
+            with self.pool.transaction("IMMEDIATE"):
+                self.duplicate_numbers = _create_unique_numbering(conn)
+        return self.duplicate_numbers
+
+    INSERT_RECEIPT_SQL = """
+        INSERT INTO receipts 
+        (user_id, assignment_id, numero_progressivo, anno_riferimento, data_emissione, descrizione_prestazione,
+         importo_lordo, imponibile_inps, aliquota_inps_applicata, ritenuta_inps_totale, quota_inps_utente,
+         aliquota_ritenuta_acconto, importo_ritenuta_acconto, rimborso_spese_esenti, 
+         bollo_applicato, importo_bollo, netto_a_pagare, file_path_pdf,
+         importo_lordo_cents, imponibile_inps_cents, ritenuta_inps_totale_cents, quota_inps_utente_cents,
+         importo_ritenuta_acconto_cents, rimborso_spese_esenti_cents, importo_bollo_cents, netto_a_pagare_cents,
+         template_version, render_status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+    """
+
+    @staticmethod
+    def _receipt_params(row):
+        """Aggiunge ai campi di save_receipt le colonne in centesimi; i REAL vengono
+        riallineati al valore in centesimi, così le due rappresentazioni coincidono.
+        In coda la versione corrente del modello PDF."""
+        (user_id, assignment_id, numero, anno, data_em, desc,
+         lordo, imp_inps, aliq_inps, rit_inps, quota_inps_user,
+         aliq_irpef, imp_irpef, rimborsi, bollo_bool, val_bollo, netto, path_pdf) = row
+        cents = [to_cents(v) for v in (lordo, imp_inps, rit_inps, quota_inps_user, imp_irpef, rimborsi, val_bollo, netto)]
+        c_lordo, c_imp_inps, c_rit_inps, c_quota, c_irpef, c_rimborsi, c_bollo, c_netto = cents
+        return (user_id, assignment_id, numero, anno, data_em, desc,
+                from_cents(c_lordo), from_cents(c_imp_inps), aliq_inps, from_cents(c_rit_inps), from_cents(c_quota),
+                aliq_irpef, from_cents(c_irpef), from_cents(c_rimborsi), bollo_bool, from_cents(c_bollo),
+                from_cents(c_netto), path_pdf, *cents, PDF_TEMPLATE_VERSION)
 
     def save_receipt(self, user_id, assignment_id, numero, anno, data_em, desc, 
                      lordo, imp_inps, aliq_inps, rit_inps, quota_inps_user,
                      aliq_irpef, imp_irpef, rimborsi, bollo_bool, val_bollo, netto, path_pdf):
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        query = """
-            INSERT INTO receipts 
-            (user_id, assignment_id, numero_progressivo, anno_riferimento, data_emissione, descrizione_prestazione,
-             importo_lordo, imponibile_inps, aliquota_inps_applicata, ritenuta_inps_totale, quota_inps_utente,
-             aliquota_ritenuta_acconto, importo_ritenuta_acconto, rimborso_spese_esenti, 
-             bollo_applicato, importo_bollo, netto_a_pagare, file_path_pdf)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        with self.transaction() as conn:
+            cur = conn.execute(self.INSERT_RECEIPT_SQL, self._receipt_params((
+                user_id, assignment_id, numero, anno, data_em, desc,
+                lordo, imp_inps, aliq_inps, rit_inps, quota_inps_user,
+                aliq_irpef, imp_irpef, rimborsi,
+                bollo_bool, val_bollo, netto, path_pdf
+            )))
+            self._changed("receipts", "insert", cur.lastrowid)
+        return cur.lastrowid
+
+    def save_receipts_bulk(self, rows):
+        """Inserisce più ricevute con un solo executemany, in un'unica transazione.
+
+        Ogni riga ha gli stessi campi, nello stesso ordine, degli argomenti di
+        save_receipt. Ritorna gli id creati, nell'ordine delle righe.
         """
-        cursor.execute(query, (
-            user_id, assignment_id, numero, anno, data_em, desc,
-            lordo, imp_inps, aliq_inps, rit_inps, quota_inps_user,
-            aliq_irpef, imp_irpef, rimborsi,
-            bollo_bool, val_bollo, netto, path_pdf
-        ))
-        conn.commit()
-        conn.close()
-    
+        if not rows:
+            return []
+        with self.transaction("IMMEDIATE") as conn:
+            conn.executemany(self.INSERT_RECEIPT_SQL, [self._receipt_params(row) for row in rows])
+            # Con il lock di scrittura in mano gli id AUTOINCREMENT sono consecutivi
+            last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'receipts'").fetchone()[0]
+            ids = list(range(last_id - len(rows) + 1, last_id + 1))
+            for new_id in ids:
+                self._changed("receipts", "insert", new_id)
+        return ids
+
+    def delete_receipt(self, receipt_id):
+        # I totali annui vengono scalati dal trigger trg_receipts_totals_del
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM receipts WHERE id = ?", (receipt_id,))
+            self._changed("receipts", "delete", int(receipt_id))
+
+    def set_render_status(self, results):
+        """Registra l'esito dei rendering PDF: lista di (receipt_id, ok, errore, impronta).
+
+        L'impronta (vedi impronta_render) viene salvata solo per i PDF riusciti.
+        """
+        with self.transaction() as conn:
+            conn.executemany("UPDATE receipts SET render_status = ?, render_error = ?, render_hash = ? WHERE id = ?",
+                             [("rendered" if ok else "failed", errore, impronta if ok else None, rid)
+                              for rid, ok, errore, impronta in results])
+
+    def set_render_hashes(self, impronte):
+        """Registra l'impronta dei PDF già emessi che non ne hanno una, senza
+        rigenerarli: lista di (receipt_id, impronta)."""
+        with self.transaction() as conn:
+            conn.executemany("UPDATE receipts SET render_hash = ? WHERE id = ? AND render_hash IS NULL",
+                             [(impronta, rid) for rid, impronta in impronte])
+
     def get_receipt_path(self, receipt_id):
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT file_path_pdf FROM receipts WHERE id = ?", (receipt_id,))
         result = cursor.fetchone()
-        conn.close()
         return result['file_path_pdf'] if result else None
 
     def get_receipt_by_id(self, receipt_id):
@@ -393,69 +1591,402 @@ class DatabaseHandler:
         c = conn.cursor()
         c.execute("SELECT * FROM receipts WHERE id = ?", (receipt_id,))
         row = c.fetchone()
-        conn.close()
-        
-        if row:
-            return {
-                "id": row['id'],
-                "user_id": row['user_id'],
-                "assign_id": row['assignment_id'],
-                "numero": row['numero_progressivo'],
-                "anno": row['anno_riferimento'],
-                "data": row['data_emissione'],
-                "desc": row['descrizione_prestazione'],
-                "lordo": row['importo_lordo'],
-                "imp_inps": row['imponibile_inps'],
-                "aliq_inps": row['aliquota_inps_applicata'],
-                "rit_inps": row['ritenuta_inps_totale'],
-                "quota_inps": row['quota_inps_utente'],
-                "aliq_irpef": row['aliquota_ritenuta_acconto'],
-                "imp_irpef": row['importo_ritenuta_acconto'],
-                "spese": row['rimborso_spese_esenti'],
-                "bollo_bool": row['bollo_applicato'],
-                "val_bollo": row['importo_bollo'],
-                "netto": row['netto_a_pagare'],
-                "filename": row['file_path_pdf']
-            }
-        return None
+        return self._receipt_dict(row) if row else None
+
+    @staticmethod
+    def _receipt_dict(row):
+        """Ricevuta nel formato usato da GUI e PDF (importi in euro dai centesimi)."""
+        return {
+            "id": row['id'],
+            "user_id": row['user_id'],
+            "assign_id": row['assignment_id'],
+            "numero": row['numero_progressivo'],
+            "anno": row['anno_riferimento'],
+            "data": row['data_emissione'],
+            "desc": row['descrizione_prestazione'],
+            "lordo": from_cents(row['importo_lordo_cents']),
+            "imp_inps": from_cents(row['imponibile_inps_cents']),
+            "aliq_inps": row['aliquota_inps_applicata'],
+            "rit_inps": from_cents(row['ritenuta_inps_totale_cents']),
+            "quota_inps": from_cents(row['quota_inps_utente_cents']),
+            "aliq_irpef": row['aliquota_ritenuta_acconto'],
+            "imp_irpef": from_cents(row['importo_ritenuta_acconto_cents']),
+            "spese": from_cents(row['rimborso_spese_esenti_cents']),
+            "bollo_bool": row['bollo_applicato'],
+            "val_bollo": from_cents(row['importo_bollo_cents']),
+            "netto": from_cents(row['netto_a_pagare_cents']),
+            "filename": row['file_path_pdf'],
+            "template_version": row['template_version']
+        }
+
+    # --- CONTESTO DI STAMPA ---
+    RENDER_PROFILE_COLUMNS = ("id", "user_id", "nome_completo", "codice_fiscale", "indirizzo", "iban", "email", "telefono")
+    RENDER_CLIENT_COLUMNS = ("id", "user_id", "ragione_sociale", "piva_cf", "indirizzo", "email_amministrazione",
+                             "sostituto_imposta", "note")
+    RENDER_CONTEXT_SQL = """
+        SELECT r.*, a.cig, a.nome_rup, a.rif_determina_incarico, a.descrizione_progetto,
+               {client_cols}, {profile_cols}
+        FROM receipts r
+        JOIN assignments a ON a.id = r.assignment_id
+        JOIN clients c ON c.id = a.client_id
+        LEFT JOIN user_profile p ON p.user_id = r.user_id
+        WHERE r.id IN ({marks})
+    """.replace("{client_cols}", ", ".join(f"c.{col} AS c_{col}" for col in RENDER_CLIENT_COLUMNS)) \
+       .replace("{profile_cols}", ", ".join(f"p.{col} AS p_{col}" for col in RENDER_PROFILE_COLUMNS))
+    # Limite prudente ai parametri per query (SQLite vecchi: 999)
+    RENDER_CONTEXT_CHUNK = 500
+
+    def _render_context(self, row):
+        pdf_data = self._receipt_dict(row)
+        pdf_data['cig'] = row['cig']
+        pdf_data['rup'] = row['nome_rup']
+        pdf_data['rif_det'] = row['rif_determina_incarico']
+        pdf_data['progetto_macro'] = row['descrizione_progetto']
+        client = {col: row[f"c_{col}"] for col in self.RENDER_CLIENT_COLUMNS}
+        profile = None
+        if row['p_id'] is not None:
+            profile = {col: row[f"p_{col}"] for col in self.RENDER_PROFILE_COLUMNS}
+        return RenderContext(row['id'], profile, client, pdf_data, row['file_path_pdf'], pdf_data['lordo'] < 0,
+                             row['render_hash'], row['render_status'])
+
+    def get_render_contexts(self, receipt_ids):
+        """Tutto ciò che serve a genera_pdf_ricevuta per più ricevute, con una
+        query unica (ricevuta + incarico + cliente + profilo) ogni
+        RENDER_CONTEXT_CHUNK id. Ritorna RenderContext nell'ordine degli id;
+        gli id inesistenti vengono saltati. Solo dict e tipi semplici: i
+        risultati si possono passare ai processi di lavoro.
+        """
+        ids = [int(rid) for rid in receipt_ids]
+        conn = self._get_connection()
+        found = {}
+        for start in range(0, len(ids), self.RENDER_CONTEXT_CHUNK):
+            chunk = ids[start:start + self.RENDER_CONTEXT_CHUNK]
+            query = self.RENDER_CONTEXT_SQL.format(marks=", ".join("?" * len(chunk)))
+            for row in conn.execute(query, chunk):
+                found[row['id']] = self._render_context(row)
+        return [found[rid] for rid in ids if rid in found]
+
+    ISSUE_CONTEXT_SQL = """
+        SELECT {client_cols}, {profile_cols}
+        FROM assignments a
+        JOIN clients c ON c.id = a.client_id
+        LEFT JOIN user_profile p ON p.user_id = a.user_id
+        WHERE a.id = ? AND a.user_id = ?
+    """.replace("{client_cols}", ", ".join(f"c.{col} AS c_{col}" for col in RENDER_CLIENT_COLUMNS)) \
+       .replace("{profile_cols}", ", ".join(f"p.{col} AS p_{col}" for col in RENDER_PROFILE_COLUMNS))
+
+    def get_issue_context(self, user_id, assignment_id):
+        """Profilo e cliente con cui emettere una ricevuta sull'incarico, in una
+        sola lettura. Ritorna (profile, client); None se l'incarico non esiste
+        o non è dell'utente, profile None se il profilo non è stato compilato."""
+        row = self._get_connection().execute(self.ISSUE_CONTEXT_SQL, (assignment_id, user_id)).fetchone()
+        if row is None:
+            return None
+        client = {col: row[f"c_{col}"] for col in self.RENDER_CLIENT_COLUMNS}
+        profile = None
+        if row['p_id'] is not None:
+            profile = {col: row[f"p_{col}"] for col in self.RENDER_PROFILE_COLUMNS}
+        return profile, client
+
+    def get_receipt_render_context(self, receipt_id):
+        """Contesto di stampa di una sola ricevuta (None se non esiste)."""
+        contexts = self.get_render_contexts([receipt_id])
+        return contexts[0] if contexts else None
+
+    # --- RICERCA ---
+    SEARCH_FTS_SQL = """
+        SELECT rowid, titolo, snippet(search_index, -1, '[', ']', '…', 8) AS estratto
+        FROM search_index
+        WHERE search_index MATCH ? AND user_id = ?
+        ORDER BY bm25(search_index, 0.0, 2.0, 5.0, 1.0)
+        LIMIT ?
+    """
+
+    def has_search_index(self):
+        conn = self._get_connection()
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'").fetchone() is not None
+
+    def search(self, user_id, testo, limit=50):
+        """Ricerca per parole (anche iniziali) su ricevute, clienti e incarichi.
+
+        Ritorna dict {tipo, id, titolo, estratto} ordinati per pertinenza
+        (bm25, con CIG/P.IVA/determina pesati più della descrizione). Senza
+        FTS5 ripiega su LIKE, più lento e senza ordinamento per pertinenza.
+        """
+        termini = testo.split()
+        if not termini:
+            return []
+        conn = self._get_connection()
+        if self.has_search_index():
+            # Ogni parola diventa un prefisso quotato: niente sintassi FTS dall'utente
+            match = " ".join('"' + t.replace('"', '""') + '"*' for t in termini)
+            rows = conn.execute(self.SEARCH_FTS_SQL, (match, user_id, limit)).fetchall()
+            return [{"tipo": SEARCH_KINDS[r['rowid'] % 4], "id": r['rowid'] // 4,
+                     "titolo": r['titolo'], "estratto": r['estratto']} for r in rows]
+        testo_sql = "(IFNULL(titolo, '') || ' ' || codici || ' ' || altro)"
+        query = ("SELECT kind, id, titolo, codici FROM search_source WHERE user_id = ? "
+                 + f"AND {testo_sql} LIKE ? ESCAPE '\\' " * len(termini) + "LIMIT ?")
+        like = ["%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for t in termini]
+        rows = conn.execute(query, (user_id, *like, limit)).fetchall()
+        return [{"tipo": SEARCH_KINDS[r['kind']], "id": r['id'],
+                 "titolo": r['titolo'], "estratto": r['codici']} for r in rows]
 
 # Istanza globale
 db = DatabaseHandler()
 
 
+# =========================================================================
+# MODULO 1-BIS: CALCOLO FISCALE
+# =========================================================================
+
+class FiscalEngine:
+    """Calcolo fiscale puro (senza GUI né database) per un anno di riferimento.
+
+    Riceve la riga di fiscal_config e calcola in un solo passaggio tutte le
+    colonne di un'intera sequenza di ricevute: il cumulato annuo prima di ogni
+    ricevuta è la somma progressiva dei lordi precedenti. Serve per simulazioni,
+    importazioni massive e ricalcoli dell'anno intero.
+
+    Il calcolo avviene in centesimi interi; le percentuali sono Decimal e ogni
+    voce è arrotondata al centesimo con ROUND_HALF_UP (vedi round_cents).
+    """
+    COLUMNS = ('lordo', 'spese', 'imp_inps', 'aliq_inps', 'rit_inps', 'quota_inps',
+               'aliq_irpef', 'imp_irpef', 'bollo_bool', 'val_bollo', 'netto')
+    MONEY_COLUMNS = ('lordo', 'spese', 'imp_inps', 'rit_inps', 'quota_inps', 'imp_irpef', 'val_bollo', 'netto')
+
+    def __init__(self, cfg, anno=None):
+        self.anno = anno if anno is not None else cfg['anno']
+        self.soglia = to_cents(cfg['soglia_inps_no_tax'])
+        self.aliq_inps = Decimal(str(cfg['aliquota_gestione_separata']))
+        self.quota_utente = Decimal(str(cfg['quota_carico_utente']))
+        self.soglia_bollo = to_cents(cfg['soglia_bollo'])
+        self.valore_bollo = to_cents(cfg['valore_bollo'])
+
+    def imponibile_inps(self, cumul, lordo):
+        """Imponibile INPS in centesimi, dato il cumulato precedente e il lordo (centesimi)."""
+        # CALCOLO CORRETTO DELL'IMPONIBILE INPS (gestione dello "scavalco")
+        if cumul >= self.soglia:
+            # Caso 1: già oltre la franchigia -> tutto il nuovo compenso è imponibile
+            return lordo
+        if cumul + lordo <= self.soglia:
+            # Caso 2: non si raggiunge la franchigia -> niente è imponibile
+            return 0
+        # Caso 3: "scavalco" -> solo la parte che supera la franchigia è imponibile
+        return (cumul + lordo) - self.soglia
+
+    def calcola(self, lordi, spese=None, aliquote_irpef=None, cumul_iniziale=0):
+        """Calcola le colonne per una sequenza di ricevute in ordine di emissione.
+
+        Gli importi in ingresso sono in euro; spese e aliquote_irpef possono essere
+        sequenze parallele a lordi o valori singoli (default 0 e 20%). Ritorna un
+        dizionario colonna -> lista, con gli importi in centesimi interi.
+        """
+        n = len(lordi)
+        spese = list(spese) if isinstance(spese, (list, tuple)) else [spese or 0] * n
+        if isinstance(aliquote_irpef, (list, tuple)):
+            aliquote_irpef = list(aliquote_irpef)
+        else:
+            aliquote_irpef = [20 if aliquote_irpef is None else aliquote_irpef] * n
+        if len(spese) != n or len(aliquote_irpef) != n:
+            raise ValueError("lordi, spese e aliquote_irpef devono avere la stessa lunghezza")
+
+        lordi = [to_cents(l) for l in lordi]
+        spese = [to_cents(x) for x in spese]
+        aliq_irpef = [Decimal(str(a)) for a in aliquote_irpef]
+
+        # Cumulato PRIMA di ciascuna ricevuta
+        cumul = list(accumulate(lordi[:-1], initial=to_cents(cumul_iniziale))) if n else []
+
+        imp_inps = [self.imponibile_inps(c, l) for c, l in zip(cumul, lordi)]
+        rit_inps = [round_cents(i * self.aliq_inps / 100) for i in imp_inps]
+        quota_inps = [round_cents(r * self.quota_utente) for r in rit_inps]
+        imp_irpef = [round_cents(l * a / 100) for l, a in zip(lordi, aliq_irpef)]
+        val_bollo = [self.valore_bollo if l >= self.soglia_bollo else 0 for l in lordi]
+        netto = [l + s + b - q - i for l, s, b, q, i in zip(lordi, spese, val_bollo, quota_inps, imp_irpef)]
+
+        return {
+            'lordo': lordi, 'spese': spese, 'imp_inps': imp_inps,
+            'aliq_inps': [float(self.aliq_inps)] * n, 'rit_inps': rit_inps, 'quota_inps': quota_inps,
+            'aliq_irpef': [float(a) for a in aliq_irpef], 'imp_irpef': imp_irpef,
+            'bollo_bool': [b > 0 for b in val_bollo], 'val_bollo': val_bollo, 'netto': netto,
+        }
+
+    def righe(self, lordi, spese=None, aliquote_irpef=None, cumul_iniziale=0):
+        """Come calcola(), ma ritorna una lista di dizionari (uno per ricevuta)
+        con gli importi in euro, come li usano GUI, save_receipt e PDF."""
+        cols = self.calcola(lordi, spese, aliquote_irpef, cumul_iniziale)
+        for col in self.MONEY_COLUMNS:
+            cols[col] = [from_cents(v) for v in cols[col]]
+        return [dict(zip(self.COLUMNS, values), anno=self.anno)
+                for values in zip(*(cols[c] for c in self.COLUMNS))]
+
+
+def calcola_ricevuta(cfg, cumul, lordo, spese, irpef_perc, anno):
+    """Calcola ritenute, bollo e netto di una singola ricevuta.
+
+    cfg è la riga di fiscal_config dell'anno, cumul il lordo già fatturato
+    nell'anno prima di questa ricevuta. Ritorna il dizionario usato da
+    save_receipt e da genera_pdf_ricevuta.
+    """
+    return FiscalEngine(cfg, anno).righe([lordo], [spese], [irpef_perc], cumul)[0]
+
+
 # =========================================================================
 # MODULO 2: PDF GENERATOR
 # =========================================================================
 
-class RicevutaPDF(FPDF):
-    def __init__(self, is_credit_note=False, *args, **kwargs):
+# Testi fissi delle ricevute, per versione. Ogni ricevuta memorizza la versione
+# con cui è stata emessa (receipts.template_version) e viene sempre ristampata
+# con quella: per cambiare un testo si aggiunge una nuova versione in coda,
+# senza modificare le precedenti.
+PDF_TEMPLATES = {
+    1: {
+        "titolo": "RICEVUTA PRESTAZIONE OCCASIONALE",
+        "titolo_storno": "NOTA DI CREDITO (Storno)",
+        "sottotitolo": "(art. 2222 e succ. Codice Civile)",
+        "nota_no_ritenuta": "* Prestazione non soggetta a ritenuta d'acconto.",
+        "nota_ritenuta": "* Ritenuta d'acconto da versare tramite F24 (Cod. Tributo 1040) entro il 16 del mese successivo.",
+        "nota_bollo": "** Imposta di bollo di 2,00 euro assolta sull'originale.",
+        "nota_storno_bollo": "** Storno imposta di bollo applicata in origine.",
+        "nota_esente_bollo": "** Esente da imposta di bollo (importo inferiore a 77,47 euro).",
+        "nota_inps": "*** Applicata trattenuta INPS Gestione Separata (L. 335/95).",
+        "dichiarazione": "DICHIARAZIONE SOSTITUTIVA DELL'ATTO DI NOTORIETA'",
+        "dichiarazione_norma": "(Art. 47 D.P.R. 28 dicembre 2000, n. 445)",
+        "intro": (
+            "Il sottoscritto {nome_completo}, Codice Fiscale {codice_fiscale}, "
+            "residente in {indirizzo}, "
+            "consapevole delle sanzioni penali richiamate dall'art. 76 del D.P.R. 445/2000 in caso di dichiarazioni mendaci,"
+        ),
+        "punti": [
+            "1) che la prestazione resa ha carattere del tutto occasionale non svolgendo il sottoscritto prestazione di lavoro autonomo con carattere di abitualità;",
+            "2) di essere dipendente di ruolo e a tempo pieno della Provincia di Salerno area Funzionari ed EQ;",
+            "3) la prestazione oggetto della presente nota è stata effettuata in via occasionale, contingente ed episodica; il relativo compenso è da inquadrare tra i redditi di cui all'art. 81 comma 1, lettera L, del D.P.R. 917/86 e, pertanto, esclusa dal campo di applicazione dell'I.V.A. ai sensi dell'art. 5 del D.P.R. n. 633 del 26 ottobre 1972;",
+            "4) di non essere soggetto al regime Iva a norma dell'ex art. 5, comma 2, D.P.R. 633/72;"
+        ],
+        "punto5_franchigia": (
+            "5) di avere fruito nell'anno, ai fini contributivi, della franchigia prevista dall'art. 44 del D.L. 30 settembre 2003, n. 269 "
+            "e l'importo da assoggettare a ritenuta INPS del 24% è pari a EUR {imponibile}. "
+            "Pertanto, l'importo complessivo che codesta stazione appaltante dovrà versare all'INPS alla Gestione Separata dello scrivente "
+            "aperta dal 30/10/2008 è pari a EUR {totale_inps} comprensivo dell'importo detratto in fattura."
+        ),
+        "punto5_storno": (
+            "5) che la presente nota è a storno parziale o totale di redditi precedentemente dichiarati. Imponibile INPS stornato: EUR {imponibile}."
+        ),
+        "punto5_no_franchigia": (
+            "5) di non avere fruito nell'anno, ai fini contributivi, della franchigia prevista dall'art. 44 del D.L. 30 settembre 2003, n. 269."
+        ),
+    },
+}
+PDF_TEMPLATE_VERSION = max(PDF_TEMPLATES)
+
+# A-capo già calcolati: (font, stile, corpo, larghezza, testo) -> righe.
+# Il calcolo delle righe è la parte più costosa del rendering; i paragrafi
+# fissi del modello (e quelli del profilo) vengono così spezzati una volta
+# sola per processo.
+_WRAP_CACHE = {}
+_WRAP_CACHE_MAX = 2048
+
+def scrivi_paragrafo(pdf, w, h, text, align='L'):
+    """Come pdf.multi_cell(w, h, text, align=align), con le righe in cache."""
+    key = (pdf.font_family, pdf.font_style, pdf.font_size_pt, w, align, text)
+    lines = _WRAP_CACHE.get(key)
+    if lines is None:
+        lines = pdf.multi_cell(w, h, text, align=align, dry_run=True, output="LINES")
+        if len(_WRAP_CACHE) >= _WRAP_CACHE_MAX:
+            _WRAP_CACHE.clear()
+        _WRAP_CACHE[key] = lines
+    # Stesse posizioni finali di multi_cell: a capo sotto, x a destra del blocco
+    for i, line in enumerate(lines):
+        last = i == len(lines) - 1
+        pdf.cell(w, h, line, align=align, new_x="RIGHT" if last else "LEFT", new_y="NEXT")
+
+class RicevutaPDF:
+    """Intestazione e piè di pagina delle ricevute.
+
+    Non eredita direttamente da FPDF per non importare fpdf2 all'avvio:
+    la classe documento concreta (RicevutaPDF + FPDF) la crea pdf_class().
+    Un documento può contenere più ricevute (esporta_pdf_unico): intestazione
+    e numero di pagina ripartono da capo a ogni inizia_ricevuta().
+    """
+    def __init__(self, is_credit_note=False, *args, template=None, **kwargs):
         self.is_credit_note = is_credit_note
+        self.template = template or PDF_TEMPLATES[PDF_TEMPLATE_VERSION]
+        self.pagina_ricevuta = 0   # pagina corrente all'interno della ricevuta
+        self.ricomincia = True     # la prossima pagina è la prima di una ricevuta
         super().__init__(*args, **kwargs)
 
+    def inizia_ricevuta(self, is_credit_note, template):
+        """Apre la prima pagina di una nuova ricevuta."""
+        self.is_credit_note = is_credit_note
+        self.template = template
+        # Il contatore si azzera in header(): add_page() disegna prima il
+        # piè di pagina della ricevuta precedente
+        self.ricomincia = True
+        self.add_page()
+
     def header(self):
-        if self.page_no() == 1:
+        self.pagina_ricevuta = 1 if self.ricomincia else self.pagina_ricevuta + 1
+        self.ricomincia = False
+        if self.pagina_ricevuta == 1:
             self.set_font('Helvetica', 'B', 16)
             # TITOLO DINAMICO
-            title = "NOTA DI CREDITO (Storno)" if self.is_credit_note else "RICEVUTA PRESTAZIONE OCCASIONALE"
+            title = self.template["titolo_storno"] if self.is_credit_note else self.template["titolo"]
             self.cell(180, 10, title, align='C', new_x="LMARGIN", new_y="NEXT")
             self.set_font('Helvetica', 'I', 10)
-            self.cell(180, 5, '(art. 2222 e succ. Codice Civile)', align='C', new_x="LMARGIN", new_y="NEXT")
+            self.cell(180, 5, self.template["sottotitolo"], align='C', new_x="LMARGIN", new_y="NEXT")
             self.ln(10)
 
     def footer(self):
         self.set_y(-15)
         self.set_font('Helvetica', 'I', 8)
-        self.cell(0, 10, f'Pagina {self.page_no()}', align='C')
+        self.cell(0, 10, f'Pagina {self.pagina_ricevuta}', align='C')
+
+_PDF_CLASS = None
+
+def pdf_class():
+    """Importa fpdf2 al primo rendering e ritorna la classe documento concreta."""
+    global _PDF_CLASS
+    if _PDF_CLASS is None:
+        from fpdf import FPDF
+        _PDF_CLASS = type("RicevutaPDF", (RicevutaPDF, FPDF), {})
+        startup_mark("import fpdf2 (primo PDF)")
+    return _PDF_CLASS
+
+def nuovo_documento_pdf():
+    """Documento A4 vuoto con i margini delle ricevute."""
+    pdf = pdf_class()(orientation='P', unit='mm', format='A4')
+    pdf.set_margins(left=15, top=15, right=15)
+    return pdf
 
 def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=False):
+    with TRACCIA.span("layout PDF"):
+        pdf = nuovo_documento_pdf()
+        disegna_ricevuta(pdf, profile, client, receipt_data, is_credit_note=is_credit_note)
+
+    # exist_ok: più processi della generazione massiva possono arrivare qui insieme
+    os.makedirs("RPO_RICEVUTE", exist_ok=True)
+
+    with TRACCIA.span("pdf.output", file=filename):
+        pdf.output(filename)
+    return filename # <--- Assicurati che ci sia questa riga!
+
+def disegna_ricevuta(pdf, profile, client, receipt_data, is_credit_note=False, segnalibro=None):
+    """Aggiunge a pdf le pagine di una ricevuta (dopo quelle già presenti).
+
+    segnalibro: se indicato, voce nell'indice del documento che punta alla ricevuta.
+    """
     # CONFIGURAZIONE SICURA
     MARGIN = 15
     CONTENT_WIDTH = 180 
     
+    # Testi fissi della versione con cui la ricevuta è stata emessa
+    template = PDF_TEMPLATES[receipt_data.get('template_version') or PDF_TEMPLATE_VERSION]
+
     # Passiamo il flag alla classe PDF
-    pdf = RicevutaPDF(is_credit_note=is_credit_note, orientation='P', unit='mm', format='A4')
-    pdf.set_margins(left=MARGIN, top=MARGIN, right=MARGIN)
-    pdf.add_page()
+    pdf.inizia_ricevuta(is_credit_note, template)
+    if segnalibro:
+        pdf.start_section(segnalibro)
     pdf.set_auto_page_break(auto=True, margin=15)
     
     def reset_x():
@@ -540,12 +2071,12 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
         # RIGA 3: Progetto (Senza Bordo, Tabella Invisibile)
         if project_text:
             reset_x()
-            pdf.multi_cell(CONTENT_WIDTH, 5, project_text, border=0, align='L')
+            scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, project_text, align='L')
         
         # RIGA 4: Codici (Senza Bordo, Tabella Invisibile)
         if codes_text:
             reset_x()
-            pdf.multi_cell(CONTENT_WIDTH, 5, codes_text, border=0, align='L')
+            scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, codes_text, align='L')
 
     pdf.ln(5)
 
@@ -605,28 +2136,28 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
     
     reset_x()
     if receipt_data['imp_irpef'] == 0:
-        pdf.multi_cell(CONTENT_WIDTH, 4, "* Prestazione non soggetta a ritenuta d'acconto.", align='L')
+        scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_no_ritenuta"], align='L')
     else:
-         pdf.multi_cell(CONTENT_WIDTH, 4, "* Ritenuta d'acconto da versare tramite F24 (Cod. Tributo 1040) entro il 16 del mese successivo.", align='L')
+         scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_ritenuta"], align='L')
     
     reset_x()
     if receipt_data['val_bollo'] > 0:
-        pdf.multi_cell(CONTENT_WIDTH, 4, "** Imposta di bollo di 2,00 euro assolta sull'originale.", align='L')
+        scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_bollo"], align='L')
     elif receipt_data['val_bollo'] < 0:
-        pdf.multi_cell(CONTENT_WIDTH, 4, "** Storno imposta di bollo applicata in origine.", align='L')
+        scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_storno_bollo"], align='L')
     else:
-        pdf.multi_cell(CONTENT_WIDTH, 4, "** Esente da imposta di bollo (importo inferiore a 77,47 euro).", align='L')
+        scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_esente_bollo"], align='L')
 
     if float(receipt_data['quota_inps']) != 0:
          reset_x()
-         pdf.multi_cell(CONTENT_WIDTH, 4, "*** Applicata trattenuta INPS Gestione Separata (L. 335/95).", align='L')
+         scrivi_paragrafo(pdf, CONTENT_WIDTH, 4, template["nota_inps"], align='L')
 
     pdf.ln(8)
 
     # 7. Firma
     reset_x()
     pdf.set_font('Helvetica', '', 10)
-    pdf.multi_cell(CONTENT_WIDTH, 5, f"Pagamento tramite bonifico su IBAN: {profile['iban']}", align='L')
+    scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, f"Pagamento tramite bonifico su IBAN: {profile['iban']}", align='L')
     
     pdf.ln(10)
     
@@ -646,19 +2177,16 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
     
     reset_x()
     pdf.set_font('Helvetica', 'B', 14)
-    pdf.multi_cell(CONTENT_WIDTH, 8, "DICHIARAZIONE SOSTITUTIVA DELL'ATTO DI NOTORIETA'", align='C')
+    scrivi_paragrafo(pdf, CONTENT_WIDTH, 8, template["dichiarazione"], align='C')
     pdf.set_font('Helvetica', 'I', 10)
-    pdf.cell(CONTENT_WIDTH, 6, "(Art. 47 D.P.R. 28 dicembre 2000, n. 445)", align='C', new_x="LMARGIN", new_y="NEXT")
+    pdf.cell(CONTENT_WIDTH, 6, template["dichiarazione_norma"], align='C', new_x="LMARGIN", new_y="NEXT")
     pdf.ln(10)
 
     reset_x()
     pdf.set_font('Helvetica', '', 10)
-    intro_text = (
-        f"Il sottoscritto {profile['nome_completo']}, Codice Fiscale {profile['codice_fiscale']}, "
-        f"residente in {profile['indirizzo']}, "
-        "consapevole delle sanzioni penali richiamate dall'art. 76 del D.P.R. 445/2000 in caso di dichiarazioni mendaci,"
-    )
-    pdf.multi_cell(CONTENT_WIDTH, 5, intro_text, align='L')
+    # Uguale per tutte le ricevute dello stesso profilo: spezzata una volta sola
+    intro_text = template["intro"].format(**profile)
+    scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, intro_text, align='L')
     
     pdf.ln(5)
     pdf.set_font('Helvetica', 'B', 10)
@@ -668,16 +2196,9 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
     pdf.cell(CONTENT_WIDTH, 6, "sotto la propria responsabilità:", align='L', new_x="LMARGIN", new_y="NEXT")
     pdf.ln(2)
 
-    punti = [
-        "1) che la prestazione resa ha carattere del tutto occasionale non svolgendo il sottoscritto prestazione di lavoro autonomo con carattere di abitualità;",
-        "2) di essere dipendente di ruolo e a tempo pieno della Provincia di Salerno area Funzionari ed EQ;",
-        "3) la prestazione oggetto della presente nota è stata effettuata in via occasionale, contingente ed episodica; il relativo compenso è da inquadrare tra i redditi di cui all'art. 81 comma 1, lettera L, del D.P.R. 917/86 e, pertanto, esclusa dal campo di applicazione dell'I.V.A. ai sensi dell'art. 5 del D.P.R. n. 633 del 26 ottobre 1972;",
-        "4) di non essere soggetto al regime Iva a norma dell'ex art. 5, comma 2, D.P.R. 633/72;"
-    ]
-
-    for p in punti:
+    for p in template["punti"]:
         reset_x()
-        pdf.multi_cell(CONTENT_WIDTH, 5, p, align='L')
+        scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, p, align='L')
         pdf.ln(2)
 
     # Punto 5 Dinamico
@@ -685,23 +2206,14 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
     totale_inps = receipt_data['rit_inps'] 
     
     if imponibile > 0:
-        testo_p5 = (
-            "5) di avere fruito nell'anno, ai fini contributivi, della franchigia prevista dall'art. 44 del D.L. 30 settembre 2003, n. 269 "
-            f"e l'importo da assoggettare a ritenuta INPS del 24% è pari a EUR {to_ita(imponibile)}. "
-            f"Pertanto, l'importo complessivo che codesta stazione appaltante dovrà versare all'INPS alla Gestione Separata dello scrivente "
-            f"aperta dal 30/10/2008 è pari a EUR {to_ita(totale_inps)} comprensivo dell'importo detratto in fattura."
-        )
+        testo_p5 = template["punto5_franchigia"].format(imponibile=to_ita(imponibile), totale_inps=to_ita(totale_inps))
     elif imponibile < 0:
-        testo_p5 = (
-            f"5) che la presente nota è a storno parziale o totale di redditi precedentemente dichiarati. Imponibile INPS stornato: EUR {to_ita(imponibile)}."
-        )
+        testo_p5 = template["punto5_storno"].format(imponibile=to_ita(imponibile))
     else:
-        testo_p5 = (
-            "5) di non avere fruito nell'anno, ai fini contributivi, della franchigia prevista dall'art. 44 del D.L. 30 settembre 2003, n. 269."
-        )
+        testo_p5 = template["punto5_no_franchigia"]
 
     reset_x()
-    pdf.multi_cell(CONTENT_WIDTH, 5, testo_p5, align='L')
+    scrivi_paragrafo(pdf, CONTENT_WIDTH, 5, testo_p5, align='L')
     pdf.ln(15)
 
     reset_x()
@@ -712,17 +2224,520 @@ def genera_pdf_ricevuta(profile, client, receipt_data, filename, is_credit_note=
     pdf.set_x(MARGIN + 90)
     pdf.cell(90, 15, "_______________________", align='C', new_x="LMARGIN", new_y="NEXT")
 
-    if not os.path.exists("RPO_RICEVUTE"):
-        os.makedirs("RPO_RICEVUTE")
-        
-    pdf.output(filename)
-    return filename # <--- Assicurati che ci sia questa riga!
+
+# --- GENERAZIONE MASSIVA ---
+# saltato=True: il PDF esistente aveva già l'impronta attuale, nessun rendering
+BatchResult = namedtuple("BatchResult", "receipt_id filename ok errore impronta saltato", defaults=(None, False))
+
+def prepara_job_pdf(receipt_ids):
+    """Legge dal DB tutto il necessario per il rendering, in dizionari serializzabili
+    (sqlite3.Row non passa tra processi)."""
+    return db.get_render_contexts(receipt_ids)
+
+def stato_pdf(ctx, impronta=None):
+    """Stato del file di una ricevuta rispetto ai dati di ctx:
+    "mancante", "aggiornato", "obsoleto" oppure "sconosciuto" per i PDF
+    emessi prima delle impronte (render_hash NULL su una ricevuta
+    'rendered'): non si sa con quali dati sono stati generati, e un
+    documento emesso non va riscritto solo per questo."""
+    if not os.path.isfile(ctx.filename):
+        return "mancante"
+    if ctx.render_hash is None:
+        return "sconosciuto" if ctx.render_status == "rendered" else "obsoleto"
+    return "aggiornato" if ctx.render_hash == (impronta or impronta_render(ctx)) else "obsoleto"
+
+def pdf_aggiornato(ctx, impronta=None):
+    """True se il file esiste ed è stato generato con gli stessi dati di ctx."""
+    return stato_pdf(ctx, impronta) == "aggiornato"
+
+def _render_job(job):
+    """Eseguito nei processi di lavoro: un errore diventa un risultato, non un'eccezione."""
+    impronta = impronta_render(job)
+    try:
+        genera_pdf_ricevuta(job.profile, job.client, job.pdf_data, job.filename, is_credit_note=job.is_credit_note)
+        return BatchResult(job.receipt_id, job.filename, True, None, impronta)
+    except Exception as e:
+        return BatchResult(job.receipt_id, job.filename, False, str(e))
+
+def genera_pdf_batch(receipt_ids, max_workers=None, progress_callback=None, forza=False):
+    """Rigenera i PDF delle ricevute indicate in parallelo su più processi.
+
+    I PDF già presenti e generati con gli stessi dati (stessa impronta), e
+    quelli emessi prima delle impronte (stato "sconosciuto"), non vengono
+    rifatti, salvo forza=True: il risultato ha saltato=True.
+    progress_callback(completati, totale, risultato) viene chiamata nel processo
+    principale a ogni file terminato. Ritorna la lista dei BatchResult.
+    """
+    contexts = prepara_job_pdf(receipt_ids)
+    total = len(contexts)
+    results = []
+
+    def done(result):
+        results.append(result)
+        if progress_callback:
+            progress_callback(len(results), total, result)
+
+    jobs = []
+    for ctx in contexts:
+        impronta = impronta_render(ctx)
+        if not forza and stato_pdf(ctx, impronta) in ("aggiornato", "sconosciuto"):
+            done(BatchResult(ctx.receipt_id, ctx.filename, True, None, impronta, True))
+        else:
+            jobs.append(ctx)
+
+    if len(jobs) <= 1 or max_workers == 1:
+        # Per pochi file l'avvio dei processi costa più del rendering
+        for job in jobs:
+            done(_render_job(job))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_render_job, job) for job in jobs]
+            for future in as_completed(futures):
+                done(future.result())
+    rendered = [(r.receipt_id, r.ok, r.errore, r.impronta) for r in results if not r.saltato]
+    if rendered:
+        db.set_render_status(rendered)
+    return results
+
+
+# Campi del profilo senza i quali la ricevuta non si può emettere (come nel form del profilo)
+PROFILO_OBBLIGATORI = {"nome_completo": "nome", "codice_fiscale": "codice fiscale",
+                       "indirizzo": "indirizzo", "iban": "IBAN"}
+
+def verifica_dati_emissione(dati, assignment_id):
+    """Solleva ValueError se incarico, cliente o profilo non permettono di emettere la ricevuta."""
+    if dati is None:
+        raise ValueError(f"Incarico {assignment_id} inesistente o non appartenente all'utente.")
+    profile, _client = dati
+    if profile is None:
+        raise ValueError("Profilo non compilato: completa i tuoi dati in \"Profilo\" prima di emettere ricevute.")
+    mancanti = [nome for col, nome in PROFILO_OBBLIGATORI.items() if not profile.get(col)]
+    if mancanti:
+        raise ValueError(f"Profilo incompleto, mancano: {', '.join(mancanti)}.")
+
+
+def emetti_ricevuta(user_id, assignment_id, anno, data_em, desc, importi, is_credit_note=False):
+    """Salva una nuova ricevuta e ne genera il PDF come unica unità di lavoro.
+
+    1. una lettura unica raccoglie profilo, incarico e cliente e li verifica:
+       se manca qualcosa si esce prima di toccare la numerazione;
+    2. una transazione IMMEDIATE breve assegna il numero e inserisce la riga
+       (render_status = 'pending');
+    3. una sola query legge il contesto di stampa (ricevuta, incarico,
+       cliente, profilo) così come è stato salvato;
+    4. il PDF viene generato fuori da ogni lock e l'esito aggiorna lo stato.
+    Se il rendering fallisce la ricevuta resta 'failed' e viene ripresa da
+    rigenera_in_sospeso. importi ha le chiavi di calcola_ricevuta.
+    Ritorna (numero, percorso PDF).
+    """
+    with TRACCIA.span("dati di emissione"):
+        verifica_dati_emissione(db.get_issue_context(user_id, assignment_id), assignment_id)
+
+    suffisso = "_STORNO" if is_credit_note else ""
+    i = importi
+    with TRACCIA.span("transazione ricevuta"):
+        with db.allocate_receipt_number(user_id, anno) as num:
+            filename = f"RPO_RICEVUTE/User{user_id}_RPO_{anno}_{num}{suffisso}.pdf"
+            with TRACCIA.span("insert ricevuta", numero=num):
+                receipt_id = db.save_receipt(user_id, assignment_id, num, anno, data_em, desc,
+                    i['lordo'], i['imp_inps'], i['aliq_inps'], i['rit_inps'], i['quota_inps'],
+                    i['aliq_irpef'], i['imp_irpef'], i['spese'], i['bollo_bool'], i['val_bollo'], i['netto'],
+                    filename)
+
+    with TRACCIA.span("contesto di stampa"):
+        ctx = db.get_receipt_render_context(receipt_id)
+    try:
+        with TRACCIA.span("genera_pdf_ricevuta"):
+            path = genera_pdf_ricevuta(ctx.profile, ctx.client, ctx.pdf_data, filename,
+                                       is_credit_note=is_credit_note)
+    except Exception as e:
+        db.set_render_status([(receipt_id, False, str(e), None)])
+        raise RuntimeError(f"Ricevuta {num}/{anno} salvata, ma il PDF non è stato generato ({e}). "
+                           "Verrà rigenerato automaticamente.") from e
+    with TRACCIA.span("stato rendering"):
+        db.set_render_status([(receipt_id, True, None, impronta_render(ctx))])
+    return num, path
+
+
+def rigenera_in_sospeso(user_id, max_workers=1):
+    """Coda di ripresa: rigenera i PDF rimasti 'pending' o 'failed'."""
+    return genera_pdf_batch(db.get_receipt_ids(user_id, in_sospeso=True), max_workers=max_workers)
+
+
+VerificaPDF = namedtuple("VerificaPDF", "mancanti obsoleti orfani senza_impronta")
+
+def verifica_cache_pdf(user_id, cartella="RPO_RICEVUTE"):
+    """Confronta i PDF dell'utente in cartella con le ricevute del database.
+
+    mancanti: id delle ricevute senza file; obsoleti: id delle ricevute il cui
+    file è stato generato con dati diversi; orfani: file User{user_id}_*.pdf
+    non collegati ad alcuna ricevuta; senza_impronta: (id, impronta attuale)
+    delle ricevute emesse prima delle impronte, non verificabili (vedi
+    DatabaseHandler.set_render_hashes per adottarne il file così com'è).
+    """
+    mancanti, obsoleti, senza_impronta, attesi = [], [], [], set()
+    for ctx in db.get_render_contexts(db.get_receipt_ids(user_id)):
+        attesi.add(os.path.normcase(os.path.abspath(ctx.filename)))
+        impronta = impronta_render(ctx)
+        stato = stato_pdf(ctx, impronta)
+        if stato == "mancante":
+            mancanti.append(ctx.receipt_id)
+        elif stato == "obsoleto":
+            obsoleti.append(ctx.receipt_id)
+        elif stato == "sconosciuto":
+            senza_impronta.append((ctx.receipt_id, impronta))
+    orfani = []
+    if os.path.isdir(cartella):
+        prefisso = f"User{user_id}_"
+        for nome in sorted(os.listdir(cartella)):
+            path = os.path.join(cartella, nome)
+            if (nome.startswith(prefisso) and nome.lower().endswith(".pdf")
+                    and os.path.normcase(os.path.abspath(path)) not in attesi):
+                orfani.append(path)
+    return VerificaPDF(mancanti, obsoleti, orfani, senza_impronta)
+
+
+# --- ESPORTAZIONE ---
+# Ricevute lette dal database per volta. Solo lo ZIP ha memoria costante: il
+# PDF unico tiene tutte le pagine fino alla scrittura (circa 55 MB ogni 2000
+# ricevute), per selezioni molto grandi va usato lo ZIP
+EXPORT_CHUNK = 200
+PDF_UNICO_MAX_CONSIGLIATO = 2000
+
+def _contesti_a_blocchi(receipt_ids):
+    ids = list(receipt_ids)
+    for start in range(0, len(ids), EXPORT_CHUNK):
+        yield db.get_render_contexts(ids[start:start + EXPORT_CHUNK])
+
+def _pypdf():
+    """pypdf se installato (dipendenza facoltativa dell'esportazione), altrimenti None."""
+    try:
+        import pypdf
+    except ImportError:
+        return None
+    return pypdf
+
+def _titolo_esportazione(ctx):
+    d = ctx.pdf_data
+    titolo = f"{'Nota di credito' if ctx.is_credit_note else 'Ricevuta'} {d['numero']}/{d['anno']}"
+    return f"{titolo} - {ctx.client['ragione_sociale']}"
+
+def _genera_mancanti(receipt_ids, max_workers=None):
+    """Genera i soli PDF che non esistono su disco: i documenti già emessi non
+    vengono mai riscritti da un'esportazione. Ritorna i BatchResult falliti."""
+    mancanti = [ctx.receipt_id for contexts in _contesti_a_blocchi(receipt_ids)
+                for ctx in contexts if not os.path.isfile(ctx.filename)]
+    return [r for r in genera_pdf_batch(mancanti, max_workers=max_workers) if not r.ok]
+
+def esporta_pdf_unico(receipt_ids, dest, progress_callback=None, max_workers=None):
+    """Scrive in dest (percorso o file binario) un solo PDF con tutte le ricevute,
+    nell'ordine degli id, con un segnalibro per ciascuna.
+
+    Le ricevute compaiono come sono state emesse. Con pypdf installato le
+    pagine dei PDF esistenti vengono copiate senza modifiche (si generano
+    solo i file mancanti). Senza pypdf le ricevute vengono ridisegnate nel
+    documento, ognuna con la propria numerazione di pagina: è possibile solo
+    se i dati non sono cambiati dall'emissione (stessa impronta) o il file
+    manca, altrimenti RuntimeError.
+    In entrambi i casi il documento resta in memoria fino alla scrittura e
+    cresce con il numero di ricevute: oltre PDF_UNICO_MAX_CONSIGLIATO usare
+    esporta_zip, che ha memoria costante.
+    progress_callback(completate, totale). Ritorna il numero di ricevute.
+    """
+    pypdf = _pypdf()
+    if pypdf is not None:
+        return _unisci_pdf_emessi(pypdf, receipt_ids, dest, progress_callback, max_workers)
+    totale = len(receipt_ids)
+    pdf = nuovo_documento_pdf()
+    fatte = 0
+    for contexts in _contesti_a_blocchi(receipt_ids):
+        for ctx in contexts:
+            if stato_pdf(ctx) in ("obsoleto", "sconosciuto"):
+                d = ctx.pdf_data
+                raise RuntimeError(f"La ricevuta {d['numero']}/{d['anno']} non si può ridisegnare uguale a "
+                                   "quella emessa: per il PDF unico installare pypdf (pip install pypdf), "
+                                   "oppure esportare in ZIP.")
+            disegna_ricevuta(pdf, ctx.profile, ctx.client, ctx.pdf_data, is_credit_note=ctx.is_credit_note,
+                             segnalibro=_titolo_esportazione(ctx))
+            fatte += 1
+            if progress_callback:
+                progress_callback(fatte, totale)
+    if fatte:
+        pdf.output(dest)
+    return fatte
+
+def _unisci_pdf_emessi(pypdf, receipt_ids, dest, progress_callback=None, max_workers=None):
+    falliti = _genera_mancanti(receipt_ids, max_workers)
+    if falliti:
+        raise RuntimeError(f"PDF non generato {falliti[0].filename}: {falliti[0].errore}")
+    totale = len(receipt_ids)
+    writer = pypdf.PdfWriter()
+    fatte = 0
+    for contexts in _contesti_a_blocchi(receipt_ids):
+        for ctx in contexts:
+            try:
+                writer.append(ctx.filename, outline_item=_titolo_esportazione(ctx), import_outline=False)
+            except Exception as e:
+                raise RuntimeError(f"PDF non leggibile {ctx.filename}: {e}") from e
+            fatte += 1
+            if progress_callback:
+                progress_callback(fatte, totale)
+    if fatte:
+        writer.write(dest)
+    return fatte
+
+def esporta_zip(receipt_ids, dest, max_workers=None, progress_callback=None):
+    """Scrive in dest (percorso o file binario, anche non ricercabile come
+    stdout) uno ZIP con i PDF delle ricevute.
+
+    Solo i PDF mancanti vengono generati (tutti insieme); i file esistenti
+    sono copiati nello ZIP byte per byte, così come sono stati emessi, a
+    blocchi senza caricarli tutti in memoria: la memoria usata non dipende
+    dal numero di ricevute. Ritorna (aggiunti, BatchResult falliti).
+    """
+    import zipfile
+
+    falliti = _genera_mancanti(receipt_ids, max_workers)
+    non_generati = {r.receipt_id for r in falliti}
+    totale = len(receipt_ids) - len(non_generati)
+    aggiunti = 0
+    # PDF già compressi: DEFLATE costerebbe tempo senza ridurre la dimensione
+    with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_STORED) as zf:
+        for contexts in _contesti_a_blocchi(receipt_ids):
+            for ctx in contexts:
+                if ctx.receipt_id in non_generati:
+                    continue
+                zf.write(ctx.filename, arcname=os.path.basename(ctx.filename))
+                aggiunti += 1
+                if progress_callback:
+                    progress_callback(aggiunti, totale)
+    return aggiunti, falliti
 
 
 # =========================================================================
 # MODULO 3: INTERFACCIA GRAFICA (GUI)
 # =========================================================================
 
+# =========================================================================
+# CLASSE LAVORI IN BACKGROUND
+# =========================================================================
+class BackgroundTasks:
+    """Esegue i lavori lenti (PDF, salvataggi, apertura file) in un thread di lavoro.
+
+    I risultati tornano al thread di Tk tramite una coda che viene letta con
+    root.after(): le callback on_done/on_error girano quindi sempre nel thread
+    della GUI e possono usare widget e messagebox. I lavori sono eseguiti uno
+    alla volta, nell'ordine di invio.
+    """
+    POLL_MS = 50
+
+    def __init__(self, root, on_busy_change=None):
+        self.root = root
+        self.on_busy_change = on_busy_change
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = 0
+        self._worker = threading.Thread(target=self._run, name="rpo-worker", daemon=True)
+        self._worker.start()
+        self._poll()
+
+    @property
+    def busy(self):
+        return self._pending > 0
+
+    def submit(self, fn, *args, on_done=None, on_error=None, descrizione=""):
+        """Accoda fn(*args) al thread di lavoro (da chiamare dal thread della GUI)."""
+        self._pending += 1
+        self._notify(descrizione)
+        self._jobs.put((fn, args, on_done, on_error))
+
+    def call_in_main(self, fn, *args):
+        """Fa eseguire fn(*args) nel thread della GUI; sicura da qualsiasi thread."""
+        self._results.put((fn, args, False))
+
+    def _run(self):
+        while True:
+            fn, args, on_done, on_error = self._jobs.get()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self._results.put((on_error, (e,), True))
+            else:
+                self._results.put((on_done, (result,), True))
+
+    def _poll(self):
+        try:
+            while True:
+                callback, args, finished_job = self._results.get_nowait()
+                if finished_job:
+                    self._pending -= 1
+                    self._notify("")
+                if callback:
+                    callback(*args)
+        except queue.Empty:
+            pass
+        self.root.after(self.POLL_MS, self._poll)
+
+    def _notify(self, descrizione):
+        if self.on_busy_change:
+            self.on_busy_change(self.busy, descrizione)
+
+
+def apri_file(path):
+    """Apre un file con il visualizzatore predefinito del sistema."""
+    # Forza il percorso a essere assoluto e usa i separatori corretti (\ per Windows)
+    full_path = os.path.normpath(os.path.abspath(path))
+    if not os.path.exists(full_path):
+        raise FileNotFoundError(f"File non trovato: {full_path}")
+
+    with TRACCIA.span("avvio visualizzatore", file=path):
+        if platform.system() == 'Darwin':       # macOS
+            subprocess.call(('open', full_path))
+        elif platform.system() == 'Windows':    # Windows
+            os.startfile(full_path)
+        else:                                   # Linux
+            subprocess.call(('xdg-open', full_path))
+
+
+# =========================================================================
+# CLASSE STORICO VIRTUALE
+# =========================================================================
+class StoricoVirtuale:
+    """Treeview dello storico ricevute caricata a finestre mentre si scorre.
+
+    Nel widget resta solo una finestra di al massimo MAX_ROWS righe: quando la
+    vista si avvicina a un bordo (entro PREFETCH della lunghezza) si legge la
+    pagina adiacente con db.get_receipts_page e si rilasciano le righe
+    all'estremo opposto. Gli iid restano gli id delle ricevute, quindi
+    tree.selection() funziona come con la lista completa. Ordinamento
+    (sort/desc) e filtri sono applicati dalla query: dopo averli cambiati
+    basta chiamare reload().
+    """
+    PAGE_SIZE = 100
+    MAX_ROWS = 400
+    PREFETCH = 0.2
+
+    def __init__(self, parent, user_id, columns, format_row):
+        self.user_id = user_id
+        self.format_row = format_row
+        frame = tk.Frame(parent)
+        frame.pack(fill=tk.BOTH, expand=True, pady=10)
+        self.scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL)
+        self.tree = ttk.Treeview(frame, columns=columns, show="headings",
+                                 yscrollcommand=self._on_scroll)
+        self.scrollbar.configure(command=self.tree.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.sort = "num"
+        self.desc = True
+        self.filtri = {}
+        self._keys = {}
+        self._more_before = False
+        self._more_after = False
+        self._pending = None
+
+    def _page(self, **keyset):
+        return db.get_receipts_page(self.user_id, self.PAGE_SIZE, sort=self.sort, desc=self.desc,
+                                    filtri=self.filtri, **keyset)
+
+    def _precedes(self, a, b):
+        """True se la chiave a viene mostrata prima della chiave b."""
+        return a > b if self.desc else a < b
+
+    def reload(self):
+        """Svuota la vista e carica la prima pagina nell'ordinamento corrente."""
+        self.tree.delete(*self.tree.get_children())
+        self._keys.clear()
+        rows = self._page()
+        self._insert(rows, tk.END)
+        self._more_before = False
+        self._more_after = len(rows) == self.PAGE_SIZE
+
+    def _insert(self, rows, index):
+        for pos, r in enumerate(rows):
+            values, tags = self.format_row(r)
+            at = tk.END if index == tk.END else index + pos
+            self.tree.insert("", at, iid=r['id'], values=values, tags=tags)
+            self._keys[str(r['id'])] = db.receipt_page_key(r, self.sort)
+
+    def apply_change(self, op, receipt_id):
+        """Riporta nella finestra una ricevuta inserita, modificata o cancellata."""
+        iid = str(receipt_id)
+        if self.tree.exists(iid):
+            self._release([iid])
+        if op == "delete":
+            return
+        row = db.get_receipt_row(receipt_id, self.filtri)
+        if row is None or row['user_id'] != self.user_id:
+            return
+        key = db.receipt_page_key(row, self.sort)
+        keys = [self._keys[c] for c in self.tree.get_children()]
+        # Fuori dalla finestra caricata: comparirà quando si scorre fin lì
+        if keys and ((self._precedes(key, keys[0]) and self._more_before)
+                     or (self._precedes(keys[-1], key) and self._more_after)):
+            return
+        self._insert([row], sum(1 for k in keys if self._precedes(k, key)))
+
+    def _release(self, iids):
+        self.tree.delete(*iids)
+        for iid in iids:
+            self._keys.pop(iid, None)
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._pending is not None:
+            return
+        first, last = float(first), float(last)
+        if self._more_after and last >= 1 - self.PREFETCH:
+            self._pending = self.tree.after_idle(self._load_after)
+        elif self._more_before and first <= self.PREFETCH:
+            self._pending = self.tree.after_idle(self._load_before)
+
+    def _top_row(self):
+        children = self.tree.get_children()
+        if not children:
+            return None
+        first = float(self.tree.yview()[0])
+        return children[min(int(first * len(children)), len(children) - 1)]
+
+    def _restore(self, anchor):
+        # Rimette in cima la riga che lo era prima del caricamento, cosi' la
+        # vista non salta quando si aggiungono o tolgono righe sopra di essa
+        children = self.tree.get_children()
+        if anchor is not None and self.tree.exists(anchor):
+            self.tree.yview_moveto(self.tree.index(anchor) / len(children))
+
+    def _load_after(self):
+        self._pending = None
+        children = self.tree.get_children()
+        if not children:
+            return
+        anchor = self._top_row()
+        rows = self._page(after=self._keys[children[-1]])
+        self._more_after = len(rows) == self.PAGE_SIZE
+        self._insert(rows, tk.END)
+        children = self.tree.get_children()
+        if len(children) > self.MAX_ROWS:
+            self._release(children[:len(children) - self.MAX_ROWS])
+            self._more_before = True
+        self._restore(anchor)
+
+    def _load_before(self):
+        self._pending = None
+        children = self.tree.get_children()
+        if not children:
+            return
+        anchor = self._top_row()
+        rows = self._page(before=self._keys[children[0]])
+        self._more_before = len(rows) == self.PAGE_SIZE
+        self._insert(rows, 0)
+        children = self.tree.get_children()
+        if len(children) > self.MAX_ROWS:
+            self._release(children[self.MAX_ROWS:])
+            self._more_after = True
+        self._restore(anchor)
+
+
 # =========================================================================
 # CLASSE LOGIN WINDOW
 # =========================================================================
@@ -789,7 +2804,6 @@ class LoginWindow:
         cur = conn.cursor()
         cur.execute("SELECT id, username, display_name FROM users ORDER BY display_name")
         users = cur.fetchall()
-        conn.close()
         
         # Crea mappa: display_name -> (id, username)
         self.user_map = {}
@@ -903,45 +2917,147 @@ class GestionaleRicevuteApp:
         current_year = date.today().year
         db.ensure_fiscal_config_exists(self.user_id, current_year)
 
+        # Barra di stato con indicatore di avanzamento per i lavori in background
+        self.status_bar = ttk.Frame(self.root, padding=(20, 0, 20, 5))
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_label = ttk.Label(self.status_bar, text="", foreground="gray")
+        self.status_label.pack(side=tk.LEFT)
+        self.status_progress = ttk.Progressbar(self.status_bar, mode="indeterminate", length=160)
+        self.tasks = BackgroundTasks(self.root, on_busy_change=self.update_status)
+
+        # Schermate di elenco tenute in vita tra una navigazione e l'altra:
+        # nome -> (frame, callback per le modifiche notificate dal DB, rilettura completa)
+        self.views = {}
+        db.subscribe(lambda *change: self.tasks.call_in_main(self.apply_db_change, *change))
+        # Le scritture di altri processi non arrivano come notifiche: le schermate
+        # vengono rilette se data_version è cambiato (alla navigazione e al focus)
+        self.data_version = db.data_version()
+        self.stale_views = set()
+        self.root.bind("<FocusIn>", self.on_focus_in, add="+")
+
         # Frame Principale# Frame Principale - usa tk.Frame con sfondo bianco
         self.main_frame = ttk.Frame(self.root)
         self.main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
         self.check_start()
+        self.warn_duplicate_numbers()
+
+        # PDF rimasti in sospeso (crash o errore di rendering in una sessione precedente)
+        if db.get_receipt_ids(self.user_id, in_sospeso=True):
+            self.tasks.submit(rigenera_in_sospeso, self.user_id, descrizione="Rigenerazione PDF in sospeso...")
+
+    def warn_duplicate_numbers(self):
+        """Avvisa se l'utente ha numeri di ricevuta doppi (vincolo UNIQUE non attivo)."""
+        duplicati = [d for d in db.duplicate_numbers if d['user_id'] == self.user_id]
+        if duplicati:
+            messagebox.showwarning(
+                "Numerazione",
+                "Alcuni numeri di ricevuta risultano assegnati più volte:\n"
+                f"{descrivi_duplicati(duplicati)}\n\n"
+                "Finché non vengono corretti (eliminando o rinumerando i doppioni) il "
+                "controllo di unicità della numerazione non è attivo.")
+
+    def update_status(self, busy, descrizione):
+        """Mostra/nasconde l'indicatore di avanzamento dei lavori in background."""
+        if busy:
+            if descrizione:
+                self.status_label.config(text=descrizione)
+            if not self.status_progress.winfo_ismapped():
+                self.status_progress.pack(side=tk.RIGHT)
+                self.status_progress.start(15)
+        else:
+            self.status_label.config(text="")
+            self.status_progress.stop()
+            self.status_progress.pack_forget()
 
-    def open_pdf(self, filepath):
-        """Versione blindata per risolvere WinError 2"""
-        import platform
-        import subprocess
-        import os
-        import time
+    def clear_frame(self):
+        cached = {frame for frame, _, _ in self.views.values()}
+        for widget in self.main_frame.winfo_children():
+            if widget in cached:
+                widget.pack_forget()
+            else:
+                widget.destroy()
+
+    def show_cached_view(self, name):
+        """Rimostra una schermata già costruita; False se va ancora creata."""
+        if name not in self.views:
+            return False
+        frame, _, ricarica = self.views[name]
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.check_external_changes()
+        if name in self.stale_views:
+            self.stale_views.discard(name)
+            ricarica()
+        return True
+
+    def new_cached_view(self, name, on_change, ricarica):
+        """Crea il frame di una schermata da conservare; on_change(tabella, op, id)
+        per le modifiche notificate, ricarica() per rileggere tutto dal DB."""
+        frame = ttk.Frame(self.main_frame)
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.views[name] = (frame, on_change, ricarica)
+        return frame
+
+    def apply_db_change(self, table, op, row_id):
+        for _, on_change, _ in self.views.values():
+            on_change(table, op, row_id)
+
+    def check_external_changes(self):
+        """Se il file è stato modificato da altre connessioni segna da rileggere
+        tutte le schermate conservate (sono rilette quando vengono mostrate).
+
+        Anche le scritture del thread di lavoro cambiano data_version: in quel
+        caso la rilettura è superflua ma innocua.
+        """
+        versione = db.data_version()
+        if versione != self.data_version:
+            self.data_version = versione
+            self.stale_views.update(self.views)
 
-        try:
-            # 1. TRASFORMAZIONE IN PERCORSO ASSOLUTO (Cruciale per Windows/Dropbox)
-            path_assoluto = os.path.abspath(filepath)
-            
-            # 2. ATTESA DI SICUREZZA (0.5 secondi)
-            # Diamo tempo al sistema operativo di 'rilasciare' il file appena scritto
-            time.sleep(0.5)
+    def on_focus_in(self, event):
+        if event.widget is not self.root:
+            return
+        self.check_external_changes()
+        for name in list(self.stale_views):
+            frame, _, ricarica = self.views[name]
+            if frame.winfo_ismapped():
+                self.stale_views.discard(name)
+                ricarica()
+
+    def upsert_tree_row(self, tree, iid, values, column, reverse=False):
+        """Inserisce o aggiorna una riga rispettando l'ordinamento della lista su column."""
+        iid = str(iid)
+        if tree.exists(iid):
+            tree.item(iid, values=values)
+        else:
+            tree.insert("", tk.END, iid=iid, values=values)
+        key = tree.set(iid, column)
+        others = [c for c in tree.get_children() if c != iid]
+        if reverse:
+            pos = sum(1 for c in others if tree.set(c, column) >= key)
+        else:
+            pos = sum(1 for c in others if tree.set(c, column) <= key)
+        tree.move(iid, "", pos)
 
-            if not os.path.exists(path_assoluto):
-                messagebox.showerror("Errore", f"File non trovato: {path_assoluto}")
-                return
+    def setup_sort_headings(self, tree, labels, stato, ricarica):
+        """Intestazioni cliccabili: ordinano la lista lato DB sulla colonna.
 
-            system = platform.system()
-            if system == 'Darwin':       # macOS
-                subprocess.call(['open', path_assoluto])
-            elif system == 'Windows':    # Windows
-                # Usiamo os.startfile con il percorso assoluto normalizzato
-                os.startfile(os.path.normpath(path_assoluto))
-            else:                        # Linux
-                subprocess.call(['xdg-open', path_assoluto])
-                
-        except Exception as e:
-            messagebox.showerror("Errore Apertura", f"Dettaglio errore: {e}")
+        stato è un dict {"sort": colonna, "desc": bool} condiviso con la query;
+        un secondo clic sulla stessa colonna inverte il verso.
+        """
+        def refresh():
+            for col, text in labels.items():
+                freccia = (" ▼" if stato['desc'] else " ▲") if col == stato['sort'] else ""
+                tree.heading(col, text=text + freccia, command=lambda c=col: click(c))
+
+        def click(col):
+            if stato['sort'] == col:
+                stato['desc'] = not stato['desc']
+            else:
+                stato['sort'], stato['desc'] = col, False
+            refresh()
+            ricarica()
 
-    def clear_frame(self):
-        for widget in self.main_frame.winfo_children():
-            widget.destroy()
+        refresh()
 
     def check_start(self):
         try:
@@ -1044,6 +3160,7 @@ class GestionaleRicevuteApp:
         ttk.Label(header, text=f"Dashboard - {profile['nome_completo']}", font=("Arial", 18, "bold")).pack(side=tk.LEFT)
         ttk.Button(header, text="⚙️ Profilo", command=self.show_setup).pack(side=tk.RIGHT, padx=5)
         ttk.Button(header, text="Configurazione Fiscale", command=self.show_fiscal_config).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(header, text="🔍 Cerca", command=self.show_search).pack(side=tk.RIGHT, padx=5)
         
         # MODIFICA: usa tk.Frame invece di ttk.Frame per il grid
         grid = ttk.Frame(self.main_frame)
@@ -1119,22 +3236,42 @@ class GestionaleRicevuteApp:
     # =========================================================================
     def show_clients_list(self):
         self.clear_frame()
-        self.create_header_back("Gestione Clienti", self.show_client_form, "+ Nuovo Cliente")
+        if self.show_cached_view("clienti"):
+            return
+
+        stato = {"sort": "ragione", "desc": False}
+
+        def on_change(table, op, row_id):
+            if table != "clients":
+                return
+            if op == "delete":
+                if tree.exists(str(row_id)):
+                    tree.delete(str(row_id))
+                return
+            c = db.get_client_by_id(row_id)
+            if c and c['user_id'] == self.user_id:
+                self.upsert_tree_row(tree, c['id'], (c['ragione_sociale'], c['piva_cf'], c['indirizzo']),
+                                     stato['sort'], reverse=stato['desc'])
+
+        def ricarica():
+            tree.delete(*tree.get_children())
+            for c in db.get_clients_list(self.user_id, stato['sort'], stato['desc']):
+                tree.insert("", tk.END, iid=c['id'], values=(c['ragione_sociale'], c['piva_cf'], c['indirizzo']))
+
+        view = self.new_cached_view("clienti", on_change, ricarica)
+        self.create_header_back("Gestione Clienti", self.show_client_form, "+ Nuovo Cliente", parent=view)
 
         cols = ("ragione", "piva", "indirizzo")
-        tree = ttk.Treeview(self.main_frame, columns=cols, show="headings")
-        tree.heading("ragione", text="Ragione Sociale")
-        tree.heading("piva", text="P.IVA/C.F.")
-        tree.heading("indirizzo", text="Indirizzo")
+        tree = ttk.Treeview(view, columns=cols, show="headings")
+        self.setup_sort_headings(tree, {"ragione": "Ragione Sociale", "piva": "P.IVA/C.F.",
+                                        "indirizzo": "Indirizzo"}, stato, ricarica)
         tree.column("ragione", width=300)
         tree.column("piva", width=150)
         tree.column("indirizzo", width=300)
         tree.pack(fill=tk.BOTH, expand=True, pady=10)
+        ricarica()
 
-        for c in db.get_clients(self.user_id):
-            tree.insert("", tk.END, iid=c['id'], values=(c['ragione_sociale'], c['piva_cf'], c['indirizzo']))
-
-        self.create_crud_buttons(tree, self.show_client_form, db.delete_client, self.show_clients_list)
+        self.create_crud_buttons(tree, self.show_client_form, db.delete_client, parent=view)
 
     def show_client_form(self, client_id):
         self.clear_frame()
@@ -1205,25 +3342,89 @@ class GestionaleRicevuteApp:
     # =========================================================================
     def show_assignments_list(self):
         self.clear_frame()
-        self.create_header_back("Gestione Incarichi", self.show_assignment_form, "+ Nuovo Incarico")
+        if self.show_cached_view("incarichi"):
+            return
+
+        stato = {"sort": "data", "desc": True}
+        tutti = "Tutti"
+        client_of = {}  # iid incarico -> id cliente, per propagare i cambi di ragione sociale
+        clienti = {}    # ragione sociale -> id, per il filtro
+
+        def filtri():
+            return {"client_id": clienti.get(f_cliente.get()),
+                    "stato": None if f_stato.get() == tutti else f_stato.get()}
+
+        def values(a):
+            return (a['ragione_sociale'], a['descrizione_progetto'], a['data_inizio'], a['stato'])
+
+        def upsert(assign_id):
+            a = db.get_assignment_row(assign_id, filtri())
+            if a is None:
+                # Non (piu') visibile con i filtri correnti
+                client_of.pop(str(assign_id), None)
+                if tree.exists(str(assign_id)):
+                    tree.delete(str(assign_id))
+            elif a['user_id'] == self.user_id:
+                client_of[str(a['id'])] = a['client_id']
+                self.upsert_tree_row(tree, a['id'], values(a), stato['sort'], reverse=stato['desc'])
+
+        def load_clienti():
+            clienti.clear()
+            clienti.update({c['ragione_sociale']: c['id'] for c in db.get_clients(self.user_id)})
+            f_cliente['values'] = [tutti] + list(clienti)
+
+        def on_change(table, op, row_id):
+            if table == "assignments":
+                if op == "delete":
+                    client_of.pop(str(row_id), None)
+                    if tree.exists(str(row_id)):
+                        tree.delete(str(row_id))
+                else:
+                    upsert(row_id)
+            elif table == "clients":
+                load_clienti()
+                if op == "update":
+                    for iid, cid in list(client_of.items()):
+                        if cid == row_id:
+                            upsert(iid)
+
+        def ricarica(*_):
+            tree.delete(*tree.get_children())
+            client_of.clear()
+            for a in db.get_assignments_list(self.user_id, stato['sort'], stato['desc'], filtri()):
+                client_of[str(a['id'])] = a['client_id']
+                tree.insert("", tk.END, iid=a['id'], values=values(a))
+
+        view = self.new_cached_view("incarichi", on_change, lambda: (load_clienti(), ricarica()))
+        self.create_header_back("Gestione Incarichi", self.show_assignment_form, "+ Nuovo Incarico", parent=view)
+
+        barra = ttk.Frame(view)
+        barra.pack(fill=tk.X)
+        ttk.Label(barra, text="Cliente:").pack(side=tk.LEFT)
+        f_cliente = ttk.Combobox(barra, state="readonly", width=30)
+        f_cliente.pack(side=tk.LEFT, padx=(5, 15))
+        ttk.Label(barra, text="Stato:").pack(side=tk.LEFT)
+        f_stato = ttk.Combobox(barra, state="readonly", width=15,
+                               values=[tutti, "Attivo", "Completato", "Sospeso"])
+        f_stato.pack(side=tk.LEFT, padx=5)
+        load_clienti()
+        f_cliente.set(tutti)
+        f_stato.set(tutti)
+        f_cliente.bind("<<ComboboxSelected>>", ricarica)
+        f_stato.bind("<<ComboboxSelected>>", ricarica)
 
         cols = ("cliente", "progetto", "data", "stato")
-        tree = ttk.Treeview(self.main_frame, columns=cols, show="headings")
-        tree.heading("cliente", text="Cliente")
-        tree.heading("progetto", text="Progetto")
-        tree.heading("data", text="Data Inizio")
-        tree.heading("stato", text="Stato")
+        tree = ttk.Treeview(view, columns=cols, show="headings")
+        self.setup_sort_headings(tree, {"cliente": "Cliente", "progetto": "Progetto",
+                                        "data": "Data Inizio", "stato": "Stato"}, stato, ricarica)
         tree.column("cliente", width=200)
         tree.column("progetto", width=300)
         tree.column("data", width=100)
         tree.column("stato", width=100)
         tree.pack(fill=tk.BOTH, expand=True, pady=10)
+        ricarica()
 
-        for a in db.get_assignments(self.user_id):
-            tree.insert("", tk.END, iid=a['id'], values=(
-                a['ragione_sociale'], a['descrizione_progetto'], a['data_inizio'], a['stato']))
-
-        self.create_crud_buttons(tree, self.show_assignment_form, db.delete_assignment, self.show_assignments_list)
+        self.create_crud_buttons(tree, self.show_assignment_form, db.delete_assignment, parent=view)
 
     def show_assignment_form(self, assign_id):
         self.clear_frame()
@@ -1381,42 +3582,18 @@ class GestionaleRicevuteApp:
                 messagebox.showerror("Errore", "Configurazione fiscale non trovata per l'anno")
                 return
 
-            # CALCOLO CORRETTO DELL'IMPONIBILE INPS (gestione dello "scavalco")
             cumul = db.get_annual_gross(self.user_id, anno)  # Cumulato prima di questa ricevuta
-            soglia = cfg['soglia_inps_no_tax']
-            
-            if cumul >= soglia:
-                # Caso 1: già oltre la franchigia -> tutto il nuovo compenso è imponibile
-                imponibile_inps = lordo
-            elif cumul + lordo <= soglia:
-                # Caso 2: non si raggiunge la franchigia -> niente è imponibile
-                imponibile_inps = 0.0
-            else:
-                # Caso 3: "scavalco" -> solo la parte che supera la franchigia è imponibile
-                imponibile_inps = (cumul + lordo) - soglia
-            
-            rit_inps_tot = imponibile_inps * (cfg['aliquota_gestione_separata'] / 100)
-            quota_inps = rit_inps_tot * cfg['quota_carico_utente']
-            imp_irpef = lordo * (irpef_perc / 100)
-            val_bollo = cfg['valore_bollo'] if lordo >= cfg['soglia_bollo'] else 0.00
-
-            netto = lordo + spese + val_bollo - quota_inps - imp_irpef
-
-            self.current_calc = {
-                'lordo': lordo, 'spese': spese, 'imp_inps': imponibile_inps,
-                'aliq_inps': cfg['aliquota_gestione_separata'], 'rit_inps': rit_inps_tot,
-                'quota_inps': quota_inps, 'aliq_irpef': irpef_perc, 'imp_irpef': imp_irpef,
-                'bollo_bool': val_bollo > 0, 'val_bollo': val_bollo, 'netto': netto, 'anno': anno
-            }
-
-            self.res_lordo.config(text=f"€ {lordo:.2f}")
-            self.res_spese.config(text=f"€ {spese:.2f}")
-            self.res_imp_inps.config(text=f"€ {imponibile_inps:.2f}")
-            self.res_rit_inps.config(text=f"€ {rit_inps_tot:.2f}")
-            self.res_quota_inps.config(text=f"€ -{quota_inps:.2f}")
-            self.res_irpef.config(text=f"€ -{imp_irpef:.2f}")
-            self.res_bollo.config(text=f"€ {val_bollo:.2f}")
-            self.res_netto.config(text=f"€ {netto:.2f}")
+            self.current_calc = calcola_ricevuta(cfg, cumul, lordo, spese, irpef_perc, anno)
+            c = self.current_calc
+
+            self.res_lordo.config(text=f"€ {c['lordo']:.2f}")
+            self.res_spese.config(text=f"€ {c['spese']:.2f}")
+            self.res_imp_inps.config(text=f"€ {c['imp_inps']:.2f}")
+            self.res_rit_inps.config(text=f"€ {c['rit_inps']:.2f}")
+            self.res_quota_inps.config(text=f"€ -{c['quota_inps']:.2f}")
+            self.res_irpef.config(text=f"€ -{c['imp_irpef']:.2f}")
+            self.res_bollo.config(text=f"€ {c['val_bollo']:.2f}")
+            self.res_netto.config(text=f"€ {c['netto']:.2f}")
 
         except ValueError:
             messagebox.showerror("Errore", "Valori numerici non validi")
@@ -1428,55 +3605,44 @@ class GestionaleRicevuteApp:
         if not self.rec_assign.get():
             messagebox.showerror("Errore", "Seleziona un incarico")
             return
+        if self.tasks.busy:
+            return
 
-        c = self.current_calc
-        try:
-            assign_id = self.rec_assign_map[self.rec_assign.get()]
-            num = db.get_next_receipt_number(self.user_id, c['anno'])
-            filename = f"RPO_RICEVUTE/User{self.user_id}_RPO_{c['anno']}_{num}.pdf"
-            
-            db.save_receipt(self.user_id, assign_id, num, c['anno'], self.rec_date.get(), self.rec_desc.get("1.0", tk.END).strip(),
-                c['lordo'], c['imp_inps'], c['aliq_inps'], c['rit_inps'], c['quota_inps'],
-                c['aliq_irpef'], c['imp_irpef'], c['spese'], c['bollo_bool'], c['val_bollo'], c['netto'], filename)
-
-            profile = db.get_user_profile(self.user_id)
-            assignment = db.get_assignment_by_id(assign_id)
-            client = db.get_client_by_id(assignment['client_id'])
-            
-            pdf_data = c.copy()
-            pdf_data['numero'] = num
-            pdf_data['data'] = self.rec_date.get()
-            pdf_data['desc'] = self.rec_desc.get("1.0", tk.END).strip()
-            pdf_data['cig'] = assignment['cig']
-            pdf_data['rup'] = assignment['nome_rup']
-            pdf_data['rif_det'] = assignment['rif_determina_incarico']
-            pdf_data['progetto_macro'] = assignment['descrizione_progetto']
-
-            path = genera_pdf_ricevuta(profile, client, pdf_data, filename)
+        c = self.current_calc.copy()
+        assign_id = self.rec_assign_map[self.rec_assign.get()]
+        data_em = self.rec_date.get()
+        desc = self.rec_desc.get("1.0", tk.END).strip()
+        user_id = self.user_id
+        # Dal clic all'avvio del visualizzatore, attese in coda comprese
+        azione = TRACCIA.inizio("Salva e Genera PDF")
+
+        # Eseguito nel thread di lavoro: niente widget qui dentro
+        def job():
+            with TRACCIA.span("emetti_ricevuta"):
+                return emetti_ricevuta(user_id, assign_id, c['anno'], data_em, desc, c)
+
+        def done(result):
+            num, path = result
+            def pdf_error(e):
+                TRACCIA.fine(azione, errore=str(e))
+                messagebox.showerror("Errore", f"Impossibile aprire il file: {e}")
+
+            self.open_pdf(path, on_done=lambda _: TRACCIA.fine(azione, numero=num), on_error=pdf_error)
+            with TRACCIA.span("aggiorna storico"):
+                self.show_receipts_history()
             messagebox.showinfo("Successo", f"Salvata ricevuta {num}/{c['anno']}")
-            self.open_pdf(path)
-            self.show_receipts_history()
-            
-        except Exception as e: 
+
+        def error(e):
+            TRACCIA.fine(azione, errore=str(e))
             messagebox.showerror("Errore", str(e))
 
-    def open_pdf(self, path):
-        """Versione blindata: trasforma il percorso in assoluto per evitare WinError 2"""
-        try:
-            # Forza il percorso a essere assoluto e usa i separatori corretti (\ per Windows)
-            full_path = os.path.normpath(os.path.abspath(path))
-            
-            import platform
-            import subprocess
-
-            if platform.system() == 'Darwin':       # macOS
-                subprocess.call(('open', full_path))
-            elif platform.system() == 'Windows':    # Windows
-                os.startfile(full_path)
-            else:                                   # Linux
-                subprocess.call(('xdg-open', full_path))
-        except Exception as e:
-            messagebox.showerror("Errore", f"Impossibile aprire il file: {e}")
+        self.tasks.submit(job, on_done=done, on_error=error, descrizione="Salvataggio e generazione PDF...")
+
+    def open_pdf(self, path, on_done=None, on_error=None):
+        """Apre il PDF dal thread di lavoro: il visualizzatore può impiegare secondi ad avviarsi."""
+        if on_error is None:
+            on_error = lambda e: messagebox.showerror("Errore", f"Impossibile aprire il file: {e}")
+        self.tasks.submit(apri_file, path, descrizione="Apertura PDF...", on_done=on_done, on_error=on_error)
 
     def create_res_row(self, parent, label, font_size=11, is_bold=False, color="black"):
         fr = ttk.Frame(parent); fr.pack(fill=tk.X, pady=3)
@@ -1490,24 +3656,97 @@ class GestionaleRicevuteApp:
     # =========================================================================
     def show_receipts_history(self):
         self.clear_frame()
-        self.create_header_back("Storico Ricevute", self.show_receipt_form, "+ Nuova")
+        if self.show_cached_view("storico"):
+            return
 
-        cols = ("num", "data", "cliente", "lordo", "netto")
-        tree = ttk.Treeview(self.main_frame, columns=cols, show="headings")
-        tree.heading("num", text="N."); tree.column("num", width=60)
-        tree.heading("data", text="Data"); tree.column("data", width=100)
-        tree.heading("cliente", text="Cliente"); tree.column("cliente", width=250)
-        tree.heading("lordo", text="Lordo"); tree.column("lordo", width=120)
-        tree.heading("netto", text="Netto a Pagare"); tree.column("netto", width=120)
-        tree.pack(fill=tk.BOTH, expand=True, pady=10)
+        stato = {"sort": "num", "desc": True}
+        tutti = "Tutti"
+        clienti = {}  # ragione sociale -> id, per il filtro
+
+        def load_filtri():
+            clienti.clear()
+            clienti.update({c['ragione_sociale']: c['id'] for c in db.get_clients(self.user_id)})
+            f_cliente['values'] = [tutti] + list(clienti)
+            f_anno['values'] = [tutti] + db.get_receipt_years(self.user_id)
+
+        def on_change(table, op, row_id):
+            if table == "receipts":
+                storico.apply_change(op, row_id)
+                if op == "insert":
+                    f_anno['values'] = [tutti] + db.get_receipt_years(self.user_id)
+            else:
+                load_filtri()
+                if op == "update":
+                    # Cambia il nome cliente mostrato: si rilegge la prima pagina
+                    storico.reload()
+
+        def importo(entry):
+            testo = entry.get().strip()
+            return to_cents(parse_importo(testo)) if testo else None
 
-        for r in db.get_receipts(self.user_id):
+        def ricarica(*_):
+            try:
+                filtri = {"anno": None if f_anno.get() == tutti else int(f_anno.get()),
+                          "client_id": clienti.get(f_cliente.get()),
+                          "min_cents": importo(f_min), "max_cents": importo(f_max)}
+            except ValueError:
+                messagebox.showerror("Errore", "Importo non valido")
+                return
+            storico.sort, storico.desc, storico.filtri = stato['sort'], stato['desc'], filtri
+            storico.reload()
+
+        def azzera():
+            f_anno.set(tutti)
+            f_cliente.set(tutti)
+            f_min.delete(0, tk.END)
+            f_max.delete(0, tk.END)
+            ricarica()
+
+        view = self.new_cached_view("storico", on_change, lambda: (load_filtri(), ricarica()))
+        self.create_header_back("Storico Ricevute", self.show_receipt_form, "+ Nuova", parent=view)
+
+        barra = ttk.Frame(view)
+        barra.pack(fill=tk.X)
+        ttk.Label(barra, text="Anno:").pack(side=tk.LEFT)
+        f_anno = ttk.Combobox(barra, state="readonly", width=8)
+        f_anno.pack(side=tk.LEFT, padx=(5, 15))
+        ttk.Label(barra, text="Cliente:").pack(side=tk.LEFT)
+        f_cliente = ttk.Combobox(barra, state="readonly", width=30)
+        f_cliente.pack(side=tk.LEFT, padx=(5, 15))
+        ttk.Label(barra, text="Lordo da €").pack(side=tk.LEFT)
+        f_min = ttk.Entry(barra, width=10)
+        f_min.pack(side=tk.LEFT, padx=5)
+        ttk.Label(barra, text="a €").pack(side=tk.LEFT)
+        f_max = ttk.Entry(barra, width=10)
+        f_max.pack(side=tk.LEFT, padx=5)
+        ttk.Button(barra, text="Filtra", command=ricarica).pack(side=tk.LEFT, padx=(15, 5))
+        ttk.Button(barra, text="Azzera", command=azzera).pack(side=tk.LEFT)
+        ttk.Button(barra, text="📦 Esporta", command=lambda: esporta()).pack(side=tk.RIGHT)
+        load_filtri()
+        f_anno.set(tutti)
+        f_cliente.set(tutti)
+        f_anno.bind("<<ComboboxSelected>>", ricarica)
+        f_cliente.bind("<<ComboboxSelected>>", ricarica)
+        f_min.bind("<Return>", ricarica)
+        f_max.bind("<Return>", ricarica)
+
+        def format_row(r):
             num_fmt = f"{r['numero_progressivo']}/{r['anno_riferimento']}"
             tags = ('credit_note',) if r['importo_lordo'] < 0 else ()
-            tree.insert("", tk.END, iid=r['id'], values=(
-                num_fmt, r['data_emissione'], r['ragione_sociale'], 
-                f"€ {r['importo_lordo']:.2f}", f"€ {r['netto_a_pagare']:.2f}"
-            ), tags=tags)
+            return (num_fmt, r['data_emissione'], r['ragione_sociale'],
+                    f"€ {r['importo_lordo']:.2f}", f"€ {r['netto_a_pagare']:.2f}"), tags
+
+        cols = ("num", "data", "cliente", "lordo", "netto")
+        storico = StoricoVirtuale(view, self.user_id, cols, format_row)
+        tree = storico.tree
+        self.setup_sort_headings(tree, {"num": "N.", "data": "Data", "cliente": "Cliente",
+                                        "lordo": "Lordo", "netto": "Netto a Pagare"}, stato, ricarica)
+        tree.column("num", width=60)
+        tree.column("data", width=100)
+        tree.column("cliente", width=250)
+        tree.column("lordo", width=120)
+        tree.column("netto", width=120)
+        storico.reload()
         
         tree.tag_configure('credit_note', foreground="red")
 
@@ -1522,44 +3761,83 @@ class GestionaleRicevuteApp:
 
         tree.bind("<Double-1>", open_selected_pdf)
 
+        def esporta():
+            # Esporta le ricevute dell'anno e del cliente selezionati nei filtri
+            filtri = storico.filtri
+            ids = db.get_receipt_ids(self.user_id, anno=filtri.get("anno"), client_id=filtri.get("client_id"))
+            if not ids:
+                messagebox.showinfo("Esporta", "Nessuna ricevuta da esportare")
+                return
+            nome = f"Ricevute_{filtri.get('anno') or 'tutte'}"
+            path = filedialog.asksaveasfilename(
+                title=f"Esporta {len(ids)} ricevute", initialfile=nome, defaultextension=".pdf",
+                filetypes=[("PDF unico", "*.pdf"), ("Archivio ZIP (consigliato per molte ricevute)", "*.zip")])
+            if not path:
+                return
+            if not path.lower().endswith(".zip") and len(ids) > PDF_UNICO_MAX_CONSIGLIATO:
+                # Il PDF unico resta tutto in memoria fino alla scrittura, lo ZIP no
+                if not messagebox.askyesno(
+                        "Esporta", f"Il PDF unico con {len(ids)} ricevute richiede molta memoria: "
+                                   "per selezioni così grandi è consigliato l'archivio ZIP.\n\nProcedere comunque?"):
+                    return
+
+            def job():
+                if path.lower().endswith(".zip"):
+                    aggiunti, falliti = esporta_zip(ids, path, max_workers=1)
+                    if falliti:
+                        raise RuntimeError(f"Esportati {aggiunti} PDF, {len(falliti)} non generati: "
+                                           f"{falliti[0].errore}")
+                else:
+                    esporta_pdf_unico(ids, path, max_workers=1)
+                return path
+
+            def done(path):
+                if path.lower().endswith(".zip"):
+                    messagebox.showinfo("Esporta", f"Archivio creato:\n{path}")
+                else:
+                    self.open_pdf(path)
+
+            self.tasks.submit(job, on_done=done,
+                              on_error=lambda e: messagebox.showerror("Errore", str(e)),
+                              descrizione=f"Esportazione di {len(ids)} ricevute...")
+
         def create_credit_note():
             if not tree.selection(): return
             orig_id = tree.selection()[0]
-            orig_data = db.get_receipt_by_id(orig_id)
+            with TRACCIA.span("lettura ricevuta originale", ricevuta=orig_id):
+                orig_data = db.get_receipt_by_id(orig_id)
             if not orig_data or orig_data['lordo'] < 0: return 
             
             if not messagebox.askyesno("Conferma", "Generare Nota di Credito?"): return
             
-            try:
+            user_id = self.user_id
+            # Dalla conferma all'aggiornamento dello storico, attese in coda comprese
+            azione = TRACCIA.inizio("Genera Nota di Credito", ricevuta=orig_id)
+
+            def job():
                 curr_year = date.today().year
                 today_str = date.today().strftime("%Y-%m-%d")
-                new_num = db.get_next_receipt_number(self.user_id, curr_year)
                 new_desc = f"STORNO TOTALE Ricevuta n. {orig_data['numero']}/{orig_data['anno']} - {orig_data['desc']}"
                 
                 new_vals = {k: -orig_data[k] for k in ['lordo','spese','imp_irpef','quota_inps','val_bollo','netto','imp_inps','rit_inps']}
+                for k in ['aliq_inps', 'aliq_irpef', 'bollo_bool']:
+                    new_vals[k] = orig_data[k]
                 
-                fname = f"RPO_RICEVUTE/User{self.user_id}_RPO_{curr_year}_{new_num}_STORNO.pdf"
-                
-                db.save_receipt(self.user_id, orig_data['assign_id'], new_num, curr_year, today_str, new_desc,
-                    new_vals['lordo'], new_vals['imp_inps'], orig_data['aliq_inps'], new_vals['rit_inps'], new_vals['quota_inps'],
-                    orig_data['aliq_irpef'], new_vals['imp_irpef'], new_vals['spese'], orig_data['bollo_bool'], new_vals['val_bollo'], new_vals['netto'], fname)
-                
-                prof = db.get_user_profile(self.user_id)
-                ass = db.get_assignment_by_id(orig_data['assign_id'])
-                cli = db.get_client_by_id(ass['client_id'])
-                
-                pdf_d = {'numero': new_num, 'anno': curr_year, 'data': today_str, 'desc': new_desc, 
-                         'lordo': new_vals['lordo'], 'spese': new_vals['spese'], 'imp_irpef': new_vals['imp_irpef'], 
-                         'aliq_irpef': orig_data['aliq_irpef'], 'quota_inps': new_vals['quota_inps'], 'val_bollo': new_vals['val_bollo'], 
-                         'netto': new_vals['netto'], 'cig': ass['cig'], 'rup': ass['nome_rup'], 'rif_det': ass['rif_determina_incarico'], 
-                         'imp_inps': new_vals['imp_inps'], 'rit_inps': new_vals['rit_inps'],
-                         'progetto_macro': ass['descrizione_progetto']}
-                
-                genera_pdf_ricevuta(prof, cli, pdf_d, fname, is_credit_note=True)
-                self.show_receipts_history()
-            except Exception as e: 
+                with TRACCIA.span("create_credit_note"):
+                    emetti_ricevuta(user_id, orig_data['assign_id'], curr_year, today_str, new_desc, new_vals,
+                                    is_credit_note=True)
+
+            def done(_):
+                with TRACCIA.span("aggiorna storico"):
+                    self.show_receipts_history()
+                TRACCIA.fine(azione)
+
+            def error(e):
+                TRACCIA.fine(azione, errore=str(e))
                 messagebox.showerror("Err", str(e))
 
+            self.tasks.submit(job, on_done=done, on_error=error, descrizione="Generazione nota di credito...")
+
         def do_del():
             if not tree.selection(): return
             rid = tree.selection()[0]
@@ -1570,22 +3848,78 @@ class GestionaleRicevuteApp:
                     if os.path.exists(fpath): 
                         os.remove(fpath)
                 
-                conn = db._get_connection()
-                cur = conn.cursor()
-                cur.execute("DELETE FROM receipts WHERE id=?", (rid,))
-                conn.commit()
-                conn.close()
-                self.show_receipts_history()
+                db.delete_receipt(rid)
 
-        bx = ttk.Frame(self.main_frame, padding=10)
+        bx = ttk.Frame(view, padding=10)
         bx.pack(side=tk.BOTTOM, fill=tk.X, pady=10)
         ttk.Button(bx, text="📄 Apri PDF", style="Big.TButton", command=open_selected_pdf).pack(side=tk.LEFT, padx=10)
         ttk.Button(bx, text="↩ Storna Rpo (Genera Nota di Credito)", style="Red.TButton", command=create_credit_note).pack(side=tk.LEFT, padx=10)
         ttk.Button(bx, text="🗑 Elimina", command=do_del).pack(side=tk.RIGHT, padx=10)
 
+    # =========================================================================
+    # SEZIONE 8: RICERCA
+    # =========================================================================
+    SEARCH_DELAY_MS = 150
+
+    def show_search(self):
+        self.clear_frame()
+        self.create_header_back("Ricerca", None, None)
+
+        testo = tk.StringVar()
+        entry = ttk.Entry(self.main_frame, textvariable=testo, font=("Arial", 12))
+        entry.pack(fill=tk.X, pady=(0, 10))
+        entry.focus_set()
+
+        cols = ("tipo", "titolo", "estratto")
+        tree = ttk.Treeview(self.main_frame, columns=cols, show="headings")
+        tree.heading("tipo", text="Tipo"); tree.column("tipo", width=90)
+        tree.heading("titolo", text="Descrizione"); tree.column("titolo", width=350)
+        tree.heading("estratto", text="Corrispondenza"); tree.column("estratto", width=450)
+        tree.pack(fill=tk.BOTH, expand=True)
+        risultati = {}
+        pending = [None]
+
+        def run_search():
+            pending[0] = None
+            tree.delete(*tree.get_children())
+            risultati.clear()
+            for r in db.search(self.user_id, testo.get()):
+                iid = f"{r['tipo']}-{r['id']}"
+                risultati[iid] = r
+                tree.insert("", tk.END, iid=iid, values=(r['tipo'].capitalize(), r['titolo'], r['estratto']))
+
+        def cancel_pending(*_):
+            if pending[0] is not None:
+                self.root.after_cancel(pending[0])
+                pending[0] = None
+
+        def on_type(*_):
+            # Si cerca solo quando l'utente fa una pausa nella digitazione
+            cancel_pending()
+            pending[0] = self.root.after(self.SEARCH_DELAY_MS, run_search)
+
+        def open_result(event=None):
+            if not tree.selection(): return
+            r = risultati[tree.selection()[0]]
+            if r['tipo'] == "cliente":
+                self.show_client_form(r['id'])
+            elif r['tipo'] == "incarico":
+                self.show_assignment_form(r['id'])
+            else:
+                rel_path = db.get_receipt_path(r['id'])
+                full_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), rel_path or ""))
+                if rel_path and os.path.exists(full_path):
+                    self.open_pdf(full_path)
+                else: messagebox.showerror("Err", "File non trovato")
+
+        testo.trace_add("write", on_type)
+        tree.bind("<Double-1>", open_result)
+        tree.bind("<Destroy>", cancel_pending)
+        entry.bind("<Return>", lambda e: (cancel_pending(), run_search()))
+
     # Helpers
-    def create_header_back(self, title, add_command, btn_text="+ Aggiungi"):
-        h = ttk.Frame(self.main_frame)
+    def create_header_back(self, title, add_command, btn_text="+ Aggiungi", parent=None):
+        h = ttk.Frame(parent or self.main_frame)
         h.pack(fill=tk.X, pady=(0,15))
         ttk.Button(h, text="⬅ Home", command=lambda: self.check_start()).pack(side=tk.LEFT)
         ttk.Label(h, text=title, font=("Arial", 16, "bold")).pack(side=tk.LEFT, padx=20)
@@ -1595,15 +3929,15 @@ class GestionaleRicevuteApp:
                     command=lambda: add_command(None) if add_command != self.show_dashboard else self.show_receipt_form(), 
                     style="Big.TButton").pack(side=tk.RIGHT)
             
-    def create_crud_buttons(self, tree, edit_cmd, delete_cmd, reload_cmd):
-        bx = ttk.Frame(self.main_frame)
+    def create_crud_buttons(self, tree, edit_cmd, delete_cmd, parent=None):
+        bx = ttk.Frame(parent or self.main_frame)
         bx.pack(pady=10)
         ttk.Button(bx, text="✎ Modifica", command=lambda: edit_cmd(tree.selection()[0]) if tree.selection() else None).pack(side=tk.LEFT, padx=5)
         def do_del():
             if not tree.selection(): return
             if messagebox.askyesno("Conferma", "Eliminare elemento?"): 
+                # La riga sparisce con la notifica di cancellazione del DB
                 delete_cmd(tree.selection()[0])
-                reload_cmd()
         ttk.Button(bx, text="🗑 Elimina", command=do_del).pack(side=tk.LEFT, padx=5)
 
     def create_save_cancel_btns(self, save_cmd, cancel_cmd, obj_id):
@@ -1614,10 +3948,594 @@ class GestionaleRicevuteApp:
 
 
 # =========================================================================
-# AVVIO APPLICAZIONE
+# MODULO 3-BIS: STRUMENTAZIONE (DIAGNOSTICA)
 # =========================================================================
-if __name__ == "__main__":
+
+STRUMENTI_FILE = "rpo_zero_strumenti.json"
+
+class Strumentazione:
+    """Registro in memoria dei tempi delle funzioni più usate, su richiesta.
+
+    Con --strumenti (o RPO_ZERO_STRUMENTI=1) installa() avvolge i metodi
+    pubblici di DatabaseHandler, genera_pdf_ricevuta/disegna_ricevuta, le
+    schermate show_* e il caricamento dello storico. Per ognuno conta le
+    chiamate, il tempo (totale, massimo, istogramma) e le righe restituite.
+    I tempi sono inclusivi: un metodo che ne chiama altri li comprende.
+    Per le schermate viene registrato anche il tempo fino al primo momento
+    di inattività di Tk ("fino al disegno"), così si distingue la query dal
+    riempimento della Treeview e dal ridisegno. Se non installata, nessuna
+    funzione viene toccata e il costo è nullo.
+    """
+    # Limiti superiori dei secchi dell'istogramma, in millisecondi
+    SECCHI_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, float("inf"))
+    STORICO_METODI = ("reload", "apply_change", "_insert", "_load_after", "_load_before")
+
+    def __init__(self):
+        self.attiva = False
+        self.file_json = None
+        self._lock = threading.Lock()
+        self._voci = {}
+
+    def registra(self, nome, secondi, righe=None):
+        ms = secondi * 1000
+        secchio = bisect_left(self.SECCHI_MS, ms)
+        with self._lock:
+            voce = self._voci.get(nome)
+            if voce is None:
+                voce = self._voci[nome] = {"chiamate": 0, "totale_ms": 0.0, "max_ms": 0.0, "righe": 0,
+                                           "istogramma": [0] * len(self.SECCHI_MS)}
+            voce["chiamate"] += 1
+            voce["totale_ms"] += ms
+            if ms > voce["max_ms"]:
+                voce["max_ms"] = ms
+            voce["istogramma"][secchio] += 1
+            if righe:
+                voce["righe"] += righe
+
+    @staticmethod
+    def _righe(risultato):
+        """Righe restituite: lunghezza delle liste, 1 per una singola riga o dizionario."""
+        if type(risultato) is list:
+            return len(risultato)
+        if isinstance(risultato, (sqlite3.Row, dict)):
+            return 1
+        return None
+
+    def avvolgi(self, nome, fn):
+        registra, righe = self.registra, self._righe
+
+        @wraps(fn)
+        def strumentata(*args, **kwargs):
+            t0 = time.perf_counter()
+            risultato = None
+            try:
+                risultato = fn(*args, **kwargs)
+                return risultato
+            finally:
+                registra(nome, time.perf_counter() - t0, righe(risultato))
+        return strumentata
+
+    def avvolgi_schermata(self, nome, fn):
+        base = self.avvolgi(nome, fn)
+
+        @wraps(fn)
+        def schermata(app, *args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return base(app, *args, **kwargs)
+            finally:
+                # Tk disegna i widget negli idle, dopo il ritorno dell'handler
+                app.root.after_idle(lambda: self.registra(f"{nome} (fino al disegno)", time.perf_counter() - t0))
+        return schermata
+
+    def installa(self, file_json=None):
+        """Avvolge le funzioni da misurare; con file_json i dati vengono salvati all'uscita."""
+        if self.attiva:
+            return
+        self.attiva = True
+        self.file_json = file_json
+        for nome, fn in list(vars(DatabaseHandler).items()):
+            # transaction e allocate_receipt_number ritornano context manager: il tempo
+            # speso dentro il blocco appartiene al chiamante
+            if (nome.startswith("_") or not inspect.isfunction(fn) or nome == "transaction"
+                    or inspect.isgeneratorfunction(inspect.unwrap(fn))):
+                continue
+            setattr(DatabaseHandler, nome, self.avvolgi(f"db.{nome}", fn))
+        for nome in ("genera_pdf_ricevuta", "disegna_ricevuta"):
+            globals()[nome] = self.avvolgi(nome, globals()[nome])
+        for nome, fn in list(vars(GestionaleRicevuteApp).items()):
+            if nome.startswith("show_") and inspect.isfunction(fn):
+                setattr(GestionaleRicevuteApp, nome, self.avvolgi_schermata(nome, fn))
+        for nome in self.STORICO_METODI:
+            setattr(StoricoVirtuale, nome, self.avvolgi(f"StoricoVirtuale.{nome}", vars(StoricoVirtuale)[nome]))
+        if file_json:
+            atexit.register(self.salva)
+
+    def azzera(self):
+        with self._lock:
+            self._voci.clear()
+
+    def istantanea(self):
+        """Copia dei contatori con media e p95 (limite superiore del secchio) calcolati."""
+        with self._lock:
+            voci = {nome: dict(voce, istogramma=list(voce["istogramma"])) for nome, voce in self._voci.items()}
+        for voce in voci.values():
+            voce["media_ms"] = voce["totale_ms"] / voce["chiamate"]
+            soglia, cumulato = 0.95 * voce["chiamate"], 0
+            for limite, n in zip(self.SECCHI_MS, voce["istogramma"]):
+                cumulato += n
+                if cumulato >= soglia:
+                    voce["p95_ms"] = limite if limite != float("inf") else voce["max_ms"]
+                    break
+        return voci
+
+    def salva(self, path=None):
+        """Scrive i contatori in JSON (default: il file indicato a installa())."""
+        path = path or self.file_json
+        if not path:
+            return
+        dati = {
+            "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "secchi_ms": [limite if limite != float("inf") else None for limite in self.SECCHI_MS],
+            "voci": self.istantanea(),
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dati, f, indent=2, ensure_ascii=False)
+
+STRUMENTI = Strumentazione()
+
+
+def mostra_pannello_strumenti(root):
+    """Finestra di debug con i contatori della strumentazione (Ctrl+Maiusc+D)."""
+    win = tk.Toplevel(root)
+    win.title("RPO Zero - Strumentazione")
+    win.geometry("950x500")
+    cols = ("nome", "chiamate", "totale", "media", "p95", "max", "righe")
+    tree = ttk.Treeview(win, columns=cols, show="headings")
+    for col, testo, larghezza in (("nome", "Funzione", 330), ("chiamate", "Chiamate", 80),
+                                  ("totale", "Totale ms", 100), ("media", "Media ms", 90),
+                                  ("p95", "p95 ≤ ms", 90), ("max", "Max ms", 90), ("righe", "Righe", 90)):
+        tree.heading(col, text=testo)
+        tree.column(col, width=larghezza, anchor=tk.W if col == "nome" else tk.E)
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    def aggiorna():
+        tree.delete(*tree.get_children())
+        voci = sorted(STRUMENTI.istantanea().items(), key=lambda kv: kv[1]["totale_ms"], reverse=True)
+        for nome, v in voci:
+            tree.insert("", tk.END, values=(nome, v["chiamate"], f"{v['totale_ms']:.1f}", f"{v['media_ms']:.2f}",
+                                            f"{v['p95_ms']:g}", f"{v['max_ms']:.1f}", v["righe"]))
+
+    def azzera():
+        STRUMENTI.azzera()
+        aggiorna()
+
+    def salva():
+        path = filedialog.asksaveasfilename(parent=win, initialfile=STRUMENTI_FILE, defaultextension=".json",
+                                            filetypes=[("JSON", "*.json")])
+        if path:
+            STRUMENTI.salva(path)
+
+    bx = ttk.Frame(win, padding=10)
+    bx.pack(fill=tk.X)
+    ttk.Button(bx, text="Aggiorna", command=aggiorna).pack(side=tk.LEFT, padx=5)
+    ttk.Button(bx, text="Azzera", command=azzera).pack(side=tk.LEFT, padx=5)
+    ttk.Button(bx, text="Salva JSON...", command=salva).pack(side=tk.RIGHT, padx=5)
+    aggiorna()
+
+
+TRACCIA_FILE = "rpo_zero_traccia.json"
+
+class Tracciatore:
+    """Intervalli annidati (span) delle azioni dell'utente, in formato Chrome trace.
+
+    Con --traccia (o RPO_ZERO_TRACCIA=1) ogni span() diventa un evento
+    "complete" del thread che lo esegue: Perfetto (ui.perfetto.dev) o
+    chrome://tracing li mostrano annidati per tempo, thread per thread.
+    Un'azione che passa tra thread (clic nella GUI, lavoro in background,
+    apertura del PDF) è un intervallo asincrono, da inizio() a fine().
+    A differenza della Strumentazione non aggrega: si vede la singola
+    esecuzione, con i suoi tempi morti. Disattivato, span() ritorna un
+    context manager vuoto e il costo è trascurabile.
+    """
+    EVENTI_MAX = 200_000
+    _NULLO = nullcontext()
+
+    def __init__(self):
+        self.attivo = False
+        self.file_json = None
+        self._eventi = deque(maxlen=self.EVENTI_MAX)
+        self._thread = {}
+        self._azioni = count(1)
+
+    def attiva(self, file_json=TRACCIA_FILE):
+        """Inizia a registrare; il file viene scritto all'uscita."""
+        if not self.attivo:
+            atexit.register(self.salva)
+        self.attivo = True
+        self.file_json = file_json
+
+    @staticmethod
+    def _adesso():
+        return time.perf_counter_ns() / 1000  # microsecondi
+
+    def _evento(self, evento):
+        tid = threading.get_native_id()
+        if tid not in self._thread:
+            self._thread[tid] = threading.current_thread().name
+        evento["pid"], evento["tid"] = os.getpid(), tid
+        self._eventi.append(evento)
+
+    def span(self, nome, **args):
+        """Context manager che registra il tempo del blocco come figlio degli span aperti."""
+        if not self.attivo:
+            return self._NULLO
+        return self._span(nome, args)
+
+    @contextmanager
+    def _span(self, nome, args):
+        inizio = self._adesso()
+        try:
+            yield
+        finally:
+            self._evento({"name": nome, "cat": "span", "ph": "X", "ts": inizio,
+                          "dur": self._adesso() - inizio, "args": args})
+
+    def inizio(self, nome, **args):
+        """Apre un'azione che può terminare in un altro thread; ritorna il suo id (None se disattivo)."""
+        if not self.attivo:
+            return None
+        id_azione = next(self._azioni)
+        self._evento({"name": nome, "cat": "azione", "ph": "b", "id": id_azione, "ts": self._adesso(),
+                      "args": args})
+        return id_azione, nome
+
+    def fine(self, azione, **args):
+        if azione is None:
+            return
+        id_azione, nome = azione
+        self._evento({"name": nome, "cat": "azione", "ph": "e", "id": id_azione, "ts": self._adesso(),
+                      "args": args})
+
+    def salva(self, path=None):
+        """Scrive il file JSON della traccia (Trace Event Format)."""
+        path = path or self.file_json
+        if not path:
+            return
+        eventi = list(self._eventi)
+        nomi = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": nome}}
+                for tid, nome in list(self._thread.items())]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": nomi + eventi, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+TRACCIA = Tracciatore()
+
+
+# =========================================================================
+# MODULO 4: RIGA DI COMANDO
+# =========================================================================
+
+def cmd_totali(args):
+    """Verifica i totali annui materializzati ed eventualmente li ricostruisce."""
+    diffs = db.verify_annual_totals()
+    for user_id, anno, campo, atteso, memorizzato in diffs:
+        if campo.endswith("_cents"):
+            atteso, memorizzato = f"{from_cents(atteso):.2f}", f"{from_cents(memorizzato):.2f}"
+        print(f"Utente {user_id} anno {anno}: {campo} atteso {atteso}, memorizzato {memorizzato}")
+    if not diffs:
+        print("Totali annui coerenti con le ricevute.")
+        return 0
+    if args.ricostruisci:
+        db.rebuild_annual_totals()
+        print("Totali annui ricostruiti.")
+        return 0
+    return 1
+
+
+def parse_importo(valore):
+    """Converte un importo da CSV/JSON: accetta 1234.56, "1234,56" e "1.234,56"."""
+    if isinstance(valore, (int, float)):
+        return float(valore)
+    testo = str(valore).strip().replace("€", "").replace(" ", "")
+    if not testo:
+        return 0.0
+    if "," in testo:
+        testo = testo.replace(".", "").replace(",", ".")
+    return float(testo)
+
+
+def leggi_voci(path):
+    """Legge le ricevute da creare da un file .json (lista di oggetti) o .csv con intestazione.
+
+    Campi: incarico (id), data (YYYY-MM-DD), descrizione, lordo, spese (default 0),
+    irpef (% ritenuta, default 20), anno (default: anno della data).
+    """
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            sample = f.read(4096)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            raw = list(csv.DictReader(f, dialect=dialect))
+
+    voci = []
+    for i, item in enumerate(raw, start=1):
+        item = {str(k).strip().lower(): v for k, v in item.items()}
+        try:
+            data_em = date.fromisoformat(str(item["data"]).strip())
+            # 20% solo se la colonna manca o è vuota: "irpef": 0 (JSON) vale 0
+            irpef = item.get("irpef")
+            voci.append({
+                'incarico': int(item["incarico"]),
+                'data': data_em.isoformat(),
+                'descrizione': str(item.get("descrizione") or "").strip(),
+                'lordo': parse_importo(item["lordo"]),
+                'spese': parse_importo(item.get("spese") or 0),
+                'irpef': parse_importo(20 if irpef is None or str(irpef).strip() == "" else irpef),
+                'anno': int(item.get("anno") or data_em.year),
+            })
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"Riga {i}: dato mancante o non valido ({e})")
+    return voci
+
+
+def prepara_ricevute_bulk(user_id, voci):
+    """Calcola numerazione e importi di tutte le voci: un passaggio di
+    FiscalEngine per ogni anno, con il cumulato annuo che parte dal già
+    fatturato. Ritorna le righe nel formato di save_receipts_bulk."""
+    assignments = {a['id'] for a in db.get_assignments(user_id)}
+    per_anno = {}
+    for i, voce in enumerate(voci, start=1):
+        if voce['incarico'] not in assignments:
+            raise ValueError(f"Riga {i}: incarico {voce['incarico']} inesistente")
+        per_anno.setdefault(voce['anno'], []).append(voce)
+    # Come emetti_ricevuta: nessun numero assegnato se il PDF non si potrà generare
+    for assignment_id in {voce['incarico'] for voce in voci}:
+        verifica_dati_emissione(db.get_issue_context(user_id, assignment_id), assignment_id)
+
+    rows = []
+    for anno, voci_anno in per_anno.items():
+        db.ensure_fiscal_config_exists(user_id, anno)
+        engine = FiscalEngine(db.get_fiscal_config(user_id, anno), anno)
+        calcoli = engine.righe([v['lordo'] for v in voci_anno], [v['spese'] for v in voci_anno],
+                               [v['irpef'] for v in voci_anno], db.get_annual_gross(user_id, anno))
+        num = db.get_next_receipt_number(user_id, anno)
+        for voce, c in zip(voci_anno, calcoli):
+            filename = f"RPO_RICEVUTE/User{user_id}_RPO_{anno}_{num}.pdf"
+            rows.append((user_id, voce['incarico'], num, anno, voce['data'], voce['descrizione'],
+                         c['lordo'], c['imp_inps'], c['aliq_inps'], c['rit_inps'], c['quota_inps'],
+                         c['aliq_irpef'], c['imp_irpef'], c['spese'], c['bollo_bool'], c['val_bollo'], c['netto'], filename))
+            num += 1
+    return rows
+
+
+def crea_ricevute_bulk(user_id, voci):
+    """Crea tutte le ricevute in un'unica transazione: o tutte o nessuna.
+    Ritorna (ids, righe)."""
+    # IMMEDIATE: numerazione e cumulato non possono cambiare sotto i nostri piedi
+    with db.transaction("IMMEDIATE"):
+        rows = prepara_ricevute_bulk(user_id, voci)
+        ids = db.save_receipts_bulk(rows)
+    return ids, rows
+
+
+def cmd_crea_ricevute(args):
+    """Crea ricevute in blocco da CSV/JSON e ne genera i PDF in parallelo."""
+    user_id = cli_login(args.utente)
+    try:
+        voci = leggi_voci(args.input)
+    except (OSError, ValueError, csv.Error) as e:
+        print(f"Errore nel file di input: {e}")
+        return 2
+
+    if args.simula:
+        with db.transaction():
+            rows = prepara_ricevute_bulk(user_id, voci)
+        ids = [None] * len(rows)
+    else:
+        ids, rows = crea_ricevute_bulk(user_id, voci)
+
+    for row in rows:
+        # row[2]=numero, row[3]=anno, row[6]=lordo, row[16]=netto
+        print(f"Ricevuta {row[2]}/{row[3]}: lordo {row[6]:.2f}, netto {row[16]:.2f}")
+    if args.simula:
+        print(f"Simulazione: {len(rows)} ricevute, nulla è stato salvato.")
+        return 0
+    print(f"Salvate {len(ids)} ricevute.")
+
+    if args.senza_pdf:
+        print("PDF in sospeso: generarli con 'rigenera-pdf --in-sospeso'.")
+        return 0
+    results = genera_pdf_batch(ids, max_workers=args.processi)
+    failed = [r for r in results if not r.ok]
+    for r in failed:
+        print(f"PDF non generato {r.filename}: {r.errore}")
+    print(f"Generati {len(results) - len(failed)} PDF, {len(failed)} errori.")
+    return 1 if failed else 0
+
+
+def cli_login(username):
+    """Autentica l'utente da riga di comando (password da RPO_ZERO_PASSWORD o richiesta a terminale)."""
+    password = os.environ.get("RPO_ZERO_PASSWORD") or getpass.getpass(f"Password per {username}: ")
+    user = db.login_user(username, password)
+    if not user:
+        raise SystemExit("Credenziali non valide")
+    return user['id']
+
+
+def cmd_rigenera_pdf(args):
+    """Rigenera in parallelo i PDF delle ricevute selezionate."""
+    user_id = cli_login(args.utente)
+    ids = db.get_receipt_ids(user_id, anno=args.anno, client_id=args.cliente, assignment_id=args.incarico,
+                             in_sospeso=args.in_sospeso)
+
+    def progress(done, total, result):
+        stato = "invariato" if result.saltato else "OK" if result.ok else f"ERRORE: {result.errore}"
+        print(f"[{done}/{total}] {result.filename} {stato}")
+
+    results = genera_pdf_batch(ids, max_workers=args.processi, progress_callback=progress, forza=args.forza)
+    failed = [r for r in results if not r.ok]
+    skipped = sum(1 for r in results if r.saltato)
+    print(f"Generati {len(results) - len(failed) - skipped} PDF, {skipped} invariati, {len(failed)} errori.")
+    return 1 if failed else 0
+
+
+def cmd_verifica_pdf(args):
+    """Controlla i PDF dell'utente: mancanti, obsoleti e file orfani in RPO_RICEVUTE."""
+    user_id = cli_login(args.utente)
+    esito = verifica_cache_pdf(user_id)
+    for rid in esito.mancanti:
+        print(f"Ricevuta {rid}: PDF mancante")
+    for rid in esito.obsoleti:
+        print(f"Ricevuta {rid}: PDF non aggiornato")
+    for path in esito.orfani:
+        print(f"File orfano: {path}")
+    if esito.senza_impronta:
+        if args.registra_impronte:
+            db.set_render_hashes(esito.senza_impronta)
+            print(f"Registrata l'impronta di {len(esito.senza_impronta)} PDF emessi in precedenza "
+                  "(i file non sono stati modificati).")
+        else:
+            print(f"{len(esito.senza_impronta)} PDF emessi prima delle impronte: non verificabili, "
+                  "non vengono rigenerati (--registra-impronte per adottarli così come sono).")
+    if not (esito.mancanti or esito.obsoleti or esito.orfani):
+        print("PDF coerenti con le ricevute.")
+        return 0
+
+    problemi = False
+    if args.ripara and (esito.mancanti or esito.obsoleti):
+        results = genera_pdf_batch(esito.mancanti + esito.obsoleti, max_workers=args.processi)
+        failed = [r for r in results if not r.ok]
+        for r in failed:
+            print(f"PDF non generato {r.filename}: {r.errore}")
+        print(f"Rigenerati {len(results) - len(failed)} PDF, {len(failed)} errori.")
+        problemi = bool(failed)
+    elif esito.mancanti or esito.obsoleti:
+        problemi = True
+    if args.pulisci and esito.orfani:
+        for path in esito.orfani:
+            os.remove(path)
+        print(f"Eliminati {len(esito.orfani)} file orfani.")
+    elif esito.orfani:
+        problemi = True
+    return 1 if problemi else 0
+
+
+def cmd_esporta(args):
+    """Esporta le ricevute selezionate in un unico PDF o in uno ZIP ('-' = stdout)."""
+    user_id = cli_login(args.utente)
+    ids = db.get_receipt_ids(user_id, anno=args.anno, client_id=args.cliente, assignment_id=args.incarico)
+    if not ids:
+        print("Nessuna ricevuta da esportare.", file=sys.stderr)
+        return 1
+    formato = args.formato or ("zip" if args.output.lower().endswith(".zip") else "pdf")
+    dest = sys.stdout.buffer if args.output == "-" else args.output
+    if formato == "zip":
+        aggiunti, falliti = esporta_zip(ids, dest, max_workers=args.processi)
+        for r in falliti:
+            print(f"PDF non generato {r.filename}: {r.errore}", file=sys.stderr)
+        print(f"Esportati {aggiunti} PDF, {len(falliti)} errori.", file=sys.stderr)
+        return 1 if falliti else 0
+    if len(ids) > PDF_UNICO_MAX_CONSIGLIATO:
+        print(f"Attenzione: il PDF unico con {len(ids)} ricevute resta in memoria fino alla scrittura; "
+              "per selezioni così grandi usare --formato zip (memoria costante).", file=sys.stderr)
+    try:
+        n = esporta_pdf_unico(ids, dest, max_workers=args.processi)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"Esportate {n} ricevute in un unico PDF.", file=sys.stderr)
+    return 0
+
+
+def report_startup():
+    """Stampa i tempi di avvio raccolti con startup_mark (su file se non c'è console)."""
+    lines = ["Profilo di avvio RPO Zero (secondi da inizio import):"]
+    previous = 0.0
+    for fase, t in STARTUP_TIMINGS:
+        lines.append(f"  {fase:<32} {t:8.3f}  (+{t - previous:.3f})")
+        previous = t
+    report = "\n".join(lines)
+    if sys.stderr is not None:
+        print(report, file=sys.stderr)
+    else:
+        # Eseguibile --noconsole: niente stderr, scriviamo accanto al database
+        with open("rpo_zero_startup.log", "a", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="rpo-zero", description="RPO Zero - Gestionale Ricevute Prestazione Occasionale")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="mostra i tempi di import e inizializzazione all'apertura del login")
+    parser.add_argument("--strumenti", nargs="?", const=STRUMENTI_FILE, metavar="FILE",
+                        help="misura i tempi di query, PDF e schermate (pannello: Ctrl+Maiusc+D) "
+                             f"e li salva in JSON all'uscita (default: {STRUMENTI_FILE})")
+    parser.add_argument("--slow-sql", nargs="?", type=float, const=50.0, metavar="MS",
+                        help=f"scrive in {SLOW_SQL_FILE} le istruzioni SQL più lente di MS millisecondi "
+                             "(default 50) con il loro piano di esecuzione")
+    parser.add_argument("--traccia", nargs="?", const=TRACCIA_FILE, metavar="FILE",
+                        help="registra gli intervalli di salvataggio, note di credito e PDF in formato "
+                             f"Chrome trace, da aprire con Perfetto (default: {TRACCIA_FILE})")
+    sub = parser.add_subparsers(dest="comando")
+
+    p_tot = sub.add_parser("totali", help="verifica i totali annui materializzati")
+    p_tot.add_argument("--ricostruisci", action="store_true", help="ricalcola i totali se non coerenti")
+    p_tot.set_defaults(func=cmd_totali)
+
+    p_pdf = sub.add_parser("rigenera-pdf", help="rigenera i PDF delle ricevute in parallelo")
+    p_pdf.add_argument("--utente", required=True, help="username")
+    p_pdf.add_argument("--anno", type=int, help="solo le ricevute di questo anno")
+    p_pdf.add_argument("--cliente", type=int, help="solo le ricevute di questo cliente (id)")
+    p_pdf.add_argument("--incarico", type=int, help="solo le ricevute di questo incarico (id)")
+    p_pdf.add_argument("--processi", type=int, help="numero di processi (default: uno per core)")
+    p_pdf.add_argument("--in-sospeso", action="store_true",
+                       help="solo le ricevute con PDF non ancora generato o fallito")
+    p_pdf.add_argument("--forza", action="store_true",
+                       help="rigenera anche i PDF già aggiornati (stessa impronta dei dati)")
+    p_pdf.set_defaults(func=cmd_rigenera_pdf)
+
+    p_ver = sub.add_parser("verifica-pdf", help="controlla PDF mancanti, non aggiornati e file orfani")
+    p_ver.add_argument("--utente", required=True, help="username")
+    p_ver.add_argument("--ripara", action="store_true", help="rigenera i PDF mancanti o non aggiornati")
+    p_ver.add_argument("--pulisci", action="store_true", help="elimina i file orfani in RPO_RICEVUTE")
+    p_ver.add_argument("--registra-impronte", action="store_true",
+                       help="registra l'impronta dei PDF emessi prima del controllo, senza rigenerarli")
+    p_ver.add_argument("--processi", type=int, help="numero di processi per i PDF (default: uno per core)")
+    p_ver.set_defaults(func=cmd_verifica_pdf)
+
+    p_exp = sub.add_parser("esporta", help="esporta le ricevute in un unico PDF o in uno ZIP",
+                           description="Esporta le ricevute in un unico PDF o in uno ZIP. Solo lo ZIP usa "
+                                       "memoria costante: il PDF unico resta in memoria fino alla scrittura, "
+                                       "per migliaia di ricevute usare lo ZIP.")
+    p_exp.add_argument("--utente", required=True, help="username")
+    p_exp.add_argument("--anno", type=int, help="solo le ricevute di questo anno")
+    p_exp.add_argument("--cliente", type=int, help="solo le ricevute di questo cliente (id)")
+    p_exp.add_argument("--incarico", type=int, help="solo le ricevute di questo incarico (id)")
+    p_exp.add_argument("--output", required=True, help="file .pdf o .zip da creare ('-' per lo standard output)")
+    p_exp.add_argument("--formato", choices=("pdf", "zip"),
+                       help="default: dall'estensione di --output; zip per selezioni molto grandi")
+    p_exp.add_argument("--processi", type=int, help="numero di processi per i PDF mancanti da generare")
+    p_exp.set_defaults(func=cmd_esporta)
+
+    p_new = sub.add_parser("crea-ricevute", help="crea ricevute in blocco da un file CSV o JSON")
+    p_new.add_argument("--utente", required=True, help="username")
+    p_new.add_argument("--input", required=True, help="file .csv o .json con le ricevute da creare")
+    p_new.add_argument("--simula", action="store_true", help="mostra i calcoli senza salvare")
+    p_new.add_argument("--senza-pdf", action="store_true", help="salva le ricevute senza generare i PDF")
+    p_new.add_argument("--processi", type=int, help="numero di processi per i PDF (default: uno per core)")
+    p_new.set_defaults(func=cmd_crea_ricevute)
+
+    return parser
+
+
+def avvia_gui(profile_startup=False):
     root = tk.Tk()
+    startup_mark("creazione finestra Tk")
+    if STRUMENTI.attiva:
+        root.bind_all("<Control-Shift-KeyPress-D>", lambda e: mostra_pannello_strumenti(root))
     
     # Callback che viene chiamata se il login ha successo
     def launch_app(user_id, user_name):
@@ -1625,5 +4543,56 @@ if __name__ == "__main__":
 
     # Avvia la schermata di login invece dell'app diretta
     login_screen = LoginWindow(root, on_login_success=launch_app)
+    startup_mark("schermata di login")
+
+    if profile_startup:
+        def login_visible():
+            startup_mark("login visibile")
+            report_startup()
+        root.after_idle(login_visible)
     
     root.mainloop()
+
+
+# Codice di uscita dei comandi riusciti su un database con numeri di ricevuta doppi
+ESITO_NUMERI_DUPLICATI = 3
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    # RPO_ZERO_STRUMENTI=1 (o il percorso del file JSON) equivale a --strumenti
+    strumenti = args.strumenti or os.environ.get("RPO_ZERO_STRUMENTI")
+    if strumenti:
+        STRUMENTI.installa(strumenti if strumenti.lower().endswith(".json") else STRUMENTI_FILE)
+    # RPO_ZERO_SLOW_SQL_MS=<soglia> equivale a --slow-sql <soglia>
+    slow_sql = args.slow_sql if args.slow_sql is not None else os.environ.get("RPO_ZERO_SLOW_SQL_MS")
+    if slow_sql not in (None, ""):
+        SLOW_SQL.configura(slow_sql)
+    # RPO_ZERO_TRACCIA=1 (o il percorso del file JSON) equivale a --traccia
+    traccia = args.traccia or os.environ.get("RPO_ZERO_TRACCIA")
+    if traccia:
+        TRACCIA.attiva(traccia if traccia.lower().endswith(".json") else TRACCIA_FILE)
+    if args.profile_startup:
+        db._ensure_schema()
+        startup_mark("inizializzazione database")
+    if args.comando:
+        db._ensure_schema()
+        result = args.func(args)
+        if args.profile_startup:
+            report_startup()
+        if db.duplicate_numbers:
+            print("ATTENZIONE: numeri di ricevuta duplicati, vincolo di unicità non applicato: "
+                  f"{descrivi_duplicati(db.duplicate_numbers)}", file=sys.stderr)
+            return result or ESITO_NUMERI_DUPLICATI
+        return result
+    avvia_gui(profile_startup=args.profile_startup)
+    return 0
+
+
+# =========================================================================
+# AVVIO APPLICAZIONE
+# =========================================================================
+startup_mark("definizione moduli")
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # necessario per l'eseguibile PyInstaller su Windows
+    sys.exit(main())